@@ -0,0 +1,160 @@
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+from .metrics import KrpcMetrics
+
+"""
+    krpc access log
+
+    every packet is offered to an `AccessSampler`, only sampled packets become log records, and their
+    payload is wrapped in `LazyPacket` so nothing is formatted on the event loop. the krpc logger's
+    handlers are moved behind a bounded queue drained by a `QueueListener` thread while the server
+    runs, see `start_background_logging`
+
+    sample rates are keyed by packet kind, the most specific key wins:
+
+        q:<query>   q       queries, e.g. `q:find_node`
+        r                   responses
+        e:<code>    e       errors, e.g. `e:203`
+        invalid             packets which are not krpc messages
+"""
+
+DEFAULT_SAMPLE_RATES = {
+    'q': 0.01,
+    'r': 0.001,
+    'e': 1.0,
+    'invalid': 0.01,
+}
+
+_DISABLED = object()    # counter of a key whose sampling is disabled
+
+
+class AccessSampler:
+    """
+    deterministic 1 in N sampling per kind, the first packet of every kind is sampled
+
+    Examples:
+    >>> sampler = AccessSampler({'q': 0.01, 'q:announce_peer': 1})
+    >>> sampler.sample('q', 'ping')
+    True
+    """
+
+    def __init__(self, rates: dict = None):
+        rates = dict(DEFAULT_SAMPLE_RATES, **(rates or {}))
+        # rate -> period, a period of 0 disables sampling
+        self._periods = {k: (round(1 / v) if v > 0 else 0) for k, v in rates.items()}
+        # queries and error codes are chosen by the remote, unknown ones share the `other` counter
+        self._subs = KrpcMetrics.queries | KrpcMetrics.errors | {k.split(':', 1)[1] for k in rates if ':' in k}
+        self._counters = dict()
+        self.sampled = 0
+
+    def period(self, kind: str, sub: str = None) -> int:
+        if sub is not None:
+            period = self._periods.get(kind + ':' + sub)
+            if period is not None:
+                return period
+        return self._periods.get(kind, 0)
+
+    def sample(self, kind: str, sub: str = None) -> bool:
+        if sub is not None and sub not in self._subs:
+            sub = 'other'
+        key = (kind, sub)
+        count = self._counters.get(key)
+        if count is None:
+            # the period of a key is looked up once
+            period = self.period(kind, sub)
+            if not period:
+                self._counters[key] = _DISABLED
+                return False
+            count = self._counters[key] = [0, period]
+        elif count is _DISABLED:
+            return False
+        count[0] += 1
+        if count[0] % count[1] != 1 % count[1]:
+            return False
+        self.sampled += 1
+        return True
+
+    @staticmethod
+    def kind_of(msg) -> tuple[str, str | None]:
+        """ sampling key of a decoded `codec.KrpcMessage` """
+        y = msg.y
+        if y == b'q':
+            return 'q', msg.query
+        if y == b'e':
+            code = msg.e[0] if isinstance(msg.e, list) and msg.e else None
+            return 'e', str(code) if code is not None else None
+        return 'r', None
+
+
+class LazyPacket:
+    """ formatted only when a handler emits the record, ids are compact hex """
+    __slots__ = ('msg', 'addr')
+
+    def __init__(self, msg, addr):
+        self.msg = msg
+        self.addr = addr
+
+    def __str__(self):
+        msg = self.msg
+        fields = ['from={}:{}'.format(*self.addr[:2])]
+        if isinstance(msg, (bytes, bytearray, memoryview)):
+            fields.append('data={}'.format(bytes(msg[:64]).hex()))
+            return '|'.join(fields)
+        for name in ('y', 'q', 't', 'v'):
+            val = getattr(msg, name, None)
+            if val is not None:
+                fields.append('{}={}'.format(name, val.decode('ascii', 'replace') if name in 'yq' else val.hex()))
+        for name in ('id', 'target', 'info_hash'):
+            val = getattr(msg, name, None)
+            if val is not None:
+                fields.append('{}={}'.format(name, val.hex()))
+        if getattr(msg, 'nodes', None) is not None:
+            fields.append('nodes={}'.format(len(msg.nodes) // 26))
+        if getattr(msg, 'values', None) is not None:
+            fields.append('values={}'.format(len(msg.values)))
+        if getattr(msg, 'e', None) is not None:
+            fields.append('e={}'.format(msg.e))
+        return '|'.join(fields)
+
+    __repr__ = __str__
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """ enqueue records as they are, formatting happens in the listener thread; a full queue drops records """
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def start_background_logging(logger: logging.Logger, maxsize=1 << 14) -> QueueListener | None:
+    """ move the handlers of `logger` behind a queue listener thread, calling it twice is harmless """
+    if any(isinstance(x, BackgroundQueueHandler) for x in logger.handlers) or not logger.handlers:
+        return None
+    q = queue.Queue(maxsize)
+    listener = QueueListener(q, *logger.handlers, respect_handler_level=True)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(BackgroundQueueHandler(q))
+    listener.start()
+    return listener
+
+
+def stop_background_logging(logger: logging.Logger, listener: QueueListener):
+    """ undo `start_background_logging`, the queued records are written before it returns """
+    for handler in listener.handlers:
+        logger.addHandler(handler)
+    for handler in [x for x in logger.handlers if isinstance(x, BackgroundQueueHandler)]:
+        logger.removeHandler(handler)
+    listener.stop()
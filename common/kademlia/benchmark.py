@@ -0,0 +1,249 @@
+import argparse
+import asyncio as aio
+import os
+import struct
+import tempfile
+import time
+
+import bencodepy
+import numpy as np
+
+from . import codec, krpc
+from .crawler import InfohashIndex
+from .download import Download, BLOCK_SIZE
+from .storage import FileStorage
+from .framer import Framer, parse_piece
+from .node import Node
+from .simulator import SimNetwork, Swarm
+
+"""
+    benchmarks of the krpc hot path and of a simulated swarm
+
+    usage: python -m common.kademlia.benchmark [codec] [swarm] [index] [framer] [picker] [storage] [--size 500 --lookups 200 --loss 0.01]
+"""
+
+
+def _sample_queries():
+    node_id, target, t = Node.create_random().data, Node.create_random().data, b'\x12\x34'
+    return [
+        krpc.PingRequest(transaction_id=t, arguments=dict(id=node_id)).bencode(),
+        krpc.FindNodeRequest(transaction_id=t, arguments=dict(id=node_id, target=target)).bencode(),
+        krpc.GetPeersRequest(transaction_id=t, arguments=dict(id=node_id, info_hash=target)).bencode(),
+    ]
+
+
+def _sample_response():
+    nodes = b''.join(krpc.compact_node_info(Node.create_random().data, '10.0.0.1', 6881) for _ in range(8))
+    return krpc.FindNodeResponse(
+        transaction_id=b'\x12\x34',
+        visible_addr=krpc.compact_ip_port('10.0.0.2', 6881),
+        response=dict(id=Node.create_random().data, nodes=nodes),
+    ).bencode()
+
+
+def _serve_legacy(data: bytes, node_id: bytes, ip: bytes, nodes: bytes):
+    """ the bencodepy + serializer path used by KrpcProtocol before the codec """
+    req = krpc.parse_request(obj=bencodepy.decode(data))
+    req.validate()
+    if req.query == krpc.QueryType.PING:
+        resp = krpc.PingResponse(transaction_id=req.transaction_id, visible_addr=ip, response=dict(id=node_id))
+    else:
+        resp = krpc.FindNodeResponse(transaction_id=req.transaction_id, visible_addr=ip,
+                                     response=dict(id=node_id, nodes=nodes))
+    return resp.bencode()
+
+
+def _serve_codec(data: bytes, node_id: bytes, ip: bytes, nodes: bytes):
+    msg = codec.decode(data).validate()
+    if msg.q == b'ping':
+        return codec.encode_ping_response(msg.t, node_id, ip)
+    return codec.encode_find_node_response(msg.t, node_id, ip, nodes)
+
+
+def _rate(func, packets, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for p in packets:
+            func(p)
+    return rounds * len(packets) / (time.perf_counter() - start)
+
+
+def bench_codec(rounds=20000):
+    node_id = Node.create_random().data
+    ip = krpc.compact_ip_port('10.0.0.2', 6881)
+    nodes = _sample_response()
+    queries = _sample_queries()
+    responses = [_sample_response()]
+
+    results = [
+        ('serve query, bencodepy + serializer', _rate(lambda x: _serve_legacy(x, node_id, ip, nodes), queries, rounds)),
+        ('serve query, codec', _rate(lambda x: _serve_codec(x, node_id, ip, nodes), queries, rounds)),
+        ('decode response, bencodepy', _rate(bencodepy.decode, responses, rounds)),
+        ('decode response, codec', _rate(codec.decode, responses, rounds)),
+    ]
+    for name, rate in results:
+        print('{:<40s}{:>12,.0f} packets/s'.format(name, rate))
+    return results
+
+
+def bench_swarm(size=500, lookups=200, latency=(0.005, 0.03), loss=0.01, concurrency=8, seed=None):
+    async def run():
+        network = SimNetwork(latency=latency, loss=loss, seed=seed)
+        swarm = Swarm(size, network, seed=seed)
+        await swarm.start()
+
+        cpu, sent, start = time.process_time(), network.sent, time.perf_counter()
+        await swarm.bootstrap()
+        bootstrap = dict(
+            elapsed=time.perf_counter() - start,
+            packets_per_node=(network.sent - sent) / size,
+            cpu_per_packet_us=(time.process_time() - cpu) / max(network.sent - sent, 1) * 1e6,
+            convergence=swarm.convergence(),
+        )
+        report = await swarm.run_lookups(lookups, concurrency=concurrency)
+        swarm.stop()
+        return bootstrap, report, network.stats()
+
+    bootstrap, report, network = aio.run(run())
+    for title, results in (('bootstrap', bootstrap), ('lookup', report), ('network', network)):
+        for name, value in results.items():
+            print('{:<40s}{:>12}'.format(title + '.' + name, '{:,.3f}'.format(value) if value is not None else '-'))
+    return bootstrap, report, network
+
+
+def bench_index(samples=1 << 20, distinct=1 << 18, batch=4096):
+    """ `InfohashIndex.add` of crawled samples, a quarter of them new """
+    pool = os.urandom(distinct * 20)
+    rng = np.random.default_rng()
+    picks = rng.integers(0, distinct, samples)
+    with tempfile.TemporaryDirectory() as path:
+        index = InfohashIndex(path)
+        start = time.perf_counter()
+        for i in range(0, samples, batch):
+            index.add(b''.join(pool[x * 20:x * 20 + 20] for x in picks[i:i + batch].tolist()))
+        elapsed = time.perf_counter() - start
+        index.close()
+        start = time.perf_counter()
+        reloaded = len(InfohashIndex(path))
+        results = dict(
+            samples_per_second=samples / elapsed,
+            indexed=len(index),
+            reload_seconds=time.perf_counter() - start,
+            bytes_per_info_hash=sum(getattr(index, x).nbytes for x in ('_keys', '_first', '_last', '_table')) / reloaded,
+        )
+    for name, value in results.items():
+        print('{:<40s}{:>12}'.format('index.' + name, '{:,.3f}'.format(value)))
+    return results
+
+
+def _frame_bytes(data: bytes, chunk: int):
+    """ the concatenate and slice framing `BitTorrentProtocol` would need without a framer """
+    buffer, blocks = b'', 0
+    for i in range(0, len(data), chunk):
+        buffer += data[i:i + chunk]
+        while len(buffer) >= 4:
+            length = struct.unpack('>I', buffer[:4])[0]
+            if len(buffer) < 4 + length:
+                break
+            message, buffer = buffer[4:4 + length], buffer[4 + length:]
+            blocks += len(message[9:])
+    return blocks
+
+
+def _frame_framer(data: bytes, chunk: int):
+    framer, view, blocks = Framer(handshake=False), memoryview(data), 0
+    for i in range(0, len(data), chunk):
+        n = min(chunk, len(data) - i)
+        framer.get_buffer(n)[:n] = view[i:i + n]     # what the socket does in `recv_into`
+        framer.buffer_updated(n)
+        for _, payload in framer.frames():
+            blocks += len(parse_piece(payload)[2])
+    return blocks
+
+
+def bench_framer(blocks=4096, chunk=1 << 16):
+    """ PIECE messages of 16 KiB blocks read in `chunk` bytes, like a busy socket """
+    block = os.urandom(1 << 14)
+    data = b''.join(struct.pack('>IBII', len(block) + 9, 7, i, 0) + block for i in range(blocks))
+    results = []
+    for name, func in (('bytes concatenate and slice', _frame_bytes), ('framer', _frame_framer)):
+        start = time.perf_counter()
+        assert func(data, chunk) == blocks * len(block)
+        elapsed = time.perf_counter() - start
+        results.append((name, len(data) / elapsed / (1 << 20), blocks / elapsed))
+    for name, mbps, rate in results:
+        print('{:<40s}{:>12,.0f} MiB/s{:>12,.0f} blocks/s'.format(name, mbps, rate))
+    return results
+
+
+def bench_picker(pieces=1 << 14, peers=300, depth=16, rounds=2000):
+    """ `Download.pick` of `depth` blocks for random peers of a swarm, each peer having half of the pieces """
+    download = Download(os.urandom(20), 1 << 18, pieces << 18, bytes(pieces * 20))
+    rng = np.random.default_rng()
+    bitfields = rng.random((peers, pieces)) < 0.5
+    download.availability[:] = bitfields.sum(axis=0)
+    # a tenth of the pieces are done and some are in flight
+    download.free[rng.random(pieces) < 0.1] = 0
+    started = rng.random(pieces) < 0.02
+    download.free[started] -= 1
+    download._update_keys()
+    start = time.perf_counter()
+    for i in rng.integers(0, peers, rounds).tolist():
+        download.pick(bitfields[i], depth)
+    elapsed = time.perf_counter() - start
+    results = dict(picks_per_second=rounds / elapsed, microseconds_per_pick=elapsed / rounds * 1e6,
+                   blocks=len(download.block_piece), block_size=BLOCK_SIZE)
+    for name, value in results.items():
+        print('{:<40s}{:>12}'.format('picker.' + name, '{:,.3f}'.format(value)))
+    return results
+
+
+def bench_storage(size=256 << 20, piece_length=1 << 18, threads=(1, 4)):
+    """ `FileStorage.write` of 16 KiB blocks and `FileStorage.rehash` of the written file with 1 and more threads """
+    block = memoryview(os.urandom(BLOCK_SIZE))
+    results = dict()
+    with tempfile.TemporaryDirectory() as path:
+        storage = FileStorage([(os.path.join(path, 'data'), size)], piece_length, threads=max(threads))
+        start = time.perf_counter()
+        for offset in range(0, size, BLOCK_SIZE):
+            storage.write(offset // piece_length, offset % piece_length, block)
+        results['write_mib_per_second'] = size / (time.perf_counter() - start) / (1 << 20)
+        hashes = bytes(storage.pieces * 20)
+        storage.close()
+        for n in threads:
+            storage = FileStorage([(os.path.join(path, 'data'), size)], piece_length, threads=n)
+            start = time.perf_counter()
+            aio.run(storage.rehash(hashes))
+            results['rehash_mib_per_second_%d_threads' % n] = size / (time.perf_counter() - start) / (1 << 20)
+            storage.close()
+    for name, value in results.items():
+        print('{:<40s}{:>12}'.format('storage.' + name, '{:,.0f}'.format(value)))
+    return results
+
+
+BENCHMARKS = {
+    'codec': bench_codec,
+    'swarm': bench_swarm,
+    'index': bench_index,
+    'framer': bench_framer,
+    'picker': bench_picker,
+    'storage': bench_storage,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m common.kademlia.benchmark')
+    parser.add_argument('names', nargs='*', choices=[[]] + list(BENCHMARKS), default=[])
+    parser.add_argument('--size', type=int, default=500, help='swarm: number of nodes')
+    parser.add_argument('--lookups', type=int, default=200, help='swarm: number of lookups')
+    parser.add_argument('--loss', type=float, default=0.01, help='swarm: packet loss rate')
+    parser.add_argument('--latency', type=float, nargs=2, default=(0.005, 0.03), help='swarm: min max seconds')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    options = {
+        'swarm': dict(size=args.size, lookups=args.lookups, loss=args.loss, latency=args.latency, seed=args.seed),
+    }
+    for name in args.names or list(BENCHMARKS):
+        print('[{}]'.format(name))
+        BENCHMARKS[name](**options.get(name, {}))
@@ -7,6 +7,8 @@ import bencodepy
 import threading
 from .node import Node
 from .constants import DEFAULT_BIT_TORRENT_CONFIG
+from .framer import Framer, FrameError, HANDSHAKE, KEEP_ALIVE
+from .metrics import BitTorrentMetrics, monitor_loop_lag
 
 """
 refer: 
@@ -108,18 +110,21 @@ class Message:
         data = data[len(BITTORRENT_PROTOCOL):]
         assert len(data) == 48
 
-        # validate whether the connection match the downloading we want
+        # validate whether the connection match the downloading we want, `peer_id` is our own one
         reserved_bytes, ih, pi = data[:8], data[8:28], data[28:]
-        if (self.info_hash and self.info_hash != ih) or (self.peer_id and self.peer_id != pi):
-            raise ValueError('bittorrent.Message.parse_handshake|info_hash or peer_id not match')
+        if self.info_hash and self.info_hash != ih:
+            raise ValueError('bittorrent.Message.parse_handshake|info_hash not match')
 
         if update_features:
             self.features.merge_with(reserved_bytes)
 
         return reserved_bytes, ih, pi
 
-    def extened_handshake(self):
-        msg_id = 20
+    def extended_handshake(self, m: dict, **fields) -> bytes:
+        """ BEP 10 handshake message, `m` maps extension names to our message ids """
+        body = bencodepy.encode(dict(fields, m=m))
+        return struct.pack('>IBB', len(body) + 2, MessageType.EXTENDED, 0) + body
+
 
 # # since the existence of GIL lock, lock may have no means in python
 # class BitTorrentProtocolStatus:
@@ -135,12 +140,16 @@ class Message:
 #     def handshake(self):
 
 
-class BitTorrentProtocol(aio.Protocol):
+class BitTorrentProtocol(aio.BufferedProtocol):
+    """
+    the transport reads into the receive buffer of `framer`, complete messages are handed to
+    `message_received` as memoryviews of that buffer, valid only during the call
+    """
     info_hash: bytes
     peer_id: bytes
     transport: aio.Transport
     status: int
-    buffer: bytes
+    framer: Framer
     supported_features: BitTorrentSupportedFeatures
 
     STATUS_CONNECTING = 0
@@ -161,6 +170,7 @@ class BitTorrentProtocol(aio.Protocol):
             logger: logging.Logger,
             info_hash: bytes = None,
             supported_features: BitTorrentSupportedFeatures = None,
+            metrics: BitTorrentMetrics = None,
     ):
         #   validate arguments and assign default value
         if info_hash:
@@ -172,50 +182,81 @@ class BitTorrentProtocol(aio.Protocol):
         self.info_hash = info_hash
         self.peer_id = peer_id
         self.logger = logger
+        self.transport = None
         self.status = self.STATUS_CONNECTING
-        self.buffer = b''
+        config = DEFAULT_BIT_TORRENT_CONFIG
+        self.framer = Framer(config.get('recv_buffer', 1 << 17), config.get('max_message_length', 1 << 20))
         self.loop = loop
         self.message = Message(self.peer_id, self.info_hash)
+        self.metrics = metrics if metrics is not None else BitTorrentMetrics()
 
     def connection_made(self, transport: aio.Transport):
         self.transport = transport
+        self.metrics.connection_made(self)
         self.logger.info('BitTorrentProtocol.connection_made|tcp connection has built')
 
     def connection_lost(self, exc: Exception) -> None:
         self.status = self.STATUS_DISCONNECTED
-        pass
+        self.metrics.connection_lost(self)
+
+    def write(self, data: bytes):
+        self.metrics.bytes_out += len(data)
+        self.transport.write(data)
+
+    def get_buffer(self, sizehint: int):
+        return self.framer.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes: int):
+        self.metrics.bytes_in += nbytes
+        self.framer.buffer_updated(nbytes)
+        self.process_frames()
 
     def data_received(self, data: bytes):
-        # parse handshake message
-        if self.status == self.STATUS_CONNECTING:
-            try:
-                _, self.info_hash, _ = self.message.parse_handshake(data)
-            except Exception as e:
-                self.logger.warning(
-                    f'{self.__class__.__name__}.data_received|error while parse handshake message|error=%s',
-                    e,
-                )
-                return self.disconnect()
-            self.transport.write(self.message.handshake(self.info_hash))
-            self.status = self.STATUS_NORMAL
-
-        # parse handshake message
-        elif self.status == self.STATUS_HANDSHAKING:
-            # should never be used in server side
+        """ the copying entry, for callers feeding bytes by hand """
+        self.metrics.bytes_in += len(data)
+        self.framer.feed(data)
+        self.process_frames()
+
+    def process_frames(self):
+        try:
+            for msg_id, payload in self.framer.frames():
+                if self.status == self.STATUS_DISCONNECTED:
+                    return
+                if msg_id == HANDSHAKE:
+                    self.handshake_received(payload)
+                elif msg_id != KEEP_ALIVE:
+                    self.metrics.message_received(msg_id)
+                    self.message_received(msg_id, payload)
+        except FrameError as e:
+            self.logger.warning(f'{self.__class__.__name__}.process_frames|error=%s', e)
+            self.disconnect()
+
+    def handshake_received(self, data: memoryview):
+        try:
+            _, info_hash, _ = self.message.parse_handshake(bytes(data))
+        except (AssertionError, ValueError) as e:
+            self.metrics.handshake_failures += 1
+            self.logger.warning(
+                f'{self.__class__.__name__}.handshake_received|error while parse handshake message|error=%s',
+                e,
+            )
             return self.disconnect()
 
-        # parse normal message
-        elif self.status == self.STATUS_NORMAL:
-            data_length, msg_identifier = struct.unpack('>IB', data[:5])
-            print(data_length, msg_identifier)
+        # the accepting side answers, the connecting side has sent its handshake already
+        if self.status == self.STATUS_CONNECTING:
+            self.info_hash = self.message.info_hash = info_hash
+            self.write(self.message.handshake(info_hash))
+        self.metrics.handshakes += 1
+        self.status = self.STATUS_NORMAL
 
-        elif self.status == self.STATUS_DISCONNECTED:
-            # do nothing
-            return self.disconnect()
+    def message_received(self, msg_id: int, payload: memoryview):
+        """ one complete message, `payload` excludes the length prefix and the id """
+        self.logger.debug(f'{self.__class__.__name__}.message_received|id=%d|length=%d', msg_id, len(payload))
 
     def disconnect(self):
         self.status = self.STATUS_DISCONNECTED
-        self.transport.close()
+        if self.transport is not None:
+            self.transport.close()
 
 
 class BitTorrent:
@@ -262,6 +303,7 @@ class BitTorrent:
         self.info_hash = info_hash
         self.task = None
         self.transport = None
+        self.metrics = BitTorrentMetrics()
 
     def start(self):
         if self.is_running():
@@ -273,8 +315,10 @@ class BitTorrent:
     def stop(self):
         if self.thread is None:
             raise RuntimeError(f'{self.__class__.__name__}.{self.peer_id.data} is not running, can not stop')
-        self.transport.close()
-        self.loop.stop()
+        # servers have no transport of their own
+        if self.transport is not None:
+            self.loop.call_soon_threadsafe(self.transport.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
         print('join')
         self.thread.join()
         print('joined')
@@ -300,7 +344,11 @@ class BitTorrent:
         else:
             self.core = self.loop.run_until_complete(task)
         self.logger.warning(f'[{self.__class__.__name__}.run]started bt {name}! peer_id={self.peer_id.data.hex()}')
+        interval = DEFAULT_BIT_TORRENT_CONFIG.get('loop_lag_interval', 0.5)
+        lag = self.loop.create_task(monitor_loop_lag(self.metrics.loop_lag, interval)) if interval else None
         self.loop.run_forever()
+        if lag is not None:
+            lag.cancel()
         if self.is_client:
             self.close()   # close transport
         self.logger.warning(f'[{self.__class__.__name__}.run]bt {name} has quit! peer_id={self.peer_id.data.hex()}')
@@ -339,6 +387,7 @@ class BitTorrent:
             loop=self.loop,
             logger=self.logger,
             info_hash=self.info_hash,
+            metrics=self.metrics,
         )
         return obj
 
@@ -0,0 +1,314 @@
+import asyncio as aio
+import logging
+import multiprocessing as mp
+import os
+import signal
+import socket
+import struct
+
+import numpy as np
+
+from . import codec
+from .constants import DEFAULT_KRPC_CONFIG
+from .krpc import Krpc, KrpcProtocol, decode_compact_nodes
+from .node import Node, DHT
+from .peer_store import PeerStore
+from .transaction import TransactionManager
+from .udp import BatchDatagramTransport
+
+"""
+    multi process krpc server
+
+    N forked workers bind the same udp port with SO_REUSEPORT, the kernel spreads datagrams over them
+    by the remote address. the transaction id space is sharded, so a response which lands on the
+    wrong worker is forwarded to the worker which sent the query. nodes learned and peers announced
+    on one worker are broadcast to the others, every worker keeps a full routing table and peer store.
+
+    ipc is one unix datagram socket pair per worker, messages are a kind byte followed by the payload:
+
+        R   ip(4) port(2) datagram      a response owned by the receiving worker
+        N   compact node info           nodes new to the sender's routing table
+        A   [info_hash(20) peer(6) seed(1)]     announcements
+
+    stats of every worker are published to a shared int64 matrix, `KrpcCluster.stats` sums them up
+"""
+
+STATS_FIELDS = (
+    'packets', 'forwarded', 'ipc_received', 'ipc_dropped',
+    'nodes', 'peers', 'outstanding', 'responses', 'timeouts', 'drifting',
+    'kernel_dropped', 'send_dropped',
+)
+IPC_CHUNK = 1 << 15
+_FORWARD = struct.Struct('!4sH')
+_ANNOUNCE_SIZE = 27
+
+
+class Channel:
+    """ one unix datagram socket pair per worker, every process can write into every inbox """
+
+    def __init__(self, shards: int):
+        self.pairs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(shards)]
+        for pair in self.pairs:
+            for sock in pair:
+                sock.setblocking(False)
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def inbox(self, shard: int) -> socket.socket:
+        return self.pairs[shard][0]
+
+    def send(self, shard: int, data: bytes) -> bool:
+        """ never blocks, a full inbox drops the message """
+        try:
+            self.pairs[shard][1].send(data)
+        except (BlockingIOError, OSError):
+            return False
+        return True
+
+    def close(self):
+        for pair in self.pairs:
+            for sock in pair:
+                sock.close()
+
+
+class ShardedDHT(DHT):
+    """ routing table which records newly inserted nodes for the other workers """
+
+    def __init__(self, node: Node, k=8, capacity=None):
+        super().__init__(node, k, capacity)
+        self.outbox = []
+        self._applying = False
+
+    def _put(self, key: bytes, index: int, ip: int, port: int):
+        new = key not in self._rows
+        super()._put(key, index, ip, port)
+        if new and port and not self._applying and key in self._rows:
+            self.outbox.append(key + struct.pack('>IH', ip, port))
+
+    def apply(self, data: bytes):
+        """ insert nodes broadcast by another worker without broadcasting them again """
+        self._applying = True
+        try:
+            self.put_compact(decode_compact_nodes(data))
+        finally:
+            self._applying = False
+
+
+class ShardedPeerStore(PeerStore):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbox = []
+        self._applying = False
+
+    def announce(self, info_hash: bytes, peer: bytes, seed=False, now=None):
+        super().announce(info_hash, peer, seed=seed, now=now)
+        if not self._applying and len(peer) == 6:
+            self.outbox.append(info_hash + peer + (b'\x01' if seed else b'\x00'))
+
+    def apply(self, data: bytes):
+        self._applying = True
+        try:
+            for i in range(0, len(data) - _ANNOUNCE_SIZE + 1, _ANNOUNCE_SIZE):
+                self.announce(data[i:i + 20], data[i + 20:i + 26], seed=data[i + 26] == 1)
+        finally:
+            self._applying = False
+
+
+class ShardedKrpcProtocol(KrpcProtocol):
+    dht: ShardedDHT
+    peers: ShardedPeerStore
+    shard = 0
+    channel: Channel = None
+    stats = None    # int64 row of the shared stats matrix
+    flush_interval = 0.1
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.counters = dict.fromkeys(STATS_FIELDS, 0)
+
+    @property
+    def shards(self):
+        return len(self.channel)
+
+    def create_transaction_manager(self, loop) -> TransactionManager:
+        return TransactionManager(loop, shard=self.shard, shards=self.shards)
+
+    def connection_made(self, transport) -> None:
+        super().connection_made(transport)
+        loop = aio.get_running_loop()
+        # every worker restored the same snapshot, nothing to share yet
+        self.dht.outbox.clear()
+        self.peers.outbox.clear()
+        loop.add_reader(self.channel.inbox(self.shard).fileno(), self.ipc_received)
+        self._tasks['share'] = loop.create_task(self.share())
+
+    def connection_lost(self, exc) -> None:
+        aio.get_running_loop().remove_reader(self.channel.inbox(self.shard).fileno())
+        super().connection_lost(exc)
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        self.counters['packets'] += 1
+        super().datagram_received(data, addr)
+
+    def response_received(self, msg: codec.KrpcMessage, addr, data: bytes):
+        owner = self.transactions.owner(msg.t)
+        if owner is None or owner == self.shard:
+            return super().response_received(msg, addr, data)
+        self.counters['forwarded'] += 1
+        self._send(owner, b'R' + _FORWARD.pack(socket.inet_aton(addr[0]), addr[1]) + data)
+
+    def ipc_received(self):
+        inbox = self.channel.inbox(self.shard)
+        while True:
+            try:
+                data = inbox.recv(1 << 17)
+            except BlockingIOError:
+                return
+            self.counters['ipc_received'] += 1
+            kind, payload = data[:1], data[1:]
+            try:
+                if kind == b'R':
+                    ip, port = _FORWARD.unpack_from(payload)
+                    data = payload[_FORWARD.size:]
+                    super().response_received(codec.decode(data), (socket.inet_ntoa(ip), port), data)
+                elif kind == b'N':
+                    self.dht.apply(payload)
+                elif kind == b'A':
+                    self.peers.apply(payload)
+            except Exception as e:
+                self.logger.warning('ShardedKrpcProtocol.ipc_received|error=%s|kind=%s', e, kind)
+
+    async def share(self):
+        """ broadcast local updates and publish stats every `flush_interval` seconds """
+        while True:
+            await aio.sleep(self.flush_interval)
+            for kind, outbox, size in ((b'N', self.dht.outbox, 26), (b'A', self.peers.outbox, _ANNOUNCE_SIZE)):
+                if not outbox:
+                    continue
+                records, outbox[:] = outbox[:], []
+                step = IPC_CHUNK // size
+                for i in range(0, len(records), step):
+                    data = kind + b''.join(records[i:i + step])
+                    for shard in range(self.shards):
+                        if shard != self.shard:
+                            self._send(shard, data)
+            self.publish_stats()
+
+    def publish_stats(self):
+        trans = self.transactions.stats()
+        self.counters.update(
+            nodes=len(self.dht), peers=len(self.peers), outstanding=trans['outstanding'],
+            responses=trans['responses'], timeouts=trans['timeouts'], drifting=trans['drifting'],
+        )
+        if isinstance(self.transport, BatchDatagramTransport):
+            udp = self.transport.stats()
+            self.counters.update(kernel_dropped=udp['kernel_dropped'], send_dropped=udp['send_dropped'])
+        if self.stats is not None:
+            self.stats[:] = [self.counters[x] for x in STATS_FIELDS]
+
+    def _send(self, shard, data):
+        if not self.channel.send(shard, data):
+            self.counters['ipc_dropped'] += 1
+
+
+class ShardWorker(Krpc):
+    protocol_class = ShardedKrpcProtocol
+    dht_class = ShardedDHT
+    peer_store_class = ShardedPeerStore
+
+    def __init__(self, shard: int, channel: Channel, stats: np.ndarray, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shard = shard
+        self.channel = channel
+        self.stats = stats
+        # only the first worker revalidates and checkpoints the shared state
+        if shard != 0:
+            self.snapshot_path = None
+            self.restored = []
+
+    def get_protocol(self) -> ShardedKrpcProtocol:
+        obj = super().get_protocol()
+        obj.shard, obj.channel, obj.stats = self.shard, self.channel, self.stats
+        return obj
+
+
+class KrpcCluster:
+    """
+    Examples:
+    >>> cluster = KrpcCluster(workers=4)
+    >>> cluster.start()
+    >>> cluster.stats()['packets']
+    >>> cluster.stop()
+    """
+
+    def __init__(self, workers=None, root=None, address=None, logger=None, **kwargs):
+        if not address:
+            address = DEFAULT_KRPC_CONFIG['address']
+        if not logger:
+            logger = logging.getLogger(DEFAULT_KRPC_CONFIG['logger'])
+
+        self.workers = workers or os.cpu_count()
+        self.root = root
+        self.address = address
+        self.logger = logger
+        self.kwargs = kwargs
+        self.processes = []
+        self.channel = None
+        self._stats = None
+
+    def start(self):
+        if self.is_running():
+            raise RuntimeError('KrpcCluster is running, do not start again')
+        # every worker must answer with the same node id
+        if not self.root:
+            snapshot_path = self.kwargs.get('snapshot_path', DEFAULT_KRPC_CONFIG.get('snapshot'))
+            snap = Krpc.load_snapshot(snapshot_path, self.logger) if snapshot_path else None
+            self.root = DEFAULT_KRPC_CONFIG['root_node'] or (Node(snap.root) if snap else Node.create_random())
+
+        ctx = mp.get_context('fork')
+        self.channel = Channel(self.workers)
+        self._stats = ctx.RawArray('q', self.workers * len(STATS_FIELDS))
+        self.processes = [
+            ctx.Process(target=self._run_worker, args=(i,), name='krpc-worker-%d' % i, daemon=True)
+            for i in range(self.workers)
+        ]
+        for p in self.processes:
+            p.start()
+        self.logger.warning('KrpcCluster.start|workers=%d|address=%s|root=%s',
+                            self.workers, self.address, self.root.base16)
+
+    def stop(self, timeout=5):
+        if not self.processes:
+            raise RuntimeError('KrpcCluster is not running, can not stop')
+        for p in self.processes:
+            p.terminate()
+        for p in self.processes:
+            p.join(timeout)
+        self.processes = []
+        self.channel.close()
+
+    def is_running(self):
+        return any(p.is_alive() for p in self.processes)
+
+    def stats(self) -> dict:
+        """ sum of every worker's counters, per worker counters are listed in `workers` """
+        rows = self._matrix()
+        ret = dict(zip(STATS_FIELDS, rows.sum(axis=0).tolist()))
+        # every worker holds the full replicated tables
+        for name in ('nodes', 'peers'):
+            ret[name] = int(rows[:, STATS_FIELDS.index(name)].max())
+        ret['workers'] = [dict(zip(STATS_FIELDS, x)) for x in rows.tolist()]
+        return ret
+
+    def _matrix(self) -> np.ndarray:
+        return np.frombuffer(self._stats, dtype=np.int64).reshape(self.workers, len(STATS_FIELDS))
+
+    def _run_worker(self, shard: int):
+        k = ShardWorker(
+            shard, self.channel, self._matrix()[shard],
+            root=self.root, address=self.address, logger=self.logger, **self.kwargs,
+        )
+        k.loop.add_signal_handler(signal.SIGTERM, k.loop.stop)
+        k.run()
+        k.sock.close()
@@ -0,0 +1,298 @@
+"""
+    krpc specialised bencode codec
+
+    inbound packets are decoded straight into a flat `KrpcMessage`, the `a` / `r` dictionaries
+    are never materialized, and the fixed response shapes are encoded from precompiled templates
+
+    refer:
+     BEP 5 DHT Protocol - http://bittorrent.org/beps/bep_0005.html
+     BEP 51 DHT Infohash Indexing - http://bittorrent.org/beps/bep_0051.html
+"""
+
+
+class DecodeError(ValueError):
+    pass
+
+
+# keys of the `a` / `r` dictionaries which are kept as slots of `KrpcMessage`
+ARGUMENT_KEYS = {
+    b'id': 'id',
+    b'target': 'target',
+    b'info_hash': 'info_hash',
+    b'token': 'token',
+    b'nodes': 'nodes',
+    b'values': 'values',
+    b'port': 'port',
+    b'implied_port': 'implied_port',
+    b'scrape': 'scrape',
+    b'seed': 'seed',
+    b'samples': 'samples',
+    b'num': 'num',
+    b'interval': 'interval',
+}
+
+# strings kept as memoryviews over the received datagram
+_VIEW_KEYS = frozenset(('nodes', 'samples'))
+
+
+class KrpcMessage:
+    """
+    one decoded krpc packet, fields of the `a` (query) or `r` (response) dictionary are flattened
+    into the same object, `nodes` and `samples` are memoryviews over the received datagram
+    """
+    __slots__ = (
+        't', 'y', 'q', 'v', 'ip', 'e',
+        'id', 'target', 'info_hash', 'token', 'nodes', 'values', 'port', 'implied_port', 'scrape', 'seed',
+        'samples', 'num', 'interval',
+        'extra',
+    )
+
+    def __init__(self):
+        self.t = self.y = self.q = self.v = self.ip = self.e = None
+        self.id = self.target = self.info_hash = self.token = self.nodes = self.values = None
+        self.port = self.implied_port = self.scrape = self.seed = None
+        self.samples = self.num = self.interval = None
+        self.extra = None
+
+    def __repr__(self):
+        fields = ['{}={}'.format(k, _short(getattr(self, k))) for k in self.__slots__ if getattr(self, k) is not None]
+        return 'KrpcMessage({})'.format(', '.join(fields))
+
+    @property
+    def transaction_id(self) -> bytes:
+        return self.t
+
+    @property
+    def query(self) -> str:
+        # the name is chosen by the remote, it is read before the query is validated
+        return self.q.decode('ascii', 'replace') if self.q is not None else ''
+
+    def is_query(self):
+        return self.y == b'q'
+
+    def is_response(self):
+        return self.y == b'r' or self.y == b'e'
+
+    def validate(self):
+        """ same constraints as `krpc.Request.validate` for inbound queries """
+        # any bencode value may stand for any key, check the types before the lengths
+        for name in ('id', 'target', 'info_hash', 'token'):
+            val = getattr(self, name)
+            if val is not None and not isinstance(val, bytes):
+                raise DecodeError('KrpcMessage validate error: {} should be bytes'.format(name))
+        if self.implied_port is not None and not isinstance(self.implied_port, int):
+            raise DecodeError('KrpcMessage validate error: implied_port should be an integer')
+        if self.id is None or len(self.id) != 20:
+            raise DecodeError('KrpcMessage validate error: id should be a 20 lengths bytes')
+        if self.q in (b'find_node', b'sample_infohashes') and (self.target is None or len(self.target) != 20):
+            raise DecodeError('KrpcMessage validate error: target should be a 20 lengths bytes')
+        if self.q in (b'get_peers', b'announce_peer') and (self.info_hash is None or len(self.info_hash) != 20):
+            raise DecodeError('KrpcMessage validate error: info_hash should be a 20 lengths bytes')
+        if self.q == b'announce_peer' and (self.token is None or self.port is None):
+            raise DecodeError('KrpcMessage validate error: announce_peer requires token and port')
+        # the port is packed into the peer store by the handler, which runs inside the datagram callback
+        if self.q == b'announce_peer' and not (isinstance(self.port, int) and 0 < self.port < 65536):
+            raise DecodeError('KrpcMessage validate error: port should be an integer in 1-65535')
+        return self
+
+    # accessors shared with `krpc.Request`
+
+    def get_querying_id(self) -> bytes:
+        return self.id
+
+    def get_target(self) -> bytes:
+        return self.target
+
+    def get_info_hash(self) -> bytes:
+        return self.info_hash
+
+    def get_token(self) -> bytes:
+        return self.token
+
+    def get_port(self) -> int:
+        return self.port
+
+    def get_implied_port(self) -> bool:
+        return self.implied_port if self.implied_port is not None else 1
+
+    def to_dict(self) -> dict:
+        """ the bencodepy shaped dict, only used by the client side serializers """
+        inner = dict()
+        for key, name in ARGUMENT_KEYS.items():
+            val = getattr(self, name)
+            if val is not None:
+                inner[key] = bytes(val) if isinstance(val, memoryview) else val
+        if self.extra:
+            inner.update(self.extra)
+
+        ret = {b't': self.t, b'y': self.y}
+        if self.y == b'q':
+            ret[b'q'] = self.q
+            ret[b'a'] = inner
+        elif self.y == b'r':
+            ret[b'r'] = inner
+        elif self.y == b'e':
+            ret[b'e'] = self.e
+        for key in ('v', 'ip'):
+            val = getattr(self, key)
+            if val is not None:
+                ret[key.encode('ascii')] = val
+        return ret
+
+
+def _short(val):
+    if isinstance(val, memoryview):
+        return '<{} bytes>'.format(len(val))
+    if isinstance(val, bytes) and len(val) == 20:
+        return val.hex()
+    return repr(val)
+
+
+# ----------------------------------- decode -----------------------------------
+
+def _decode_string(data: bytes, i: int):
+    j = data.index(b':', i)
+    end = j + 1 + int(data[i:j])
+    if end > len(data) or end <= j:
+        raise DecodeError('string out of range')
+    return data[j + 1:end], end
+
+
+def _decode_int(data: bytes, i: int):
+    j = data.index(b'e', i)
+    return int(data[i + 1:j]), j + 1
+
+
+def _decode(data: bytes, i: int):
+    """ generic bencode value, used for the rarely present or unknown keys """
+    c = data[i]
+    if c == 0x69:   # i
+        return _decode_int(data, i)
+    if c == 0x6c:   # l
+        ret, i = [], i + 1
+        while data[i] != 0x65:
+            val, i = _decode(data, i)
+            ret.append(val)
+        return ret, i + 1
+    if c == 0x64:   # d
+        ret, i = dict(), i + 1
+        while data[i] != 0x65:
+            key, i = _decode_string(data, i)
+            ret[key], i = _decode(data, i)
+        return ret, i + 1
+    return _decode_string(data, i)
+
+
+def decode_value(data: bytes, i: int = 0):
+    """ (value, end) of one bencode value starting at `i`, bytes may follow it, like ut_metadata pieces """
+    try:
+        return _decode(data, i)
+    except (ValueError, IndexError) as e:
+        raise DecodeError('malformed bencode: {}'.format(e))
+
+
+def _decode_arguments(msg: KrpcMessage, data: bytes, view: memoryview, i: int):
+    if data[i] != 0x64:
+        raise DecodeError('a/r is not a dict')
+    i += 1
+    while data[i] != 0x65:
+        key, i = _decode_string(data, i)
+        name = ARGUMENT_KEYS.get(key)
+        c = data[i]
+        if name is None:
+            val, i = _decode(data, i)
+            if msg.extra is None:
+                msg.extra = dict()
+            msg.extra[key] = val
+        elif c == 0x69:
+            val, i = _decode_int(data, i)
+            setattr(msg, name, val)
+        elif c == 0x6c:
+            val, i = _decode(data, i)
+            setattr(msg, name, val)
+        elif name in _VIEW_KEYS:
+            j = data.index(b':', i)
+            end = j + 1 + int(data[i:j])
+            if end > len(data) or end <= j:
+                raise DecodeError('string out of range')
+            setattr(msg, name, view[j + 1:end])
+            i = end
+        else:
+            val, i = _decode_string(data, i)
+            setattr(msg, name, val)
+    return i + 1
+
+
+def decode(data: bytes) -> KrpcMessage:
+    """ decode one krpc datagram, raise `DecodeError` for anything which is not a krpc message """
+    msg = KrpcMessage()
+    view = memoryview(data)
+    try:
+        if data[0] != 0x64:
+            raise DecodeError('krpc message is not a dict')
+        i = 1
+        while data[i] != 0x65:
+            key, i = _decode_string(data, i)
+            if key == b'a' or key == b'r':
+                i = _decode_arguments(msg, data, view, i)
+            elif key == b'e':
+                msg.e, i = _decode(data, i)
+            elif key in (b't', b'y', b'q', b'v', b'ip'):
+                val, i = _decode_string(data, i)
+                setattr(msg, key.decode('ascii'), val)
+            else:
+                _, i = _decode(data, i)
+    except DecodeError:
+        raise
+    except (ValueError, IndexError) as e:
+        raise DecodeError('malformed bencode: {}'.format(e))
+
+    if msg.t is None or msg.y is None:
+        raise DecodeError('krpc message without t or y')
+    return msg
+
+
+# ----------------------------------- encode -----------------------------------
+# keys of bencode dictionaries are sorted, `ip` < `r` < `t` < `y`
+
+_PING_RESPONSE = b'd2:ip6:%b1:rd2:id20:%be1:t%d:%b1:y1:re'
+_NODES_RESPONSE = b'd2:ip6:%b1:rd2:id20:%b5:nodes%d:%be1:t%d:%b1:y1:re'
+_PEERS_NODES_RESPONSE = b'd2:ip6:%b1:rd%b2:id20:%b5:nodes%d:%b5:token%d:%be1:t%d:%b1:y1:re'
+_PEERS_VALUES_RESPONSE = b'd2:ip6:%b1:rd%b2:id20:%b5:token%d:%b6:valuesl%bee1:t%d:%b1:y1:re'
+_BLOOM = b'4:BFpe256:%b4:BFsd256:%b'     # BEP 33, upper case keys sort before `id`
+_SAMPLES_RESPONSE = b'd2:ip6:%b1:rd2:id20:%b8:intervali%de5:nodes%d:%b3:numi%de7:samples%d:%be1:t%d:%b1:y1:re'
+_ERROR_RESPONSE = b'd1:eli%de%d:%be1:t%d:%b1:y1:ee'
+
+
+def encode_ping_response(t: bytes, node_id: bytes, ip: bytes) -> bytes:
+    return _PING_RESPONSE % (ip, node_id, len(t), t)
+
+
+def encode_find_node_response(t: bytes, node_id: bytes, ip: bytes, nodes: bytes) -> bytes:
+    return _NODES_RESPONSE % (ip, node_id, len(nodes), nodes, len(t), t)
+
+
+def encode_get_peers_response(t: bytes, node_id: bytes, ip: bytes, token: bytes,
+                              nodes: bytes = None, values: list[bytes] = None,
+                              bloom: tuple[bytes, bytes] = None) -> bytes:
+    """ `bloom` is the BEP 33 (BFsd, BFpe) pair of a scrape request """
+    scrape = _BLOOM % (bloom[1], bloom[0]) if bloom else b''
+    if values:
+        values = b''.join(b'6:' + x for x in values)
+        return _PEERS_VALUES_RESPONSE % (ip, scrape, node_id, len(token), token, values, len(t), t)
+    nodes = nodes or b''
+    return _PEERS_NODES_RESPONSE % (ip, scrape, node_id, len(nodes), nodes, len(token), token, len(t), t)
+
+
+def encode_announce_peer_response(t: bytes, node_id: bytes, ip: bytes) -> bytes:
+    return _PING_RESPONSE % (ip, node_id, len(t), t)
+
+
+def encode_sample_infohashes_response(t: bytes, node_id: bytes, ip: bytes, interval: int, num: int,
+                                      samples: bytes, nodes: bytes) -> bytes:
+    """ BEP 51, `samples` is a concatenation of 20 bytes info hashes """
+    return _SAMPLES_RESPONSE % (ip, node_id, interval, len(nodes), nodes, num, len(samples), samples, len(t), t)
+
+
+def encode_error(t: bytes, code: int, message: bytes) -> bytes:
+    return _ERROR_RESPONSE % (code, len(message), message, len(t), t)
@@ -1,5 +1,4 @@
 import os
-import socket
 import numpy as np
 
 """
@@ -41,10 +40,17 @@ dht_bootstrap_address = [
     # ('u4.trakx.crim.ist', '1337'),
 ]
 
-# get real ip address
-for i, ele in enumerate(dht_bootstrap_address):
-    ip, port = socket.getaddrinfo(*ele)[0][-1]
-    dht_bootstrap_address[i] = (ip, port)
+# static ip addresses of well known routers, used while the host names above can not be resolved.
+# host names are resolved lazily inside the krpc loop, see `resolver.BootstrapResolver`
+dht_bootstrap_fallback = [
+    ('67.215.246.10', 6881),        # router.bittorrent.com
+    ('82.221.103.244', 6881),       # router.utorrent.com
+    ('87.98.162.88', 6881),         # dht.transmissionbt.com
+    ('185.157.221.247', 25401),     # dht.libtorrent.org
+]
+
+# seconds a resolved bootstrap address is trusted
+BOOTSTRAP_RESOLVE_TTL = 3600
 
 # # 21/04/04
 # bootstrap_nodes_filename = os.path.join(os.path.dirname(__file__), 'bootstrap_nodes.csv')
@@ -72,11 +78,72 @@ DEFAULT_KRPC_CONFIG = {
     'address': ('0.0.0.0', 6881),
     'root_node': None,
     'logger': 'krpc',
+    # routing table snapshot for warm restarts, empty to disable
+    'snapshot': os.path.join(os.path.dirname(__file__), 'krpc.snapshot'),
+    'checkpoint_interval': 300,
+    # udp socket, the kernel caps buffer sizes at net.core.rmem_max / wmem_max
+    'rcvbuf': 1 << 21,
+    'sndbuf': 1 << 20,
+    # drain many datagrams per readiness event, see `udp.BatchDatagramTransport`
+    'batch_reader': True,
+    'recv_batch': 64,
+    'send_queue': 4096,
+    'send_rate': 0,     # packets per second, 0 means unlimited
+    # inbound queries per source ip, see `limiter.RateLimiter`
+    'query_rate': 20,
+    'query_burst': 40,
+    # pings per second sent to verify requesters before they enter the routing table
+    'verify_rate': 50,
+    # seconds a verified or failed requester is not pinged again
+    'verify_ttl': 600,
+    # access log sample rates by packet kind, merged into `access_log.DEFAULT_SAMPLE_RATES`
+    'access_log_sample': {},
+    # write krpc log records from a background thread
+    'background_logging': True,
+    # liveness, nodes queued by full buckets are pinged in batches, idle buckets are refreshed by a lookup
+    'ping_interval': 1,
+    'ping_batch': 32,
+    'refresh_interval': 900,
+    # BEP 51, info hashes per sample_infohashes response and seconds the same sample is served
+    'sample_count': 20,
+    'sample_interval': 300,
+    # `crawler.Crawler`, concurrent sample_infohashes queries, queries per second and segment file size
+    'crawl_concurrency': 32,
+    'crawl_rate': 200,
+    'crawl_segment_size': 64 << 20,
+    # unix socket of the daemon owning the krpc and bittorrent servers, see `daemon.Daemon`
+    'daemon_socket': os.path.join(os.path.dirname(__file__), 'krpc.sock'),
+    # `Krpc.call` from other threads, concurrent calls and the default deadline in seconds
+    'max_callers': 64,
+    'call_deadline': 10,
+    # seconds between event loop lag probes exported by `metrics.KrpcCollector`, 0 to disable
+    'loop_lag_interval': 0.5,
 }
 
 DEFAULT_BIT_TORRENT_CONFIG = {
     'address': ('0.0.0.0', 6882),
     'root_node': None,
     'logger': 'bt',
+    'loop_lag_interval': 0.5,
+    # peer wire receive buffer, it grows for longer messages up to `max_message_length`, see `framer.Framer`
+    'recv_buffer': 1 << 17,
+    'max_message_length': 1 << 20,
+    # `metadata.MetadataFetcher`, connections of every torrent, connected peers per torrent and timeouts
+    'metadata_connections': 256,
+    'metadata_peers_per_torrent': 8,
+    'metadata_connect_timeout': 5,
+    'metadata_piece_timeout': 10,
+    'max_metadata_size': 8 << 20,
+    # `session.Session`, connections of every torrent, connections per torrent, timeouts in seconds
+    'session_connections': 500,
+    'session_peers_per_torrent': 50,
+    'session_handshake_timeout': 10,
+    'session_idle_timeout': 180,
+    'session_keep_alive_interval': 90,
+    # `download.Download`, block requests in flight per peer, seconds a peer may deliver nothing
+    'download_queue_depth': 16,
+    'download_request_timeout': 30,
+    # `storage.FileStorage`, threads hashing pieces and flushing maps
+    'storage_threads': 4,
 }
 
@@ -0,0 +1,384 @@
+import asyncio as aio
+import os
+import random
+import time
+
+import numpy as np
+
+from .constants import DEFAULT_KRPC_CONFIG
+from .krpc import KrpcProtocol, ErrorResponse, COMPACT_NODE_DTYPE, decode_compact_nodes, unpack_ip_port
+from .node import Node
+
+"""
+    BEP 51 infohash crawler
+
+    `Crawler` walks the id space with sample_infohashes queries. every query targets the next step of
+    a golden ratio sweep, consecutive targets are far apart and any stretch of steps covers the id
+    space evenly. nodes of the responses feed a fixed size frontier and the routing table
+    seeds it again whenever it runs dry. a node is not sampled again before the `interval` it announced
+
+    samples are collected as raw bytes and handed to `InfohashIndex` in batches, which keeps every
+    info hash in numpy arrays behind an open addressing hash table, no python object per info hash,
+    and appends (info_hash, first seen, last seen) records to segment files. a record is written for a
+    new info hash and again when it is seen `touch_interval` seconds after its last record, replaying
+    the segments keeps the earliest first seen and the latest last seen
+
+    Examples:
+    >>> index = InfohashIndex('/data/infohash')
+    >>> crawler = Crawler(krpc.get_default().core, index)
+    >>> await crawler.run(duration=600)
+    >>> index.get(info_hash)
+    (1700000000, 1700003600)
+
+    refer:
+     BEP 51 DHT Infohash Indexing - http://bittorrent.org/beps/bep_0051.html
+"""
+
+# a 20 bytes info hash split into integers, `a` is uniformly distributed and hashes the table
+KEY_DTYPE = np.dtype([('a', '<u8'), ('b', '<u8'), ('c', '<u4')])
+# one record of a segment file, times are unix seconds
+RECORD_DTYPE = np.dtype([('key', KEY_DTYPE), ('first', '<u4'), ('last', '<u4')])
+
+SEGMENT_SUFFIX = '.seg'
+
+ID_SPACE = 1 << 160
+GOLDEN_STEP = int(ID_SPACE * 0.6180339887498949) | 1
+
+
+class InfohashIndex:
+    """
+    append only segment files with an in memory hash index, not thread safe
+
+    Examples:
+    >>> index = InfohashIndex('/data/infohash')
+    >>> index.add(samples)      # concatenated 20 bytes info hashes
+    3
+    >>> info_hash in index
+    True
+    """
+
+    def __init__(self, path: str, segment_size=64 << 20, touch_interval=3600, capacity=1 << 16):
+        self.path = path
+        self.segment_size = segment_size
+        self.touch_interval = touch_interval
+
+        self._keys = np.zeros(capacity, dtype=KEY_DTYPE)
+        self._first = np.zeros(capacity, dtype=np.uint32)
+        self._last = np.zeros(capacity, dtype=np.uint32)
+        self._size = 0
+        self._table = np.full(capacity * 2, -1, dtype=np.int64)     # slot -> row, -1 means empty
+
+        self._fp = None
+        self._segment = 0       # number of the segment being appended
+        self._written = 0       # bytes of the segment being appended
+        self.records = 0        # records appended since opened
+
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, info_hash: bytes):
+        return self._find(np.frombuffer(info_hash, dtype=KEY_DTYPE))[0] >= 0
+
+    def get(self, info_hash: bytes) -> tuple[int, int] | None:
+        """ (first seen, last seen) unix seconds """
+        row = self._find(np.frombuffer(info_hash, dtype=KEY_DTYPE))[0]
+        if row < 0:
+            return None
+        return int(self._first[row]), int(self._last[row])
+
+    def to_array(self) -> np.ndarray:
+        """ RECORD_DTYPE copy of every info hash """
+        ret = np.empty(self._size, dtype=RECORD_DTYPE)
+        ret['key'], ret['first'], ret['last'] = self._keys[:self._size], self._first[:self._size], self._last[:self._size]
+        return ret
+
+    def add(self, samples, now=None) -> int:
+        """ merge concatenated 20 bytes info hashes seen at `now`, return how many are new """
+        keys = np.frombuffer(samples, dtype=KEY_DTYPE) if not isinstance(samples, np.ndarray) else samples
+        if not len(keys):
+            return 0
+        now = int(time.time() if now is None else now)
+        keys = np.unique(keys)
+        rows, new = self._insert(keys)
+
+        # only new or long unseen info hashes are written
+        touched = new | (now - self._last[rows].astype(np.int64) >= self.touch_interval)
+        rows = rows[touched]
+        self._first[rows] = np.minimum(self._first[rows], now)
+        self._last[rows] = np.maximum(self._last[rows], now)
+        if len(rows):
+            records = np.empty(len(rows), dtype=RECORD_DTYPE)
+            records['key'], records['first'], records['last'] = keys[touched], self._first[rows], self._last[rows]
+            self._append(records)
+        return int(new.sum())
+
+    def flush(self):
+        if self._fp is not None:
+            self._fp.flush()
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    # segment files
+
+    def _segments(self) -> list[str]:
+        names = [x for x in os.listdir(self.path) if x.endswith(SEGMENT_SUFFIX)]
+        return sorted(names, key=lambda x: int(x[:-len(SEGMENT_SUFFIX)]))
+
+    def _load(self, chunk=1 << 20):
+        names = self._segments()
+        for name in names:
+            filename = os.path.join(self.path, name)
+            size = os.path.getsize(filename)
+            # a record cut by a crash is dropped
+            if size % RECORD_DTYPE.itemsize:
+                size -= size % RECORD_DTYPE.itemsize
+                os.truncate(filename, size)
+            records = np.fromfile(filename, dtype=RECORD_DTYPE)
+            for i in range(0, len(records), chunk):
+                part = records[i:i + chunk]
+                keys, inverse = np.unique(part['key'], return_inverse=True)
+                rows = self._insert(keys)[0][inverse]
+                np.minimum.at(self._first, rows, part['first'])
+                np.maximum.at(self._last, rows, part['last'])
+        if names:
+            self._segment = int(names[-1][:-len(SEGMENT_SUFFIX)])
+            self._written = os.path.getsize(os.path.join(self.path, names[-1]))
+
+    def _append(self, records: np.ndarray):
+        if self._fp is None or self._written >= self.segment_size:
+            self.close()
+            if self._written >= self.segment_size:
+                self._segment, self._written = self._segment + 1, 0
+            self._fp = open(os.path.join(self.path, '%08d%s' % (self._segment, SEGMENT_SUFFIX)), 'ab')
+        data = records.tobytes()
+        self._fp.write(data)
+        self._written += len(data)
+        self.records += len(records)
+
+    # hash table, linear probing, every step is vectorized over the pending keys
+
+    def _find(self, keys: np.ndarray) -> np.ndarray:
+        """ rows of `keys`, -1 for missing ones """
+        mask = len(self._table) - 1
+        pos = (keys['a'] & np.uint64(mask)).astype(np.int64)
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        pending = np.arange(len(keys))
+        while len(pending):
+            cur = self._table[pos[pending]]
+            hit = cur >= 0
+            same = np.zeros(len(pending), dtype=bool)
+            same[hit] = self._keys[cur[hit]] == keys[pending[hit]]
+            rows[pending[same]] = cur[same]
+            pending = pending[hit & ~same]
+            pos[pending] = (pos[pending] + 1) & mask
+        return rows
+
+    def _insert(self, keys: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """ rows of distinct `keys` and which ones are new, new rows start with an empty time range """
+        rows = self._find(keys)
+        new = rows < 0
+        count = int(new.sum())
+        if count:
+            self._reserve(count)
+            ids = np.arange(self._size, self._size + count)
+            self._keys[ids] = keys[new]
+            self._first[ids] = np.iinfo(np.uint32).max
+            self._last[ids] = 0
+            self._size += count
+            self._place(ids)
+            rows[new] = ids
+        return rows, new
+
+    def _place(self, ids: np.ndarray):
+        """ put rows which are not in the table yet into free slots """
+        mask = len(self._table) - 1
+        pos = (self._keys['a'][ids] & np.uint64(mask)).astype(np.int64)
+        pending = np.arange(len(ids))
+        while len(pending):
+            slot = pos[pending]
+            free = np.flatnonzero(self._table[slot] < 0)
+            # keys racing for the same free slot, the first one wins and the others probe on
+            _, first = np.unique(slot[free], return_index=True)
+            winners = free[first]
+            self._table[slot[winners]] = ids[pending[winners]]
+            placed = np.zeros(len(pending), dtype=bool)
+            placed[winners] = True
+            pending = pending[~placed]
+            pos[pending] = (pos[pending] + 1) & mask
+
+    def _reserve(self, count: int):
+        size = self._size + count
+        if size > len(self._keys):
+            capacity = max(len(self._keys) * 2, size)
+            for name in ('_keys', '_first', '_last'):
+                old = getattr(self, name)
+                ar = np.zeros(capacity, dtype=old.dtype)
+                ar[:self._size] = old[:self._size]
+                setattr(self, name, ar)
+        # load factor stays below 1 / 2
+        if size * 2 > len(self._table):
+            capacity = len(self._table)
+            while size * 2 > capacity:
+                capacity *= 2
+            self._table = np.full(capacity, -1, dtype=np.int64)
+            self._place(np.arange(self._size))
+
+
+class Crawler:
+    """
+    runs on the loop of `protocol`, every counter of `stats` is cumulative
+
+    Examples:
+    >>> crawler = Crawler(protocol, InfohashIndex('/data/infohash'), concurrency=64, rate=500)
+    >>> task = loop.create_task(crawler.run())
+    """
+
+    def __init__(self, protocol: KrpcProtocol, index: InfohashIndex, concurrency=None, rate=None, timeout=1,
+                 frontier=1 << 16, flush_interval=1, dead_interval=3600, logger=None):
+        config = DEFAULT_KRPC_CONFIG
+        self.protocol = protocol
+        self.index = index
+        self.concurrency = concurrency or config.get('crawl_concurrency', 32)
+        self.rate = rate or config.get('crawl_rate', 200)
+        self.timeout = timeout
+        self.flush_interval = flush_interval
+        self.dead_interval = dead_interval      # seconds a silent node is not sampled again
+        self.logger = logger or protocol.logger
+
+        # sweep of the id space, one step per query
+        self._cursor = random.getrandbits(160)
+
+        # ring buffer of compact nodes to sample
+        self._frontier = np.zeros(frontier, dtype=COMPACT_NODE_DTYPE)
+        self._head = self._tail = 0
+        self._cooldown = dict()     # ip << 16 | port -> monotonic time the node may be sampled again
+        self._buffer = bytearray()  # samples not merged into the index yet
+        self._next_send = 0.0
+
+        # counters
+        self.queries = 0
+        self.responses = 0
+        self.timeouts = 0
+        self.samples = 0
+        self.new = 0
+
+    def stats(self) -> dict:
+        return dict(
+            queries=self.queries, responses=self.responses, timeouts=self.timeouts, samples=self.samples,
+            new=self.new, indexed=len(self.index), frontier=self._tail - self._head, cooldown=len(self._cooldown),
+        )
+
+    async def run(self, duration=None):
+        """ crawl until cancelled or for `duration` seconds """
+        loop = aio.get_running_loop()
+        tasks = [loop.create_task(self._worker()) for _ in range(self.concurrency)]
+        tasks.append(loop.create_task(self._flush_forever()))
+        try:
+            if duration is None:
+                await aio.gather(*tasks)
+            else:
+                await aio.sleep(duration)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await aio.gather(*tasks, return_exceptions=True)
+            self.flush()
+            self.logger.info('Crawler.run|stopped|%s', self.stats())
+
+    def flush(self):
+        if self._buffer:
+            self.new += self.index.add(bytes(self._buffer))
+            self._buffer.clear()
+        self.index.flush()
+
+    async def _flush_forever(self, max_cooldown=1 << 20):
+        while True:
+            await aio.sleep(self.flush_interval)
+            self.flush()
+            if len(self._cooldown) > max_cooldown:
+                now = time.monotonic()
+                self._cooldown = {k: v for k, v in self._cooldown.items() if v > now}
+
+    async def _worker(self):
+        while True:
+            node = self._pop()
+            if node is None:
+                self._seed()
+                node = self._pop()
+            if node is None:
+                await aio.sleep(self.flush_interval)
+                continue
+            await self._pace()
+            try:
+                await self._sample(*node)
+            except Exception as e:
+                self.logger.debug('Crawler._worker|error=%s|addr=%s', e, node[1])
+
+    async def _pace(self):
+        loop = aio.get_running_loop()
+        now = loop.time()
+        at = max(self._next_send, now)
+        self._next_send = at + 1 / self.rate
+        if at > now:
+            await aio.sleep(at - now)
+
+    async def _sample(self, key: int, addr: tuple[str, int]):
+        target = self._next_target()
+        self.queries += 1
+        try:
+            resp = await self.protocol.sample_infohashes(target, addr, retry=1, timeout=self.timeout)
+        except aio.TimeoutError:
+            self.timeouts += 1
+            self._cooldown[key] = time.monotonic() + self.dead_interval
+            return
+        # nodes without BEP 51 answer with an error
+        if isinstance(resp, ErrorResponse):
+            self._cooldown[key] = time.monotonic() + self.dead_interval
+            return
+
+        self.responses += 1
+        samples = resp.get_samples()
+        self._buffer += samples
+        self.samples += len(samples) // 20
+        self._cooldown[key] = time.monotonic() + max(resp.get_interval(), 60)
+        nodes = resp.get_compact_nodes()
+        self._push(nodes)
+        self.protocol.dht.put_compact(nodes)
+
+    def _seed(self):
+        """ nodes of the routing table around the next step of the sweep """
+        target = Node(self._next_target())
+        self._push(decode_compact_nodes(self.protocol.dht.get_compact_neighbors(target, self.protocol.dht.k)))
+
+    def _next_target(self) -> bytes:
+        self._cursor = (self._cursor + GOLDEN_STEP) % ID_SPACE
+        return self._cursor.to_bytes(20, 'big')
+
+    def _push(self, nodes: np.ndarray):
+        capacity = len(self._frontier)
+        count = min(len(nodes), capacity - (self._tail - self._head))
+        if count <= 0:
+            return
+        self._frontier[(self._tail + np.arange(count)) % capacity] = nodes[:count]
+        self._tail += count
+
+    def _pop(self) -> tuple[int, tuple[str, int]] | None:
+        now = time.monotonic()
+        capacity = len(self._frontier)
+        while self._head < self._tail:
+            row = self._frontier[self._head % capacity]
+            self._head += 1
+            ip, port = int(row['ip']), int(row['port'])
+            key = ip << 16 | port
+            if not port or self._cooldown.get(key, 0) > now:
+                continue
+            # queried, another worker must not pick it before the answer
+            self._cooldown[key] = now + self.timeout * 4
+            return key, unpack_ip_port(ip, port)
+        return None
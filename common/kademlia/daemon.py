@@ -0,0 +1,371 @@
+import argparse
+import asyncio as aio
+import fcntl
+import inspect
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+
+from common.constants import ErrCode
+from common.utils import error_response
+from . import metrics
+from .crawler import Crawler, InfohashIndex
+from .constants import DEFAULT_KRPC_CONFIG, DEFAULT_BIT_TORRENT_CONFIG
+from .krpc import Krpc, QueryType
+from .metadata import MetadataFetcher, MetadataError, parse_info
+from .session import Session
+
+"""
+    krpc and bittorrent daemon
+
+    exactly one process per host owns the dht identity and the krpc and bittorrent ports, web workers
+    control it through a unix socket. an exclusive lock on `<socket>.lock` keeps a second daemon from
+    starting, SO_REUSEPORT would otherwise let it bind the same port silently.
+
+    one request per connection, json lines:
+
+        -> {"method": "status", "params": {}}
+        <- {"errcode": 0, "errmsg": "success", ...}
+
+    streaming methods, like `iter_peers`, answer with one line per item and end with a line carrying
+    `errcode`
+
+    the bittorrent side is a `session.Session` listening on `--bt-address`, it runs on the krpc loop
+    next to the dht, so torrents can look up peers without crossing threads
+
+    with `--crawl DIR` the daemon also runs a BEP 51 `crawler.Crawler` on the krpc loop, indexing into DIR
+
+    Examples:
+    $ python -m common.kademlia.daemon --socket /run/krpc/krpc.sock
+    >>> await DaemonClient().request('status')
+"""
+
+
+def _node_json(node) -> dict:
+    """ the json safe part of a node, its information also holds bytes like `token` and `visible_addr` """
+    addr = node.addr
+    return {'id': node.base16, 'addr': [addr[0], addr[1]] if addr else None}
+
+
+def _parse_addr(value: str) -> tuple[str, int]:
+    host, _, port = value.rpartition(':')
+    return host or '0.0.0.0', int(port)
+
+
+class Daemon:
+    def __init__(self, path: str = None, krpc: Krpc = None, session: Session = None, logger=None,
+                 crawl_path: str = None):
+        self.path = path or DEFAULT_KRPC_CONFIG['daemon_socket']
+        self.krpc = krpc or Krpc()
+        self.session = session
+        self.crawl_path = crawl_path
+        self.crawler = None
+        self.fetcher = None     # created on the krpc loop by the first `metadata` rpc
+        self.logger = logger or logging.getLogger(DEFAULT_KRPC_CONFIG['logger'])
+        self._lock = None
+        self._stopped = None
+
+    def acquire_lock(self):
+        """ raise RuntimeError if another daemon owns the socket """
+        fp = open(self.path + '.lock', 'a+')
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            fp.close()
+            raise RuntimeError('Daemon.acquire_lock|another daemon is running|path=%s' % self.path)
+        fp.seek(0)
+        fp.truncate()
+        fp.write(str(os.getpid()))
+        fp.flush()
+        self._lock = fp
+
+    def run(self):
+        self.acquire_lock()
+        try:
+            self.krpc.start()
+            aio.run(self.serve())
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        if self.krpc.is_running():
+            try:
+                self.krpc.stop()
+            except Exception as e:
+                self.logger.error('Daemon.shutdown|error=%s|server=%s', e, self.krpc.__class__.__name__)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
+
+    async def serve(self):
+        loop = aio.get_running_loop()
+        self._stopped = aio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self._stopped.set)
+
+        # a socket left by a crashed daemon, the lock proves nobody uses it
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await aio.start_unix_server(self.handle, self.path)
+        os.chmod(self.path, 0o660)
+        self.logger.warning('Daemon.serve|pid=%d|path=%s|root=%s', os.getpid(), self.path, self.krpc.root.base16)
+        async with server:
+            if self.session is not None:
+                await self.start_session()
+            crawl = await self.start_crawler() if self.crawl_path else None
+            await self._stopped.wait()
+            if self.session is not None:
+                await self.krpc.call(self.session.close, deadline=5)
+            if crawl is not None:
+                # the crawler flushes its index while the krpc loop still runs
+                crawl.cancel()
+                await aio.wait([aio.wrap_future(crawl)], timeout=5)
+                self.crawler.index.close()
+        self.logger.warning('Daemon.serve|stopped|path=%s', self.path)
+
+    async def start_session(self):
+        while getattr(self.krpc, 'core', None) is None:
+            await aio.sleep(0.05)
+        try:
+            await self.krpc.call(self.session.start, deadline=5)
+        except OSError as e:
+            # the dht is still useful without the bittorrent port
+            self.logger.error('Daemon.start_session|error=%s|address=%s', e, self.session.address)
+
+    async def start_crawler(self):
+        while getattr(self.krpc, 'core', None) is None:
+            await aio.sleep(0.05)
+        config = DEFAULT_KRPC_CONFIG
+        index = InfohashIndex(self.crawl_path, segment_size=config.get('crawl_segment_size', 64 << 20))
+        self.crawler = Crawler(self.krpc.core, index)
+        self.logger.warning('Daemon.start_crawler|indexed=%d|path=%s', len(index), self.crawl_path)
+        return aio.run_coroutine_threadsafe(self.crawler.run(), self.krpc.loop)
+
+    async def handle(self, reader: aio.StreamReader, writer: aio.StreamWriter):
+        try:
+            try:
+                req = json.loads(await reader.readline())
+                method = getattr(self, 'rpc_' + req['method'])
+                params = req.get('params') or {}
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                return self._write(writer, error_response(ErrCode.INVALID_PARAMETERS, 'invalid request|error=%s' % e))
+
+            if not self.krpc.is_running() or getattr(self.krpc, 'core', None) is None:
+                return self._write(writer, error_response(ErrCode.KRPC_SERVER_NOT_START))
+            try:
+                if inspect.isasyncgenfunction(method):
+                    async for item in method(**params):
+                        self._write(writer, item)
+                        await writer.drain()
+                    ret = error_response(ErrCode.SUCCESS)
+                else:
+                    ret = await method(**params)
+            except aio.TimeoutError:
+                ret = error_response(ErrCode.TIMEOUT)
+            except (TypeError, ValueError) as e:
+                ret = error_response(ErrCode.INVALID_PARAMETERS, str(e))
+            except Exception as e:
+                self.logger.exception('Daemon.handle|error=%s|method=%s', e, req['method'])
+                ret = error_response(ErrCode.SERVER_ERROR, str(e))
+            self._write(writer, ret)
+            await writer.drain()
+        except (ConnectionError, aio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _write(writer, obj):
+        try:
+            data = json.dumps(obj).encode()
+        except (TypeError, ValueError) as e:
+            # the client gets an errcode line instead of a dropped connection
+            data = json.dumps(error_response(ErrCode.SERVER_ERROR, 'unserializable response|error=%s' % e)).encode()
+        writer.write(data + b'\n')
+
+    # rpc methods, every one runs on the daemon loop and reaches the krpc loop through `Krpc.call`
+
+    async def rpc_status(self):
+        k = self.krpc
+        core = k.core
+        ret = error_response(ErrCode.SUCCESS)
+        ret.update(
+            pid=os.getpid(),
+            root=k.root.base16,
+            address=list(k.address),
+            nodes=len(k.dht),
+            peers=len(k.peers),
+            bittorrent=bool(self.session and self.session.is_serving()),
+        )
+        try:
+            resp = await k.call(core.ping, ('127.0.0.1', k.sock.getsockname()[1]), deadline=3)
+        except aio.TimeoutError:
+            ret['ping'] = False
+        else:
+            ret['ping'] = resp.get_queried_id().hex()
+        ret['transactions'] = await k.call(self._stats, deadline=3)
+        if self.session is not None:
+            ret['session'] = await k.call(self._session_stats, deadline=3)
+        return ret
+
+    async def _stats(self):
+        core = self.krpc.core
+        return dict(core.transactions.stats(), limiter=core.limiter.stats(), verify=core.verify_queue.stats())
+
+    async def _session_stats(self):
+        return self.session.stats()
+
+    async def rpc_bootstrap(self, method=QueryType.FIND_NODE, info_hash=None, timeout=10):
+        k, core, timeout = self.krpc, self.krpc.core, float(timeout)
+        ret = error_response(ErrCode.SUCCESS)
+        if method == QueryType.FIND_NODE:
+            nodes = await k.call(core.bootstrap_by_find_node, core.resolver.addrs, timeout=timeout,
+                                 deadline=timeout + 1)
+        elif method == QueryType.GET_PEERS:
+            nodes, peers = await k.call(core.bootstrap_by_get_peers, bytes.fromhex(info_hash), core.resolver.addrs,
+                                        timeout=timeout, deadline=timeout + 1)
+            ret['peers'] = [list(x) for x in peers]
+        else:
+            nodes = await k.call(core.bootstrap_by_ping, core.resolver.addrs, deadline=timeout)
+        ret['nodes'] = [_node_json(x) for x in nodes]
+        return ret
+
+    async def rpc_lookup(self, target, query=QueryType.FIND_NODE, timeout=10):
+        k = self.krpc
+        nodes, peers = await k.call(k.core.lookup, bytes.fromhex(target), query, deadline=float(timeout))
+        ret = error_response(ErrCode.SUCCESS)
+        ret['nodes'] = [_node_json(x) for x in nodes]
+        ret['peers'] = [list(x) for x in peers]
+        return ret
+
+    async def rpc_iter_peers(self, info_hash, timeout=10):
+        async for ip, port in self.krpc.iter_peers(bytes.fromhex(info_hash), timeout=float(timeout)):
+            yield {'ip': ip, 'port': port}
+
+    async def rpc_metadata(self, info_hash, timeout=60):
+        timeout = float(timeout)
+        try:
+            info = await self.krpc.call(self._resolve, bytes.fromhex(info_hash), timeout, deadline=timeout + 1)
+        except MetadataError as e:
+            return error_response(ErrCode.CLIENT_CONNECTION_ERROR, str(e))
+        ret = error_response(ErrCode.SUCCESS)
+        ret.update(parse_info(info))
+        return ret
+
+    async def _resolve(self, info_hash: bytes, timeout: float):
+        if self.fetcher is None:
+            self.fetcher = MetadataFetcher()
+        return await self.fetcher.resolve(self.krpc.core, info_hash, timeout)
+
+    async def rpc_metrics(self):
+        text = metrics.exposition(
+            metrics.KrpcCollector(lambda: self.krpc.core),
+            metrics.BitTorrentCollector(lambda: self.session.metrics if self.session else None),
+        )
+        if text is None:
+            return error_response(ErrCode.SERVER_ERROR, 'prometheus_client is not installed')
+        ret = error_response(ErrCode.SUCCESS)
+        ret['text'] = text.decode()
+        return ret
+
+    async def rpc_crawler(self):
+        if self.crawler is None:
+            return error_response(ErrCode.SERVER_ERROR, 'crawler is not running')
+        ret = error_response(ErrCode.SUCCESS)
+        ret.update(await self.krpc.call(self._crawler_stats, deadline=3))
+        return ret
+
+    async def _crawler_stats(self):
+        return self.crawler.stats()
+
+    async def rpc_stop(self):
+        # answer first, the servers stop once the loop leaves `serve`
+        aio.get_running_loop().call_soon(self._stopped.set)
+        return error_response(ErrCode.SUCCESS)
+
+
+class DaemonClient:
+    """
+    raises OSError, e.g. FileNotFoundError or ConnectionRefusedError, when no daemon listens
+
+    Examples:
+    >>> client = DaemonClient('/run/krpc/krpc.sock')
+    >>> await client.request('bootstrap', method='find_node', timeout=5)
+    >>> async for peer in client.stream('iter_peers', info_hash=info_hash.hex()):
+    ...     print(peer['ip'], peer['port'])
+    """
+
+    def __init__(self, path: str = None, timeout=30):
+        self.path = path or DEFAULT_KRPC_CONFIG['daemon_socket']
+        self.timeout = timeout
+
+    async def stream(self, method: str, /, **params):
+        """ every response line, the last one carries `errcode` """
+        reader, writer = await aio.wait_for(aio.open_unix_connection(self.path, limit=1 << 24), self.timeout)
+        try:
+            writer.write(json.dumps({'method': method, 'params': params}).encode() + b'\n')
+            await writer.drain()
+            while True:
+                line = await aio.wait_for(reader.readline(), self.timeout)
+                if not line:
+                    raise ConnectionResetError('DaemonClient.stream|daemon closed the connection')
+                obj = json.loads(line)
+                yield obj
+                if 'errcode' in obj:
+                    return
+        finally:
+            writer.close()
+
+    async def request(self, method: str, /, **params) -> dict:
+        async for obj in self.stream(method, **params):
+            if 'errcode' in obj:
+                return obj
+
+    def request_sync(self, method: str, /, **params) -> dict:
+        return aio.run(self.request(method, **params))
+
+    def is_alive(self) -> bool:
+        try:
+            return self.request_sync('status').get('errcode') == ErrCode.SUCCESS
+        except (OSError, aio.TimeoutError, ValueError):
+            return False
+
+
+def spawn(path: str = None, cwd: str = None, args=()) -> subprocess.Popen:
+    """ start a detached daemon, a second one exits at once because of the lock """
+    path = path or DEFAULT_KRPC_CONFIG['daemon_socket']
+    return subprocess.Popen(
+        [sys.executable, '-m', 'common.kademlia.daemon', '--socket', path, *args],
+        cwd=cwd, start_new_session=True, stdin=subprocess.DEVNULL,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m common.kademlia.daemon', description='krpc and bittorrent daemon')
+    parser.add_argument('--socket', default=DEFAULT_KRPC_CONFIG['daemon_socket'])
+    parser.add_argument('--address', type=_parse_addr, default=DEFAULT_KRPC_CONFIG['address'], help='krpc host:port')
+    parser.add_argument('--bt-address', type=_parse_addr, default=DEFAULT_BIT_TORRENT_CONFIG['address'])
+    parser.add_argument('--no-bittorrent', action='store_true')
+    parser.add_argument('--snapshot', default=None, help='routing table snapshot, empty to disable')
+    parser.add_argument('--crawl', default=None, help='crawl BEP 51 samples into this directory')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+    krpc = Krpc(address=args.address, snapshot_path=args.snapshot)
+    session = None if args.no_bittorrent else Session(address=args.bt_address)
+    try:
+        Daemon(args.socket, krpc, session, crawl_path=args.crawl).run()
+    except RuntimeError as e:
+        logging.getLogger(DEFAULT_KRPC_CONFIG['logger']).error('%s', e)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,446 @@
+import asyncio as aio
+import contextlib
+import hashlib
+import logging
+import math
+import struct
+
+import bencodepy
+import numpy as np
+
+from .bittorrent import MessageType
+from .constants import DEFAULT_BIT_TORRENT_CONFIG
+from .framer import parse_have, parse_piece
+from .metadata import _aiter
+from .session import Torrent, PeerConnection
+
+"""
+    piece download engine
+
+    a `Download` is the `session.Torrent` of a torrent being downloaded. the state of the swarm is a
+    handful of numpy arrays: the bitfield of every peer, the number of peers having each piece, and
+    per block whether it was received and by how many peers it is requested. a piece is chosen with a
+    few array operations over the pieces the peer has, the partly downloaded ones first, then the
+    rarest, ties broken at random, so picking stays cheap with tens of thousands of pieces and
+    hundreds of peers
+
+    every unchoked peer keeps `queue_depth` block requests in flight. once every missing block is
+    requested the download enters endgame, idle peers request blocks which are in flight elsewhere
+    and the copies still in flight are cancelled when the first one arrives. a peer which delivers
+    nothing for `request_timeout` seconds loses its requests to the others and is sent one request at a
+    time until it delivers again
+
+    a completed piece is checked against its sha1 by `storage.verify`, a failed one is downloaded again
+
+    Examples:
+    >>> download = session.add(Download.from_info(info_hash, info, MemoryStorage(piece_length, length)))
+    >>> await download.run(krpc.core.iter_peers(info_hash, timeout=60))
+
+    refer:
+     BEP 3 The BitTorrent Protocol Specification - http://bittorrent.org/beps/bep_0003.html
+     Rarest First and Choke Algorithms Are Enough - https://hal.inria.fr/inria-00001111/document
+"""
+
+BLOCK_SIZE = 1 << 14
+_HAVE = struct.Struct('>IBI')
+_REQUEST = struct.Struct('>IBIII')
+_PARTIAL_FIRST = 1 << 24    # added to the key of pieces not started yet, which sorts them last
+
+
+class MemoryStorage:
+    """ pieces kept in memory, the interface a storage implements for `Download`, see `storage.FileStorage` """
+
+    def __init__(self, piece_length: int, length: int):
+        self.piece_length = piece_length
+        self.length = length
+        self.pieces = dict()    # index -> bytearray
+
+    def piece_size(self, index: int) -> int:
+        return min(self.piece_length, self.length - index * self.piece_length)
+
+    def write(self, index: int, begin: int, block: memoryview):
+        piece = self.pieces.get(index)
+        if piece is None:
+            piece = self.pieces[index] = bytearray(self.piece_size(index))
+        piece[begin:begin + len(block)] = block
+
+    def read(self, index: int, begin: int, length: int) -> bytes:
+        return bytes(self.pieces[index][begin:begin + length])
+
+    async def verify(self, index: int, digest: bytes) -> bool:
+        piece = self.pieces.get(index)
+        if piece is not None and hashlib.sha1(piece).digest() == digest:
+            return True
+        self.pieces.pop(index, None)
+        return False
+
+
+class _Peer:
+    __slots__ = ('conn', 'bitfield', 'choked', 'interested', 'snubbed', 'requests', 'last_block')
+
+    def __init__(self, conn: PeerConnection, pieces: int, now: float):
+        self.conn = conn
+        self.bitfield = np.zeros(pieces, dtype=np.bool_)
+        self.choked = True          # the peer chokes us
+        self.interested = False     # we are interested in the peer
+        self.snubbed = False        # timed out, one request at a time until it delivers
+        self.requests = set()       # block numbers in flight
+        self.last_block = now
+
+
+class Download(Torrent):
+    """
+    `hashes` is the concatenated sha1 of every piece, `have` the pieces already verified, e.g. of a
+    resumed download
+    """
+
+    def __init__(self, info_hash: bytes, piece_length: int, length: int, hashes: bytes, storage=None,
+                 have: np.ndarray = None, queue_depth: int = None, request_timeout: float = None,
+                 max_connections: int = None, logger=None):
+        super().__init__(info_hash, max_connections)
+        config = DEFAULT_BIT_TORRENT_CONFIG
+        pieces = math.ceil(length / piece_length)
+        assert len(hashes) == pieces * 20, 'Download|one sha1 per piece'
+        self.piece_length = piece_length
+        self.length = length
+        self.hashes = hashes
+        self.storage = storage if storage is not None else MemoryStorage(piece_length, length)
+        self.queue_depth = queue_depth or config.get('download_queue_depth', 16)
+        self.request_timeout = request_timeout or config.get('download_request_timeout', 30)
+        self.logger = logger or logging.getLogger(config['logger'])
+        self.rng = np.random.default_rng()
+
+        # pieces
+        sizes = np.full(pieces, piece_length, dtype=np.int64)
+        sizes[-1] = length - (pieces - 1) * piece_length
+        self.have = np.zeros(pieces, dtype=np.bool_) if have is None else np.array(have, dtype=np.bool_)
+        self.availability = np.zeros(pieces, dtype=np.int32)    # peers having each piece
+        self.blocks = -(-sizes // BLOCK_SIZE)
+        self.first_block = np.concatenate(([0], np.cumsum(self.blocks)[:-1]))
+        # blocks neither received nor requested, zero for pieces we have or verify
+        self.free = np.where(self.have, 0, self.blocks)
+        self.verifying = set()
+        # pick order, kept up to date as availability and free change, see `_update_keys`
+        self._jitter = self.rng.random(pieces)
+        self._key = np.empty(pieces)
+        self._update_keys()
+
+        # blocks
+        self.block_piece = np.repeat(np.arange(pieces), self.blocks)
+        self.received = np.repeat(self.have, self.blocks)
+        self.requested = np.zeros(len(self.block_piece), dtype=np.int16)     # peers requesting each block
+
+        self.peers_state = dict()   # PeerConnection -> _Peer
+        self.done = None        # future set once every piece is verified, created on the loop
+        self._slot = None       # set when a connection of this torrent is closed or failed
+
+        # counters
+        self.downloaded = 0
+        self.wasted = 0
+        self.hash_failures = 0
+        self.endgame = False
+
+    @classmethod
+    def from_info(cls, info_hash: bytes, info: bytes, storage=None, **kwargs) -> 'Download':
+        """ from a bencoded info dictionary, like `metadata.MetadataFetcher.fetch` returns """
+        d = bencodepy.decode(info)
+        if b'files' in d:
+            length = sum(f[b'length'] for f in d[b'files'])
+        else:
+            length = d[b'length']
+        return cls(info_hash, d[b'piece length'], length, d[b'pieces'], storage, **kwargs)
+
+    @property
+    def pieces(self) -> int:
+        return len(self.have)
+
+    def progress(self) -> dict:
+        return dict(
+            pieces=self.pieces, have=int(self.have.sum()), peers=len(self.peers_state),
+            unchoked=sum(not x.choked for x in self.peers_state.values()),
+            in_flight=int((self.requested > 0).sum()), endgame=self.endgame,
+            downloaded=self.downloaded, wasted=self.wasted, hash_failures=self.hash_failures,
+        )
+
+    def _ensure_loop_state(self):
+        if self.done is None:
+            loop = aio.get_running_loop()
+            self.done = loop.create_future()
+            self._slot = aio.Event()
+            if self.have.all():
+                self.done.set_result(True)
+
+    async def run(self, peers=(), sweep_interval=1.0):
+        """
+        connect to `peers`, (ip, port) pairs of an iterable or an async iterable, while below the
+        connection caps, until every piece is verified
+        """
+        self._ensure_loop_state()
+        loop = aio.get_running_loop()
+        tasks = set()
+        sweeper = loop.create_task(self._sweep(sweep_interval))
+        try:
+            tried = set()
+            async with contextlib.aclosing(_aiter(peers)) as addrs:
+                async for addr in addrs:
+                    addr = tuple(addr)
+                    if addr in tried:
+                        continue
+                    tried.add(addr)
+                    while not self.done.done() and (self.is_full() or self.session.is_full()):
+                        self._slot.clear()
+                        # disconnects of other torrents free session slots without telling us
+                        with contextlib.suppress(aio.TimeoutError):
+                            await aio.wait_for(self._slot.wait(), sweep_interval)
+                    if self.done.done():
+                        break
+                    task = loop.create_task(self._connect(addr))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            await self.done
+        finally:
+            sweeper.cancel()
+            for task in tasks:
+                task.cancel()
+
+    async def _connect(self, addr):
+        try:
+            if await self.connect(addr) is not None:
+                return
+        except (OSError, aio.TimeoutError) as e:
+            self.logger.debug('Download._connect|error=%s|addr=%s', e, addr)
+        self._slot.set()
+
+    # session callbacks
+
+    def peer_connected(self, conn: PeerConnection):
+        self._ensure_loop_state()
+        self.peers_state[conn] = _Peer(conn, self.pieces, conn.loop.time())
+        if self.have.any():
+            payload = np.packbits(self.have).tobytes()
+            conn.write(struct.pack('>IB', len(payload) + 1, MessageType.BITFIELD) + payload)
+
+    def peer_disconnected(self, conn: PeerConnection):
+        peer = self.peers_state.pop(conn, None)
+        if peer is None:
+            return
+        self.availability -= peer.bitfield
+        self._release(peer)
+        self._update_keys()
+        if self._slot is not None:
+            self._slot.set()
+        self._fill_all()
+
+    def message_received(self, conn: PeerConnection, msg_id: int, payload: memoryview):
+        peer = self.peers_state.get(conn)
+        if peer is None:
+            return
+        try:
+            if msg_id == MessageType.PIECE:
+                self.piece_received(peer, *parse_piece(payload))
+            elif msg_id == MessageType.HAVE:
+                self.have_received(peer, parse_have(payload))
+            elif msg_id == MessageType.BITFIELD:
+                self.bitfield_received(peer, payload)
+            elif msg_id == MessageType.UNCHOKE:
+                peer.choked = False
+                peer.last_block = conn.loop.time()
+                self._fill(peer)
+            elif msg_id == MessageType.CHOKE:
+                # a choking peer discards our requests
+                peer.choked = True
+                self._release(peer)
+                self._fill_all()
+        except (ValueError, IndexError, struct.error) as e:
+            self.logger.warning('Download.message_received|error=%s|id=%d|address=%s', e, msg_id, conn.address)
+            conn.disconnect()
+
+    def bitfield_received(self, peer: _Peer, payload: memoryview):
+        if len(payload) != math.ceil(self.pieces / 8):
+            raise ValueError('Download.bitfield_received|wrong length|length=%d' % len(payload))
+        bits = np.unpackbits(np.frombuffer(payload, dtype=np.uint8), count=self.pieces).astype(np.bool_)
+        self.availability += bits
+        self.availability -= peer.bitfield
+        self._update_keys()
+        peer.bitfield = bits
+        self._update_interest(peer)
+
+    def have_received(self, peer: _Peer, index: int):
+        if not peer.bitfield[index]:
+            peer.bitfield[index] = True
+            self.availability[index] += 1
+            self._update_keys(index)
+            if not peer.interested and not self.have[index]:
+                self._update_interest(peer)
+            elif self.endgame or self.free[index]:
+                self._fill(peer)
+
+    def piece_received(self, peer: _Peer, index: int, begin: int, block: memoryview):
+        if begin % BLOCK_SIZE or begin >= self.blocks[index] * BLOCK_SIZE:
+            raise ValueError('Download.piece_received|bad offset|index=%d|begin=%d' % (index, begin))
+        b = int(self.first_block[index]) + begin // BLOCK_SIZE
+        if b not in peer.requests:
+            # unrequested or cancelled in endgame, dropped
+            self.wasted += len(block)
+            return
+        if len(block) != self._block_length(b):
+            raise ValueError('Download.piece_received|bad length|index=%d|length=%d' % (index, len(block)))
+        peer.requests.discard(b)
+        self.requested[b] -= 1
+        peer.last_block = peer.conn.loop.time()
+        peer.snubbed = False
+
+        if self.received[b]:
+            self.wasted += len(block)
+        else:
+            self.storage.write(index, begin, block)
+            self.received[b] = True
+            self.downloaded += len(block)
+            if self.endgame and self.requested[b]:
+                self._cancel(b)
+            s = int(self.first_block[index])
+            if self.received[s:s + self.blocks[index]].all():
+                self.verifying.add(index)
+                peer.conn.loop.create_task(self._verify(index))
+        self._fill(peer)
+
+    # requests
+
+    def _fill(self, peer: _Peer):
+        """ top up the requests in flight of `peer` to `queue_depth` """
+        need = (1 if peer.snubbed else self.queue_depth) - len(peer.requests)
+        if peer.choked or not peer.interested or need <= 0:
+            return
+        blocks = self.pick(peer.bitfield, need)
+        if not blocks and not self.endgame and not self.free.any() and not self.have.all():
+            self.endgame = True
+            self.logger.info('Download._fill|endgame|info_hash=%s', self.info_hash.hex())
+        if not blocks and self.endgame:
+            blocks = self.pick_endgame(peer, need)
+        if not blocks:
+            return
+
+        messages = []
+        for b in blocks:
+            if not self.requested[b]:
+                self.free[self.block_piece[b]] -= 1
+            self.requested[b] += 1
+            peer.requests.add(b)
+            index = int(self.block_piece[b])
+            begin = (b - int(self.first_block[index])) * BLOCK_SIZE
+            messages.append(_REQUEST.pack(13, MessageType.REQUEST, index, begin, self._block_length(b)))
+        self._update_keys(self.block_piece[blocks])
+        peer.conn.write(b''.join(messages))
+
+    def _fill_all(self):
+        for peer in list(self.peers_state.values()):
+            self._fill(peer)
+
+    def pick(self, bitfield: np.ndarray, count: int) -> list[int]:
+        """ up to `count` free blocks of the pieces in `bitfield`, partly downloaded pieces first, then the rarest """
+        candidates = np.flatnonzero(bitfield & (self.free > 0))
+        if not candidates.size:
+            return []
+        key = self._key[candidates]
+        if candidates.size > count:
+            # every piece gives at least one block, `count` pieces are enough
+            part = np.argpartition(key, count - 1)[:count]
+            candidates, key = candidates[part], key[part]
+        blocks = []
+        for index in candidates[np.argsort(key)].tolist():
+            s = int(self.first_block[index])
+            e = s + int(self.blocks[index])
+            free = np.flatnonzero((self.requested[s:e] == 0) & ~self.received[s:e])
+            blocks.extend((free[:count - len(blocks)] + s).tolist())
+            if len(blocks) >= count:
+                break
+        return blocks
+
+    def pick_endgame(self, peer: _Peer, count: int) -> list[int]:
+        """ blocks in flight at other peers, the least requested first """
+        blocks = np.flatnonzero((self.requested > 0) & ~self.received)
+        blocks = blocks[peer.bitfield[self.block_piece[blocks]]]
+        if peer.requests:
+            blocks = blocks[~np.isin(blocks, np.fromiter(peer.requests, dtype=np.int64))]
+        blocks = blocks[np.argsort(self.requested[blocks], kind='stable')[:count]]
+        return blocks.tolist()
+
+    def _cancel(self, b: int):
+        """ cancel the copies of block `b` still in flight """
+        index = int(self.block_piece[b])
+        begin = (b - int(self.first_block[index])) * BLOCK_SIZE
+        message = _REQUEST.pack(13, MessageType.CANCEL, index, begin, self._block_length(b))
+        for other in self.peers_state.values():
+            if b in other.requests:
+                other.requests.discard(b)
+                self.requested[b] -= 1
+                other.conn.write(message)
+
+    def _release(self, peer: _Peer):
+        """ forget the requests of `peer`, the blocks nobody else requests are free again """
+        if not peer.requests:
+            return
+        blocks = np.fromiter(peer.requests, dtype=np.int64)
+        peer.requests.clear()
+        self.requested[blocks] -= 1
+        blocks = blocks[(self.requested[blocks] == 0) & ~self.received[blocks]]
+        np.add.at(self.free, self.block_piece[blocks], 1)
+        self._update_keys(self.block_piece[blocks])
+
+    def _update_keys(self, index=slice(None)):
+        """ pick order of pieces `index`, the random fraction breaks ties between pieces of equal availability """
+        self._key[index] = (
+            self.availability[index] + self._jitter[index]
+            + _PARTIAL_FIRST * (self.free[index] == self.blocks[index])
+        )
+
+    def _block_length(self, b: int) -> int:
+        index = int(self.block_piece[b])
+        size = min(self.piece_length, self.length - index * self.piece_length)
+        return min(BLOCK_SIZE, size - (b - int(self.first_block[index])) * BLOCK_SIZE)
+
+    def _update_interest(self, peer: _Peer):
+        interested = bool((peer.bitfield & ~self.have).any())
+        if interested != peer.interested:
+            peer.interested = interested
+            msg_id = MessageType.INTERESTED if interested else MessageType.NOT_INTERESTED
+            peer.conn.write(struct.pack('>IB', 1, msg_id))
+        self._fill(peer)
+
+    async def _verify(self, index: int):
+        ok = await self.storage.verify(index, self.hashes[index * 20:index * 20 + 20])
+        self.verifying.discard(index)
+        if ok:
+            self.have[index] = True
+            message = _HAVE.pack(5, MessageType.HAVE, index)
+            for peer in list(self.peers_state.values()):
+                peer.conn.write(message)
+                if peer.interested and peer.bitfield[index]:
+                    self._update_interest(peer)
+            if self.have.all() and not self.done.done():
+                self.logger.info('Download._verify|complete|info_hash=%s', self.info_hash.hex())
+                self.done.set_result(True)
+        else:
+            # nobody knows which peer sent the bad block, the whole piece is downloaded again
+            self.hash_failures += 1
+            s = int(self.first_block[index])
+            self.received[s:s + self.blocks[index]] = False
+            self.free[index] = self.blocks[index] - (self.requested[s:s + self.blocks[index]] > 0).sum()
+            self._update_keys(index)
+            self.endgame = False
+            self.logger.warning('Download._verify|hash failed|index=%d|info_hash=%s', index, self.info_hash.hex())
+            self._fill_all()
+
+    async def _sweep(self, interval: float):
+        """ peers which delivered nothing for `request_timeout` lose their requests and are snubbed """
+        loop = aio.get_running_loop()
+        while True:
+            await aio.sleep(interval)
+            now = loop.time()
+            for peer in list(self.peers_state.values()):
+                if peer.requests and now - peer.last_block > self.request_timeout:
+                    self.logger.debug('Download._sweep|snubbed|address=%s', peer.conn.address)
+                    self._release(peer)
+                    peer.snubbed = True
+                    peer.last_block = now
+            self._fill_all()
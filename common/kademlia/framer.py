@@ -0,0 +1,142 @@
+import struct
+
+"""
+    incremental peer wire framer
+
+    the socket is read straight into one reusable `bytearray`, see `asyncio.BufferedProtocol`, and
+    `Framer.frames` slices the handshake and length prefixed messages out of it as memoryviews, a
+    PIECE block is never copied before its consumer writes it. a frame cut by tcp segmentation stays
+    in the buffer until the rest arrives, then the partial bytes are moved to the front, or into a
+    larger buffer if the frame does not fit
+
+    yielded views point into the receive buffer, they are valid until the next `get_buffer` or `feed`,
+    consumers copy what they keep
+
+    Examples:
+    >>> framer = Framer()
+    >>> framer.feed(data)
+    >>> for msg_id, payload in framer.frames():
+    ...     if msg_id == MessageType.PIECE:
+    ...         index, begin, block = parse_piece(payload)
+
+    refer:
+     BEP 3 The BitTorrent Protocol Specification - http://bittorrent.org/beps/bep_0003.html
+"""
+
+# pseudo message ids of frames without one
+HANDSHAKE = -1
+KEEP_ALIVE = -2
+
+HANDSHAKE_LENGTH = 68
+_LENGTH = struct.Struct('>I')
+_INDEX = struct.Struct('>I')
+_BLOCK = struct.Struct('>II')
+_REQUEST = struct.Struct('>III')
+
+
+class FrameError(ValueError):
+    pass
+
+
+class Framer:
+    """
+    `capacity` is the initial receive buffer, it grows for frames longer than it up to `max_length`
+    bytes of payload, longer frames raise `FrameError`
+    """
+    __slots__ = ('_buf', '_view', '_start', '_end', '_need', 'handshake', 'max_length')
+
+    def __init__(self, capacity=1 << 17, max_length=1 << 20, handshake=True):
+        self._buf = bytearray(capacity)
+        self._view = memoryview(self._buf)
+        self._start = 0     # first byte not framed yet
+        self._end = 0       # end of received bytes
+        self._need = HANDSHAKE_LENGTH if handshake else _LENGTH.size     # bytes of the pending frame
+        self.handshake = handshake      # the next frame is a handshake
+        self.max_length = max_length
+
+    def __len__(self):
+        """ received bytes not framed yet """
+        return self._end - self._start
+
+    @property
+    def capacity(self) -> int:
+        return len(self._buf)
+
+    def get_buffer(self, sizehint=-1) -> memoryview:
+        """ free space behind the received bytes, `asyncio.BufferedProtocol.get_buffer` """
+        if self._start == self._end:
+            self._start = self._end = 0
+        # room for the rest of the pending frame, and for a reasonable read if compacting gives it
+        pending = self._end - self._start
+        self._make_room(max(self._need - pending, min(len(self._buf) >> 2, len(self._buf) - pending), sizehint))
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes: int):
+        self._end += nbytes
+
+    def feed(self, data: bytes):
+        """ copy `data` in, for `asyncio.Protocol.data_received` """
+        if self._start == self._end:
+            self._start = self._end = 0
+        self._make_room(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def frames(self):
+        """ yield (message id, payload) of every complete frame, a keep alive has an empty payload """
+        buf, view, end = self._buf, self._view, self._end
+        start = self._start
+        while True:
+            available = end - start
+            if self.handshake:
+                if available < HANDSHAKE_LENGTH:
+                    self._need = HANDSHAKE_LENGTH
+                    return
+                self.handshake = False
+                self._start = start = start + HANDSHAKE_LENGTH
+                yield HANDSHAKE, view[start - HANDSHAKE_LENGTH:start]
+                continue
+
+            if available < 4:
+                self._need = 4
+                return
+            length = _LENGTH.unpack_from(buf, start)[0]
+            if length > self.max_length:
+                raise FrameError('Framer.frames|message too long|length=%d' % length)
+            if available < 4 + length:
+                self._need = 4 + length
+                return
+            self._start = start = start + 4 + length
+            if length:
+                yield buf[start - length], view[start - length + 1:start]
+            else:
+                yield KEEP_ALIVE, view[start:start]
+
+    def _make_room(self, size: int):
+        """ at least `size` free bytes behind the received ones """
+        if len(self._buf) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if pending + size <= len(self._buf):
+            # the source is copied first, the ranges may overlap
+            self._buf[:pending] = self._buf[self._start:self._end]
+        else:
+            buf = bytearray(max(len(self._buf) * 2, pending + size))
+            buf[:pending] = self._view[self._start:self._end]
+            self._buf, self._view = buf, memoryview(buf)
+        self._start, self._end = 0, pending
+
+
+def parse_have(payload) -> int:
+    return _INDEX.unpack_from(payload)[0]
+
+
+def parse_request(payload) -> tuple[int, int, int]:
+    """ (index, begin, length) of REQUEST and CANCEL """
+    return _REQUEST.unpack_from(payload)
+
+
+def parse_piece(payload: memoryview) -> tuple[int, int, memoryview]:
+    """ (index, begin, block), `block` is a view of the payload """
+    index, begin = _BLOCK.unpack_from(payload)
+    return index, begin, payload[_BLOCK.size:]
@@ -1,29 +1,46 @@
 import asyncio as aio
-import bencodepy
+import bisect
+import contextlib
+import numpy as np
 import logging
 import socket
 import struct
 import threading
 import time
 from asyncio.transports import DatagramTransport
-from functools import reduce
 from hashlib import md5
 from typing import Iterable, Sequence
 
 from common.utils import serializer, ip_address
-from .constants import ONE_WEEK, dht_bootstrap_address, DEFAULT_KRPC_CONFIG
+from . import codec, snapshot
+from .constants import dht_bootstrap_address, DEFAULT_KRPC_CONFIG
 from .node import Node, NodeInfo, DHT
+from .peer_store import PeerStore, bloom_estimate
+from .limiter import RateLimiter, VerifyQueue
+from .metrics import KrpcMetrics, monitor_loop_lag
+from .access_log import AccessSampler, LazyPacket, start_background_logging, stop_background_logging
+from .resolver import BootstrapResolver
+from .transaction import TransactionManager
+from .udp import create_batch_endpoint
 
 """
-    refer: http://bittorrent.org/beps/bep_0005.html
+    refer:
+     BEP 5 DHT Protocol - http://bittorrent.org/beps/bep_0005.html
+     BEP 51 DHT Infohash Indexing - http://bittorrent.org/beps/bep_0051.html
 """
 
 
+LOOKUP_QUERYING = 1
+LOOKUP_RESPONDED = 2
+LOOKUP_FAILED = 3
+
+
 class QueryType:
     PING = 'ping'
     FIND_NODE = 'find_node'
     GET_PEERS = 'get_peers'
     ANNOUNCE_PEER = 'announce_peer'
+    SAMPLE_INFOHASHES = 'sample_infohashes'
 
     @classmethod
     def get_query_class(cls, name: str):
@@ -65,12 +82,11 @@ class CommonMessage(serializer.Serializer):
         if self.transaction_id == b'':
             self.transaction_id = self.__get_transaction_id()
 
-    @classmethod
-    def __get_transaction_id(cls):
-        cls.__transaction_id += 1
-        if cls.__transaction_id >= 65536:
-            cls.transaction_id = 0
-        return struct.pack('H', cls.__transaction_id)
+    @staticmethod
+    def __get_transaction_id():
+        # one counter shared by every message class, or different queries would reuse the same ids
+        CommonMessage.__transaction_id = (CommonMessage.__transaction_id + 1) & 0xffff
+        return struct.pack('H', CommonMessage.__transaction_id)
 
     @classmethod
     def get_query_type(cls):
@@ -141,7 +157,7 @@ class Response(CommonMessage):
         return self.visible_addr is not None
 
     def get_visible_addr(self):
-        return decompress_ip_port(self.visible_addr)
+        return decompress_ip_port([self.visible_addr])[0]
 
 
 class ErrorResponse(CommonMessage):
@@ -178,6 +194,9 @@ class FindNodeResponse(Response):
             return []
         return decompress_node_info(nodes, fetch_detail=fetch_detail)
 
+    def get_compact_nodes(self) -> np.ndarray:
+        return decode_compact_nodes(self.response.get(b'nodes'))
+
 
 @QueryType.register_query(QueryType.GET_PEERS)
 class GetPeersRequest(Request):
@@ -209,12 +228,25 @@ class GetPeersResponse(Response):
         values = self.response.get(b'values', [])
         return decompress_ip_port(values)
 
+    def get_compact_values(self) -> np.ndarray:
+        return decode_compact_peers(self.response.get(b'values', []))
+
     def get_nodes(self, fetch_detail=False):
         nodes = self.response.get(b'nodes')
         if not nodes:
             return []
         return decompress_node_info(self.response.get(b'nodes'), fetch_detail=fetch_detail)
 
+    def get_compact_nodes(self) -> np.ndarray:
+        return decode_compact_nodes(self.response.get(b'nodes'))
+
+    def get_scrape(self) -> tuple[int, int] | None:
+        """ BEP 33 estimated (seeds, downloaders), None if the remote did not answer a scrape """
+        seeds, peers = self.response.get(b'BFsd'), self.response.get(b'BFpe')
+        if seeds is None or peers is None:
+            return None
+        return bloom_estimate(seeds), bloom_estimate(peers)
+
     def get_queried_node(self):
         n = super().get_queried_node()
         if self.has_token():
@@ -254,11 +286,44 @@ class AnnouncePeerResponse(Response):
     pass
 
 
+@QueryType.register_query(QueryType.SAMPLE_INFOHASHES)
+class SampleInfohashesRequest(Request):
+    query = serializer.CharField(field_name='q', default=QueryType.SAMPLE_INFOHASHES, encode='ascii')
+
+    def get_target(self) -> bytes:
+        return self.arguments[b'target']
+
+
+@QueryType.register_response(QueryType.SAMPLE_INFOHASHES)
+class SampleInfohashesResponse(Response):
+    def get_interval(self) -> int:
+        return self.response.get(b'interval', 0)
+
+    def get_num(self) -> int:
+        """ info hashes the remote stores, the samples are a subset """
+        return self.response.get(b'num', 0)
+
+    def get_samples(self) -> bytes:
+        """ concatenated 20 bytes info hashes, a trailing partial one is dropped """
+        samples = self.response.get(b'samples') or b''
+        return samples[:len(samples) - len(samples) % 20]
+
+    def get_nodes(self, fetch_detail=False):
+        nodes = self.response.get(b'nodes')
+        if not nodes:
+            return []
+        return decompress_node_info(nodes, fetch_detail=fetch_detail)
+
+    def get_compact_nodes(self) -> np.ndarray:
+        return decode_compact_nodes(self.response.get(b'nodes'))
+
+
 def parse_request(data: bytes = None, obj: dict = None) -> Request:
-    if obj:
-        data = obj
-    else:
-        data = bencodepy.decode(data)
+    if obj is None:
+        obj = codec.decode(data)
+    if isinstance(obj, codec.KrpcMessage):
+        obj = obj.to_dict()
+    data = obj
     query = data.get(b'q', b'').decode('utf8')
     if not query:
         raise ValueError(f'invalid request params: {data}')
@@ -280,10 +345,11 @@ def parse_request(data: bytes = None, obj: dict = None) -> Request:
 
 def parse_response(name: str, data: bytes = None, obj: dict = None):
     # parse bencode
-    if obj:
-        data = obj
-    else:
-        data = bencodepy.decode(data)
+    if obj is None:
+        obj = codec.decode(data)
+    if isinstance(obj, codec.KrpcMessage):
+        obj = obj.to_dict()
+    data = obj
 
     #  get response class:
     if data[b'y'] == b'e':
@@ -314,7 +380,7 @@ def compact_ip_port(ip: str, port: int) -> bytes:
             raise ValueError(f'ip {ip} format not valid')
     except Exception as e:
         raise ValueError(f'parse ip failed: {e}')
-    data = struct.pack('BBBBH', *fragment, port)
+    data = struct.pack('!4BH', *fragment, port)
     return data
 
 
@@ -322,43 +388,55 @@ def compact_node_info(n: bytes, ip: str, port: int) -> bytes:
     return n + compact_ip_port(ip, port)
 
 
+# compact info of BEP 5, ip and port are big endian
+COMPACT_PEER_DTYPE = np.dtype([('ip', '>u4'), ('port', '>u2')])
+COMPACT_NODE_DTYPE = np.dtype([('id', np.uint8, (20,)), ('ip', '>u4'), ('port', '>u2')])
+
+
+def decode_compact_nodes(nodes: bytes) -> np.ndarray:
+    """ view compact node info as a COMPACT_NODE_DTYPE array without copying, empty for malformed data """
+    if not nodes or len(nodes) % COMPACT_NODE_DTYPE.itemsize != 0:
+        return np.empty(0, dtype=COMPACT_NODE_DTYPE)
+    return np.frombuffer(nodes, dtype=COMPACT_NODE_DTYPE)
+
+
+def decode_compact_peers(values: list[bytes]) -> np.ndarray:
+    """ compact peer strings of get_peers `values` as a COMPACT_PEER_DTYPE array, non ipv4 entries are skipped """
+    data = b''.join(x for x in values if len(x) == COMPACT_PEER_DTYPE.itemsize)
+    return np.frombuffer(data, dtype=COMPACT_PEER_DTYPE)
+
+
+def pack_ip_port(ip: str, port: int) -> tuple[int, int]:
+    return int.from_bytes(socket.inet_aton(ip), 'big'), port
+
+
+def unpack_ip_port(ip: int, port: int) -> tuple[str, int]:
+    return socket.inet_ntoa(ip.to_bytes(4, 'big')), port
+
+
+def compact_ip_ports(ar: np.ndarray) -> list[tuple[str, int]]:
+    """ (ip, port) tuples of an array with `ip` and `port` fields """
+    octets = np.ascontiguousarray(ar['ip']).view(np.uint8).reshape(-1, 4).tolist()
+    return [('%d.%d.%d.%d' % tuple(ip), port) for ip, port in zip(octets, ar['port'].tolist())]
+
+
 def decompress_ip_port(values: list[bytes]) -> list[tuple[str, int]]:
-    ret = []
     for value in values:
         if len(value) != 6:
             raise ValueError(f'kademlia.decompress_ip_port validation error:{value} is not the compacted ip-port data')
-        args = struct.unpack('4BH', value)
-        ip = '.'.join(map(lambda x: str(x), args[:4]))
-        port = args[-1]
-        ret.append((ip, port))
-    return ret
+    return compact_ip_ports(decode_compact_peers(values))
 
 
 def decompress_node_info(nodes: bytes, fetch_detail=False) -> list[Node]:
-    nodes_len = len(nodes)
-    if len(nodes) % 26 != 0:
-        # TODO: log bad response
-        return []
-
-    # parse nodes
+    ar = decode_compact_nodes(nodes)
     ret = []
-    for i in range(nodes_len // 26):
-        node_info = NodeInfo()
-
-        # parse bytes
-        args = struct.unpack('20s4BH', nodes[i * 26:(i + 1) * 26])
-        node_info.update({
-            'id': args[0],
-            'ip': '.'.join(map(lambda x: str(x), args[1:5])),
-            'port': args[-1],
-        })
-        node_info['addr'] = (node_info.pop('ip'), node_info.pop('port'))
+    for row, addr in zip(ar, compact_ip_ports(ar)):
+        node_info = NodeInfo(addr=addr)
 
         # fetch ip detail info from https://ipinfo.io/, which may be too heavy
         if fetch_detail:
-            node_info['ip_info'] = ip_address.IpManager.create_by_ip(node_info['ip'])
-        node = Node(data=node_info['id'], info=NodeInfo(node_info))
-        ret.append(node)
+            node_info['ip_info'] = ip_address.IpManager.create_by_ip(addr[0])
+        ret.append(Node(data=row['id'].tobytes(), info=node_info))
 
     return ret
 
@@ -369,7 +447,7 @@ class Token:
     @classmethod
     def create(cls, addr: tuple[str, int]):
         """ generate krpc token """
-        h = md5(addr[0] + cls.token_seed)
+        h = md5((addr[0] + cls.token_seed).encode('utf8'))
         return h.digest()
 
     @classmethod
@@ -379,7 +457,7 @@ class Token:
 
 
 class KrpcProtocol(aio.DatagramProtocol):
-    _krpc_session = dict()
+    transactions: TransactionManager
 
     def __init__(
             self,
@@ -387,31 +465,59 @@ class KrpcProtocol(aio.DatagramProtocol):
             dht: DHT,
             logger: logging.Logger,
             bootstrap_addrs: list[tuple[str, int]],
+            peers: PeerStore = None,
+            snapshot_path: str = None,
+            checkpoint_interval=300,
+            revalidate: Sequence[bytes] = (),
     ):
         self.logger = logger
         self.node = root
         self.dht = dht # decentralization hash table
-        self.peers = dict()
+        self.peers = peers if peers is not None else PeerStore()
         self.bootstrap_addrs = bootstrap_addrs
-        self._krpc_session = dict()
+        self.resolver = BootstrapResolver(bootstrap_addrs, logger=logger)
+        self.snapshot_path = snapshot_path
+        self.checkpoint_interval = checkpoint_interval
+        self.revalidate_nodes = list(revalidate)    # node ids restored from a snapshot, not heard from yet
+        self.transactions = None
+        self.limiter = RateLimiter(DEFAULT_KRPC_CONFIG.get('query_rate', 20), DEFAULT_KRPC_CONFIG.get('query_burst', 40))
+        self.verify_queue = VerifyQueue(self.verify_requester, rate=DEFAULT_KRPC_CONFIG.get('verify_rate', 50),
+                                        ttl=DEFAULT_KRPC_CONFIG.get('verify_ttl', 600), logger=logger)
+        self.sampler = AccessSampler(DEFAULT_KRPC_CONFIG.get('access_log_sample'))
+        self.metrics = KrpcMetrics()
+        self._tasks = dict()    # background tasks
         super().__init__()
 
     def connection_made(self, transport: DatagramTransport) -> None:
         self.logger.info(f'KrpcProtocol.connection_made|krpc listen on {self.node.base16}')
         self.transport = transport
         loop = aio.get_running_loop()
-        self._krpc_session['bootstrap'] = {
-            'future': loop.create_task(self.bootstrap()),
-        }
+        self.transactions = self.create_transaction_manager(loop)
+        self._tasks['bootstrap'] = loop.create_task(self.bootstrap())
+        self._tasks['verify'] = loop.create_task(self.verify_queue.run())
+        if self.resolver.hosts:
+            self._tasks['resolve'] = loop.create_task(self.resolver.refresh_forever())
+        if self.revalidate_nodes:
+            self._tasks['revalidate'] = loop.create_task(self.revalidate(self.revalidate_nodes))
+            self.revalidate_nodes = []
+        if self.snapshot_path:
+            self._tasks['checkpoint'] = loop.create_task(self.checkpoint(self.checkpoint_interval))
+        config = DEFAULT_KRPC_CONFIG
+        self._tasks['ping'] = loop.create_task(self.ping_pending(config.get('ping_interval', 1),
+                                                                 config.get('ping_batch', 32)))
+        self._tasks['refresh'] = loop.create_task(self.refresh(config.get('refresh_interval', 900)))
+
+    def create_transaction_manager(self, loop) -> TransactionManager:
+        return TransactionManager(loop)
 
     def connection_lost(self, exc) -> None:
         if not exc:
             self.logger.warning('KrpcProtocol.connection_lost|connection normal quit')
         else:
             self.logger.error('KrpcProtocol.connection_lost|error=%s', exc)
-        for session_key, val in self._krpc_session.items():
-            future = val['future']
-            future.cancel('KrpcProtocol.connection_lost')
+        self.transactions.cancel_all('KrpcProtocol.connection_lost')
+        for task in self._tasks.values():
+            task.cancel('KrpcProtocol.connection_lost')
 
     def error_received(self, exc: Exception) -> None:
         self.logger.error('KrpcProtocol.error_received|error=%s', exc)
@@ -420,100 +526,101 @@ class KrpcProtocol(aio.DatagramProtocol):
     def datagram_received(self, data: bytes, addr) -> None:
         #   parse message
         try:
-            obj = bencodepy.decode(data)
-        except Exception as e:
-            self.logger.warning('KrpcProtocol.datagram_received|BencodeDecodeError|error=%s|data=%s', e, data)
+            msg = codec.decode(data)
+        except codec.DecodeError as e:
+            self.metrics.received('invalid')
+            if self.sampler.sample('invalid'):
+                self.logger.warning('KrpcProtocol.datagram_received|BencodeDecodeError|error=%s|%s',
+                                    e, LazyPacket(data, addr))
             return
-        t = obj[b't'].hex()
-        y = obj[b'y']
+        y = msg.y
+        kind = AccessSampler.kind_of(msg)
+        self.metrics.received(*kind)
 
-        # print access log
-        self.logger.info('access_log|KrpcProtocol.datagram_received|from=%s|message=%s', addr, dict(obj))
+        # sampled access log, formatted by the log writer thread
+        if self.sampler.sample(*kind):
+            self.logger.info('access_log|KrpcProtocol.datagram_received|%s', LazyPacket(msg, addr))
 
         #   handle response
-        if y in [b'r', b'e']:
-            if t in self._krpc_session:
-                self._krpc_session[t]['future'].set_result((obj, addr))
-            else:
-                # handle drifting packet
-                pass
+        if y == b'r' or y == b'e':
+            self.response_received(msg, addr, data)
 
         #   handle request
         elif y == b'q':
-            # parse request
-            req = parse_request(obj=obj)
-            data = req.validate()
-            # self.logger.info('access_log|KrpcProtocol.datagram_received|from={}|request={}'.format(addr, data))
+            if not self.limiter.allow(addr[0]):
+                return
 
-            # add middleware, like logger / trace-id or etc.
-            setattr(req, 'logger', self.logger)
+            # validate request
+            try:
+                msg.validate()
+            except codec.DecodeError as e:
+                if self.sampler.sample('invalid'):
+                    self.logger.info('KrpcProtocol.datagram_received|invalid krpc request|error=%s|%s',
+                                     e, LazyPacket(msg, addr))
+                return
 
             # handle request
-            loop = aio.get_running_loop()
-            if hasattr(self, req.query):
-                name = 'handle_' + req.query
-                handle = getattr(self, name, None)
-                loop.create_task(handle(req, addr), name=name + '.' + req.transaction_id.hex())
-                if req.query != QueryType.PING:
-                    loop.create_task(self.try_record_requesting_node(req, addr))
+            query = msg.query
+            handle = getattr(self, 'handle_' + query, None) if hasattr(self, query) else None
+            if handle is not None:
+                # cheap handlers answer inside the callback, only coroutine handlers get a task
+                if aio.iscoroutinefunction(handle):
+                    aio.get_running_loop().create_task(handle(msg, addr), name='handle_' + query + '.' + msg.t.hex())
+                else:
+                    handle(msg, addr)
+                if msg.id in self.dht:
+                    self.dht.seen(msg.id, query=True)
+                elif query != QueryType.PING:
+                    self.verify_queue.push(msg.id, addr)
 
             # handle not inherited query method
             else:
-                self.logger.info('KrpcProtocol.datagram_received|unrecognized krpc request: %s', repr(obj))
+                if self.sampler.sample('invalid'):
+                    self.logger.info('KrpcProtocol.datagram_received|unrecognized krpc request|%s',
+                                     LazyPacket(msg, addr))
 
         # handle unrecognized krpc packet
         elif y == b'echo':
             self.transport.sendto(data, addr)
         else:
-            self.logger.info('KrpcProtocol.datagram_received|unrecognized krpc packet:%s', repr(obj))
+            if self.sampler.sample('invalid'):
+                self.logger.info('KrpcProtocol.datagram_received|unrecognized krpc packet|%s', LazyPacket(msg, addr))
+
+    def response_received(self, msg: codec.KrpcMessage, addr, data: bytes):
+        # late or unknown responses, and responses from another address, are counted as drifting packets
+        self.transactions.resolve(msg.t, addr, (msg, addr))
 
     # client
 
     async def do_request(self, req: Request, addr, *, retry=3, timeout=0.2):
-        def _timeout_handle(coro, transaction_id):
-            del self._krpc_session[transaction_id]
-            if not coro.done():
-                coro.set_exception(aio.exceptions.TimeoutError())
-
-        # insert coroutine to event loop
-        loop = aio.get_running_loop()
-        coro = loop.create_future()
-        transaction_id = req.transaction_id.hex()
-        self._krpc_session[transaction_id] = {
-            'future': coro,
-            'ctime': time.time(),
-        }
-
-        # send request
-        self.transport.sendto(req.bencode(), addr)
-
-        # set timeout
-        loop.call_later(timeout, _timeout_handle, coro, transaction_id)
-
-        # await response
-        try:
-            obj, received_addr = await coro
-        except aio.exceptions.TimeoutError as e:
-            retry -= 1
-            if retry:
-                return await self.do_request(req, addr, retry=retry, timeout=timeout*2)
-            raise e
-        except aio.CancelledError as e:
-            raise e
+        # every attempt gets its own transaction id, so a late response of a previous attempt is drifting
+        query = req.get_query_type()
+        for attempt in range(retry):
+            future = self.transactions.create(addr, timeout)
+            req.transaction_id = future.tid
+            self.transport.sendto(req.bencode(), addr)
+            self.metrics.sent('q', query)
+            start = time.perf_counter()
+            try:
+                obj, _ = await future
+            except aio.TimeoutError:
+                self.metrics.timeout(query)
+                if attempt + 1 >= retry:
+                    raise
+                self.transactions.retries += 1
+                timeout *= 2
+            else:
+                self.metrics.observe_rtt(query, time.perf_counter() - start)
+                break
 
         # parse response
         resp = parse_response(req.get_query_type(), obj=obj)
 
-        # validate packet
-        if received_addr != addr:
-            raise AssertionError('KrpcProtocol.do_request|{}.{} requested addr={}, but received response from {}'.format(
-                req.get_query_type(),
-                transaction_id,
-                addr,
-                received_addr,
-            ))
+        # validate packet, the transaction table only resolves responses from `addr`
         if resp.transaction_id != req.transaction_id:
             raise AssertionError('KrpcProtocol.do_request|response={}|transaction id is different', resp.validate())
+        if obj.id is not None:
+            self.dht.seen(obj.id)
 
         # return
         setattr(resp, 'remote', addr)
@@ -538,19 +645,19 @@ class KrpcProtocol(aio.DatagramProtocol):
         resp = await self.do_request(req, addr)
         return resp
 
-    async def find_node(self, target: Node, addr: (str, int)) -> FindNodeResponse:
+    async def find_node(self, target: Node | bytes, addr: (str, int), **kwargs) -> FindNodeResponse:
         req = FindNodeRequest(arguments=dict(
             id=self.node.data,
-            target=target.data,
+            target=bytes(target),
         ))
-        return await self.do_request(req, addr)
+        return await self.do_request(req, addr, **kwargs)
 
-    async def get_peers(self, info_hash: bytes, addr: (str, int)) -> GetPeersResponse:
+    async def get_peers(self, info_hash: bytes, addr: (str, int), **kwargs) -> GetPeersResponse:
         req = GetPeersRequest(arguments=dict(
             id=self.node.data,
             info_hash=info_hash,
         ))
-        return await self.do_request(req, addr)
+        return await self.do_request(req, addr, **kwargs)
 
     async def announce_peer(self, addr: (str, int), info_hash, port, token,
                             implied_port=True) -> AnnouncePeerResponse:
@@ -563,77 +670,61 @@ class KrpcProtocol(aio.DatagramProtocol):
         ))
         return await self.do_request(req, addr)
 
+    async def sample_infohashes(self, target: bytes, addr: (str, int), **kwargs) -> SampleInfohashesResponse:
+        req = SampleInfohashesRequest(arguments=dict(
+            id=self.node.data,
+            target=bytes(target),
+        ))
+        return await self.do_request(req, addr, **kwargs)
+
     # request handler
 
-    async def try_record_requesting_node(self, request: Request, addr):
-        resp = await self.ping(addr)
-        if not isinstance(resp, ErrorResponse):
-            info = NodeInfo(addr=addr)
-            if resp.visible_addr is not None:
-                info.visible_addr = resp.visible_addr
-            n = Node(request.get_querying_id(), info=info)
-            self.dht.put(n)
+    async def verify_requester(self, node_id: bytes, addr):
+        """ ping a requester once, it enters the routing table only if it answers with the same id """
+        resp = await self.do_request(PingRequest(arguments=dict(id=self.node.data)), addr, retry=1, timeout=1)
+        if isinstance(resp, ErrorResponse) or resp.get_queried_id() != node_id:
+            return
+        info = NodeInfo(addr=addr)
+        if resp.visible_addr is not None:
+            info.visible_addr = resp.visible_addr
+        self.dht.put(Node(node_id, info=info))
+        self.dht.seen(node_id)
 
-    async def handle_ping(self, request: PingRequest, addr):
+    def handle_ping(self, request: codec.KrpcMessage, addr):
         # response
-        resp = PingResponse(
-            transaction_id=request.transaction_id,
-            visible_addr=compact_ip_port(*addr),
-            response=dict(id=self.node.data),
-        )
-        self.transport.sendto(resp.bencode(), addr)
+        resp = codec.encode_ping_response(request.t, self.node.data, compact_ip_port(*addr))
+        self.transport.sendto(resp, addr)
+        self.metrics.sent('r', QueryType.PING)
 
-    async def handle_find_node(self, request: FindNodeRequest, addr):
+    def handle_find_node(self, request: codec.KrpcMessage, addr):
         # response
         target = Node(request.get_target())
-        nodes = self.dht.get_neighbors(target, 16)
-        info = reduce(
-            lambda x, y: x + y,
-            (compact_node_info(x.data, *x.information.addr) for x in nodes if x.information.addr is not None),
-        )
-        resp = FindNodeResponse(
-            transaction_id=request.transaction_id,
-            visible_addr=compact_ip_port(*addr),
-            response=dict(
-                id=self.node.data,
-                nodes=info,
-            )
-        )
-        self.transport.sendto(resp.bencode(), addr)
+        info = self.dht.get_compact_neighbors(target, 16)
+        resp = codec.encode_find_node_response(request.t, self.node.data, compact_ip_port(*addr), info)
+        self.transport.sendto(resp, addr)
+        self.metrics.sent('r', QueryType.FIND_NODE)
 
-    async def handle_get_peers(self, request: GetPeersRequest, addr):
+    def handle_get_peers(self, request: codec.KrpcMessage, addr):
         # response
         info_hash = request.get_info_hash()
         token = Token.create(addr)
-        if info_hash in self.peers:
-            peers = self.peers.setdefault(info_hash, [])
-            now = time.time()
-            peers = [x[0] for x in peers if x[1] + ONE_WEEK > now],
-            self.peers[info_hash] = peers
-            args = dict(
-                id=self.node.data,
-                token=token,
-                values=peers,
+        bloom = self.peers.get_bloom(info_hash) if request.scrape else None
+        values = self.peers.get(info_hash)
+        if values:
+            resp = codec.encode_get_peers_response(
+                request.t, self.node.data, compact_ip_port(*addr), token,
+                values=values, bloom=bloom,
             )
         else:
-            nodes = self.dht.get_neighbors(Node(info_hash), 16)
-            info = reduce(
-                lambda x, y: x + y,
-                (compact_node_info(x.data, *x.information.addr) for x in nodes if x.information.addr is not None),
-            )
-            args = dict(
-                id=self.node.data,
-                nodes=info,
-                token=token,
+            info = self.dht.get_compact_neighbors(Node(info_hash), 16)
+            resp = codec.encode_get_peers_response(
+                request.t, self.node.data, compact_ip_port(*addr), token,
+                nodes=info, bloom=bloom,
             )
-        resp = GetPeersResponse(
-            transaction_id=request.transaction_id,
-            visible_addr=compact_ip_port(*addr),
-            response=args,
-        )
-        self.transport.sendto(resp.bencode(), addr)
+        self.transport.sendto(resp, addr)
+        self.metrics.sent('r', QueryType.GET_PEERS)
 
-    async def handle_announce_peer(self, request: AnnouncePeerRequest, addr):
+    def handle_announce_peer(self, request: codec.KrpcMessage, addr):
         # validate
         token = request.get_token()
         if not Token.is_valid(token, addr):
@@ -645,15 +736,23 @@ class KrpcProtocol(aio.DatagramProtocol):
         else:
             port = request.get_port()
         peer = compact_ip_port(addr[0], port)
-        self.peers.setdefault(request.get_info_hash(), []).append((peer, time.time()))
+        self.peers.announce(request.get_info_hash(), peer, seed=bool(request.seed))
 
         # return response
-        resp = AnnouncePeerResponse(
-            transaction_id=request.transaction_id,
-            visible_addr=compact_ip_port(*addr),
-            response=dict(id=self.node.data),
+        resp = codec.encode_announce_peer_response(request.t, self.node.data, compact_ip_port(*addr))
+        self.transport.sendto(resp, addr)
+        self.metrics.sent('r', QueryType.ANNOUNCE_PEER)
+
+    def handle_sample_infohashes(self, request: codec.KrpcMessage, addr):
+        config = DEFAULT_KRPC_CONFIG
+        interval = config.get('sample_interval', 300)
+        samples = self.peers.sample(config.get('sample_count', 20), interval)
+        info = self.dht.get_compact_neighbors(Node(request.get_target()), 8)
+        resp = codec.encode_sample_infohashes_response(
+            request.t, self.node.data, compact_ip_port(*addr), interval, self.peers.torrents(), samples, info,
         )
-        self.transport.sendto(resp.bencode(), addr)
+        self.transport.sendto(resp, addr)
+        self.metrics.sent('r', QueryType.SAMPLE_INFOHASHES)
 
     async def bootstrap_by_ping(self, addrs) -> Sequence[Node]:
         ret = []
@@ -695,67 +794,276 @@ class KrpcProtocol(aio.DatagramProtocol):
                 nodes.update(resp.get_nodes())
         return responses, nodes
 
-    async def bootstrap_by_find_node(self, addrs, timeout=3) -> set[Node]:
-        # get booming nodes
-        ret = set()
-        if addrs is None:
-            addrs = set()
-        addrs = set(addrs)
-
-        last_length = -1
-        start_time = time.time()
-        while len(ret) != last_length or time.time() - start_time < timeout:
-            responses, nodes = await self.batch_find_node(self.node, addrs)
-            ret |= nodes
-            addrs ^= {x.information.addr for x in responses}
-            addrs |= {x.information.addr for x in nodes}
-            self.logger.info(
-                'KrpcProtocol.bootstrap_by_find_node|querying_nodes=%d|found_counts=%d|differential=%d',
-                len(addrs),
-                len(ret),
-                len(ret) - last_length,
-            )
-            last_length = len(ret)
+    async def lookup(
+            self, target: bytes, query_type=QueryType.FIND_NODE, addrs: Iterable = (), *,
+            alpha=3, k=8, retry=1, timeout=0.5, on_peers=None,
+    ) -> tuple[list[Node], set[tuple[str, int]]]:
+        """
+        iterative kademlia lookup, at most `alpha` queries are in flight and the lookup stops
+        once the `k` closest known nodes have all responded
+
+        :param target: node id for find_node or info_hash for get_peers
+        :param query_type: QueryType.FIND_NODE or QueryType.GET_PEERS
+        :param addrs: extra addresses with unknown ids to start with, like bootstrap routers
+        :param on_peers: called with the (ip, port) list of every get_peers response carrying values
+        :return: k closest responded nodes sorted by distance, peers found by get_peers
+        """
+        if query_type == QueryType.FIND_NODE:
+            query = self.find_node
+        elif query_type == QueryType.GET_PEERS:
+            query = self.get_peers
+        else:
+            raise ValueError(f'KrpcProtocol.lookup|unsupported query type: {query_type}')
+
+        target_key = int.from_bytes(target, 'big')
+        shortlist = []      # sorted (distance, id)
+        candidates = {}     # id -> (ip, port) integers of the compact node info
+        responded = {}      # id -> node
+        state = {}          # id -> LOOKUP_*, absent means not queried yet
+        seeds = list(addrs)
+        in_flight = {}      # task -> id, None for seeds
+        peers = set()
 
-        self.logger.info('KrpcProtocol.bootstrap_by_find_node|results={}'.format([dict(x.information) for x in ret]))
-        return ret
+        def add_candidates(nodes: np.ndarray):
+            for key, ip, port in zip(map(bytes, nodes['id']), nodes['ip'].tolist(), nodes['port'].tolist()):
+                if key in candidates or key == self.node.data or not port:
+                    continue
+                candidates[key] = (ip, port)
+                bisect.insort(shortlist, (int.from_bytes(key, 'big') ^ target_key, key))
+
+        def next_candidate():
+            # the first not queried node among the k closest nodes which has not failed
+            alive = 0
+            for _, key in shortlist:
+                st = state.get(key)
+                if st is None:
+                    return key
+                if st != LOOKUP_FAILED:
+                    alive += 1
+                    if alive >= k:
+                        break
+            return None
+
+        add_candidates(decode_compact_nodes(self.dht.get_compact_neighbors(Node(target), k)))
+
+        # in flight queries of a cancelled lookup, like a closed `iter_peers`, are cancelled too
+        try:
+            while True:
+                # keep `alpha` queries in flight
+                while len(in_flight) < alpha:
+                    if seeds:
+                        key, addr = None, seeds.pop()
+                    else:
+                        key = next_candidate()
+                        if key is None:
+                            break
+                        addr = unpack_ip_port(*candidates[key])
+                        state[key] = LOOKUP_QUERYING
+                    task = aio.create_task(query(target, addr, retry=retry, timeout=timeout))
+                    in_flight[task] = key
+                if not in_flight:
+                    break
+
+                done, _ = await aio.wait(in_flight, return_when=aio.FIRST_COMPLETED)
+                for task in done:
+                    key = in_flight.pop(task)
+                    try:
+                        resp = task.result()
+                        nodes = resp.get_compact_nodes()
+                        # the id is chosen by the remote, a malformed one fails this query only
+                        node = resp.get_queried_node()
+                        if len(node.data) != len(self.node.data):
+                            raise ValueError('malformed responder id|length=%d' % len(node.data))
+                    except Exception as e:
+                        if key is not None:
+                            state[key] = LOOKUP_FAILED
+                        if not isinstance(e, aio.TimeoutError):
+                            self.logger.debug('KrpcProtocol.lookup|query failed|error=%s', e)
+                        elif key is not None:
+                            self.dht.failed(key)
+                        continue
+
+                    # responded node
+                    self.dht.put(node)
+                    self.dht.seen(node.data)
+                    if key != node.data:
+                        if key is not None:
+                            state[key] = LOOKUP_FAILED
+                        if node.data not in candidates and node.data != self.node.data:
+                            candidates[node.data] = pack_ip_port(*resp.remote)
+                            bisect.insort(shortlist, (int.from_bytes(node.data, 'big') ^ target_key, node.data))
+                    responded[node.data] = node
+                    state[node.data] = LOOKUP_RESPONDED
+
+                    # closer nodes and peers
+                    add_candidates(nodes)
+                    self.dht.put_compact(nodes)
+                    if query_type == QueryType.GET_PEERS and resp.has_values():
+                        values = compact_ip_ports(resp.get_compact_values())
+                        if on_peers is not None:
+                            on_peers(values)
+                        peers.update(values)
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+        ret = [responded[key] for _, key in shortlist if state.get(key) == LOOKUP_RESPONDED][:k]
+        return ret, peers
+
+    async def bootstrap_by_find_node(self, addrs, timeout=3) -> set[Node]:
+        try:
+            nodes, _ = await aio.wait_for(self.lookup(self.node.data, addrs=addrs), timeout)
+        except aio.TimeoutError:
+            nodes = []
+        self.logger.info('KrpcProtocol.bootstrap_by_find_node|found_counts=%d|dht_size=%d', len(nodes), len(self.dht))
+        return set(nodes)
 
     async def bootstrap_by_get_peers(self, info_hash: bytes, addrs, timeout: int = 10) -> tuple[set[Node], set]:
-        addrs = set(addrs)
-        nodes = set()
-        peers = set()
-        start_time = time.time()
-        while len(addrs) > 0 and len(peers) == 0 and time.time() - start_time < timeout:
-            results = await self.batch_request((self.get_peers(info_hash, x) for x in addrs))
-            ns, vals = set(), set()
-            for resp in results:
-                ns = resp.get_nodes()
-                vals = resp.get_values()
-                addrs.remove(resp.remote)
-            addrs |= {x.information.addr for x in ns}
-            nodes |= set(ns)
-            peers |= set(vals)
-            self.logger.info(
-                'KrpcProtocol.bootstrap_by_get_peers|responded_nodes=%d|found_nodes=%d|found_peers=%d|addrs=%s',
-                len(results),
-                len(nodes),
-                len(peers),
-                addrs,
+        try:
+            nodes, peers = await aio.wait_for(
+                self.lookup(info_hash, QueryType.GET_PEERS, addrs=addrs),
+                timeout,
             )
+        except aio.TimeoutError:
+            nodes, peers = [], set()
+        self.logger.info(
+            'KrpcProtocol.bootstrap_by_get_peers|found_nodes=%d|found_peers=%d',
+            len(nodes),
+            len(peers),
+        )
+        return set(nodes), peers
+
+    async def iter_peers(self, info_hash: bytes, addrs: Iterable = None, timeout=10, **kwargs):
+        """
+        yield distinct (ip, port) peers of `info_hash` as get_peers responses arrive, locally announced
+        peers first. the lookup runs until it converges or `timeout` expires, and is cancelled as soon
+        as the generator is closed, so close it when you stop early
+
+        Examples:
+        >>> async with contextlib.aclosing(protocol.iter_peers(info_hash)) as peers:
+        ...     async for ip, port in peers:
+        ...         break
+        """
+        if addrs is None:
+            addrs = self.resolver.addrs if len(self.dht) < self.dht.k else ()
+        distinct = set()
+        for peer in decompress_ip_port(self.peers.get(info_hash)):
+            distinct.add(peer)
+            yield peer
 
-        return nodes, peers
+        loop = aio.get_running_loop()
+        queue = aio.Queue()
+        task = loop.create_task(self.lookup(info_hash, QueryType.GET_PEERS, addrs, on_peers=queue.put_nowait, **kwargs))
+        task.add_done_callback(lambda _: queue.put_nowait(None))
+        deadline = loop.time() + timeout
+        try:
+            while True:
+                try:
+                    values = await aio.wait_for(queue.get(), deadline - loop.time())
+                except aio.TimeoutError:
+                    return
+                if values is None:
+                    task.result()
+                    return
+                for peer in values:
+                    if peer not in distinct:
+                        distinct.add(peer)
+                        yield peer
+        finally:
+            task.cancel()
 
     async def bootstrap(self):
-        addrs = set(self.bootstrap_addrs)
         try:
             while True:
-                nodes = await self.bootstrap_by_find_node(addrs, timeout=2)
-                if len(nodes):
-                    addrs |= nodes
+                addrs = await self.resolver.get() if len(self.dht) < self.dht.k else ()
+                await self.bootstrap_by_find_node(addrs, timeout=30)
                 await aio.sleep(10)
         except Exception as e:
             self.logger.error('KrpcProtocol.bootstrap|error while bootstrap|error=%s', e)
 
+    async def revalidate(self, keys: Sequence[bytes], concurrency=16, timeout=1):
+        """ ping nodes restored from a snapshot, the silent ones are removed from the routing table """
+        sem = aio.Semaphore(concurrency)
+        removed = 0
+
+        async def _check(key):
+            nonlocal removed
+            async with sem:
+                if key not in self.dht:
+                    return
+                node = self.dht.get_node(key)
+                if node.information.addr is None:
+                    return
+                try:
+                    await self.do_request(PingRequest(arguments=dict(id=self.node.data)), node.information.addr,
+                                          timeout=timeout, retry=2)
+                except aio.TimeoutError:
+                    if key in self.dht:
+                        self.dht.remove(node)
+                        removed += 1
+                except Exception as e:
+                    self.logger.warning('KrpcProtocol.revalidate|error=%s|node=%s', e, key.hex())
+
+        await aio.gather(*[_check(x) for x in keys])
+        self.logger.info('KrpcProtocol.revalidate|checked=%d|removed=%d', len(keys), removed)
+
+    async def check_node(self, key: bytes, timeout=1) -> bool:
+        """ ping a routing table node, a silent node counts a failure and may give way to a replacement """
+        if key not in self.dht:
+            return False
+        addr = self.dht.get_node(key).addr
+        if addr is None:
+            return False
+        try:
+            resp = await self.do_request(PingRequest(arguments=dict(id=self.node.data)), addr, retry=1, timeout=timeout)
+        except aio.TimeoutError:
+            resp = None
+        if resp is None or isinstance(resp, ErrorResponse) or resp.get_queried_id() != key:
+            self.dht.failed(key)
+            return False
+        return True
+
+    async def ping_pending(self, interval=1, batch=32, timeout=1):
+        """ background task, ping the least recently seen nodes of full buckets in batches """
+        while True:
+            await aio.sleep(interval)
+            keys = self.dht.take_pending(batch)
+            if not keys:
+                continue
+            for key, ret in zip(keys, await aio.gather(*[self.check_node(x, timeout) for x in keys],
+                                                       return_exceptions=True)):
+                if isinstance(ret, Exception):
+                    self.logger.warning('KrpcProtocol.ping_pending|error=%s|node=%s', ret, key.hex())
+
+    async def refresh(self, interval=900, check=60):
+        """ background task, look up a random id in every bucket which did not change within `interval` """
+        while True:
+            await aio.sleep(check)
+            for index in self.dht.stale_buckets(interval):
+                try:
+                    await self.lookup(self.dht.random_id(index))
+                except Exception as e:
+                    self.logger.warning('KrpcProtocol.refresh|error=%s|bucket=%d', e, index)
+                # a bucket nobody answered for waits another interval
+                self.dht.buckets[index].changed = time.monotonic()
+
+    def dump_snapshot(self):
+        """ synchronously write routing table and peers to `snapshot_path` """
+        snapshot.dump(self.snapshot_path, self.node.data, self.dht.to_compact(), snapshot.encode_peers(self.peers.items()))
+
+    async def checkpoint(self, interval):
+        loop = aio.get_running_loop()
+        while True:
+            await aio.sleep(interval)
+            # copy the tables on the loop, write them in the default executor
+            nodes, peers = self.dht.to_compact(), snapshot.encode_peers(self.peers.items())
+            try:
+                await loop.run_in_executor(None, snapshot.dump, self.snapshot_path, self.node.data, nodes, peers)
+            except OSError as e:
+                self.logger.error('KrpcProtocol.checkpoint|error=%s|path=%s', e, self.snapshot_path)
+            else:
+                self.logger.info('KrpcProtocol.checkpoint|nodes=%d|peers=%d', len(nodes), len(peers))
+
 
 # sync apis
 
@@ -768,36 +1076,55 @@ class Krpc:
     root: Node
     address: tuple[str, int]
     sock: socket.socket
+    transport: aio.DatagramTransport
     core: KrpcProtocol
     protocol_class = KrpcProtocol
+    dht_class = DHT
+    peer_store_class = PeerStore
     bootstrap_addrs = dht_bootstrap_address
 
     def __init__(
             self, root=None, loop=None, max_kbucket_length=16, address=None, logger=None,
-            protocol_class=None, bootstrap_addrs=None,
+            protocol_class=None, bootstrap_addrs=None, snapshot_path=None,
     ):
         # set default value
+        if snapshot_path is None:
+            snapshot_path = DEFAULT_KRPC_CONFIG.get('snapshot')
+        if not logger:
+            logger = logging.getLogger(DEFAULT_KRPC_CONFIG['logger'])
+        snap = self.load_snapshot(snapshot_path, logger) if snapshot_path else None
         if not root:
-            root = DEFAULT_KRPC_CONFIG['root_node'] or Node.create_random()
+            root = DEFAULT_KRPC_CONFIG['root_node'] or (Node(snap.root) if snap else Node.create_random())
         if not loop:
             loop = aio.new_event_loop()
         if not protocol_class:
-            protocol_class = KrpcProtocol
+            protocol_class = self.protocol_class
         if not bootstrap_addrs:
             bootstrap_addrs = []
         if not address:
             address = DEFAULT_KRPC_CONFIG['address']
-        if not logger:
-            logger = logging.getLogger(DEFAULT_KRPC_CONFIG['logger'])
 
         self.loop = loop
-        self.dht = DHT(root, max_kbucket_length)
+        self.dht = self.dht_class(root, max_kbucket_length)
         self.root = root
         self.address = address
         self.thread = None
         self.logger = logger
         self.protocol_class = protocol_class
-        self.bootstrap_addrs.extend(bootstrap_addrs)
+        self.bootstrap_addrs = self.bootstrap_addrs + list(bootstrap_addrs)
+        self.snapshot_path = snapshot_path
+        self.peers = self.peer_store_class()
+        self.restored = []
+        self._callers = None    # semaphore of the krpc loop, limits concurrent `call`s
+
+        # warm start, restored nodes answer find_node at once and are revalidated once the server runs
+        if snap is not None and len(snap.root) == len(root.data):
+            self.dht.put_compact(snap.nodes)
+            for info_hash, peer, t in snapshot.decode_peers(snap.peers):
+                self.peers.announce(info_hash, peer, now=t)
+            self.restored = [x for x in map(bytes, snap.nodes['id']) if x in self.dht]
+            self.logger.warning('Krpc.__init__|restored snapshot|nodes=%d|peers=%d|path=%s',
+                                len(self.dht), len(self.peers), snapshot_path)
 
     def start(self):
         if self.is_running():
@@ -809,25 +1136,135 @@ class Krpc:
     def stop(self):
         if self.thread is None:
             raise RuntimeError('Krpc is not running, can not stop')
-        self.loop.stop()
+        self.loop.call_soon_threadsafe(self.loop.stop)
         self.thread.join()
         self.sock.close()
 
+    def create_endpoint(self):
+        config = DEFAULT_KRPC_CONFIG
+        if config.get('batch_reader', True):
+            return create_batch_endpoint(
+                self.loop, self.get_protocol, self.create_socket(),
+                batch=config.get('recv_batch', 64),
+                send_queue=config.get('send_queue', 4096),
+                send_rate=config.get('send_rate', 0),
+            )
+        return self.loop.create_datagram_endpoint(self.get_protocol, sock=self.create_socket())
+
     def run(self):
-        task = self.loop.create_task(self.loop.create_datagram_endpoint(
-            self.get_protocol,
-            sock=self.create_socket(),
-        ))
+        # the listener thread lives as long as the server, None if another server started it already
+        listener = None
+        if DEFAULT_KRPC_CONFIG.get('background_logging', True):
+            listener = start_background_logging(self.logger)
+        try:
+            self._serve()
+        finally:
+            if listener is not None:
+                stop_background_logging(self.logger, listener)
+
+    def _serve(self):
+        task = self.loop.create_task(self.create_endpoint())
         self.logger.warning('[Krpc.run]starting krpc server!')
         trans, self.core = self.loop.run_until_complete(task)
+        self.transport = trans
+        interval = DEFAULT_KRPC_CONFIG.get('loop_lag_interval', 0.5)
+        if interval:
+            self.core._tasks['loop_lag'] = self.loop.create_task(monitor_loop_lag(self.core.metrics.loop_lag, interval))
         self.logger.warning('[Krpc.run]started krpc server!')
         self.loop.run_forever()
         trans.close()   # close transport
+        if self.snapshot_path:
+            try:
+                self.core.dump_snapshot()
+            except OSError as e:
+                self.logger.error('Krpc.run|error while dump snapshot|error=%s', e)
         self.logger.warning('[Krpc.run]krpc server has quit!')
 
     def is_running(self):
         return self.thread and self.thread.is_alive()
 
+    # thread safe client apis, coroutines of the krpc loop must never be awaited from another loop
+
+    async def call(self, func, *args, deadline=None, **kwargs):
+        """
+        run coroutine function `func(*args, **kwargs)` on the krpc loop and await its result from any
+        other event loop. at most `max_callers` calls run at once, the others wait on the krpc loop,
+        and `deadline` seconds cover both waiting and running. cancelling the caller cancels the call
+
+        Examples:
+        >>> k = krpc.get_default()
+        >>> resp = await k.call(k.core.ping, ('1.2.3.4', 6881), deadline=3)
+        """
+        if deadline is None:
+            deadline = DEFAULT_KRPC_CONFIG.get('call_deadline', 10)
+        if aio.get_running_loop() is self.loop:
+            return await aio.wait_for(func(*args, **kwargs), deadline)
+        if not self.is_running():
+            raise RuntimeError('Krpc is not running, can not call')
+        future = aio.run_coroutine_threadsafe(self._call(func, args, kwargs, deadline), self.loop)
+        return await aio.wrap_future(future)
+
+    def call_sync(self, func, *args, deadline=None, **kwargs):
+        """ `call` for threads without an event loop, like sync django views """
+        if deadline is None:
+            deadline = DEFAULT_KRPC_CONFIG.get('call_deadline', 10)
+        if not self.is_running():
+            raise RuntimeError('Krpc is not running, can not call')
+        future = aio.run_coroutine_threadsafe(self._call(func, args, kwargs, deadline), self.loop)
+        try:
+            # a stalled krpc loop can not enforce the deadline itself
+            return future.result(deadline + 1)
+        except BaseException:
+            future.cancel()
+            raise
+
+    async def _call(self, func, args, kwargs, deadline):
+        if self._callers is None:
+            self._callers = aio.Semaphore(DEFAULT_KRPC_CONFIG.get('max_callers', 64))
+
+        async def _run():
+            async with self._callers:
+                return await func(*args, **kwargs)
+
+        return await aio.wait_for(_run(), deadline)
+
+    async def iter_peers(self, info_hash: bytes, timeout=10, **kwargs):
+        """
+        `KrpcProtocol.iter_peers` for coroutines of another event loop, like django views. the lookup
+        runs on the krpc loop and peers are handed over one by one, closing the generator cancels it
+
+        Examples:
+        >>> async for ip, port in krpc.get_default().iter_peers(info_hash):
+        ...     print(ip, port)
+        """
+        loop = aio.get_running_loop()
+        if loop is self.loop:
+            async with contextlib.aclosing(self.core.iter_peers(info_hash, timeout=timeout, **kwargs)) as peers:
+                async for peer in peers:
+                    yield peer
+            return
+
+        queue = aio.Queue()
+
+        async def pump():
+            try:
+                async with contextlib.aclosing(self.core.iter_peers(info_hash, timeout=timeout, **kwargs)) as peers:
+                    async for peer in peers:
+                        loop.call_soon_threadsafe(queue.put_nowait, peer)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, None)
+
+        future = aio.run_coroutine_threadsafe(pump(), self.loop)
+        try:
+            while True:
+                peer = await queue.get()
+                if peer is None:
+                    break
+                yield peer
+            await aio.wrap_future(future)
+        finally:
+            future.cancel()
+
     def create_socket(self):
         if hasattr(self, 'sock') and isinstance(self.sock, socket.socket):
             try:
@@ -836,16 +1273,24 @@ class Krpc:
                 pass
 
         # open a new DHT_SOCK
+        # SO_REUSEPORT must be set before bind, otherwise the port can not be shared between processes
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
-        sock.bind(self.address)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, True)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 14)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 14)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, DEFAULT_KRPC_CONFIG.get('rcvbuf', 1 << 21))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, DEFAULT_KRPC_CONFIG.get('sndbuf', 1 << 20))
+        sock.bind(self.address)
         self.sock = sock
         self.logger.warning('Krpc.create_socket|fileno=%d|address=%s', sock.fileno(), self.address)
         return sock
 
+    @staticmethod
+    def load_snapshot(path, logger):
+        try:
+            return snapshot.load(path)
+        except (OSError, snapshot.SnapshotError) as e:
+            logger.error('Krpc.load_snapshot|ignore broken snapshot|error=%s|path=%s', e, path)
+
     def get_protocol_class(self):
         return self.protocol_class
 
@@ -856,6 +1301,10 @@ class Krpc:
             dht=self.dht,
             logger=self.logger,
             bootstrap_addrs=self.bootstrap_addrs,
+            peers=self.peers,
+            snapshot_path=self.snapshot_path,
+            checkpoint_interval=DEFAULT_KRPC_CONFIG.get('checkpoint_interval', 300),
+            revalidate=self.restored,
         )
         return obj
 
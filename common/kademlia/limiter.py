@@ -0,0 +1,164 @@
+import asyncio as aio
+import logging
+import time
+from collections import OrderedDict
+
+"""
+    inbound query limits
+
+    `RateLimiter` is a per source token bucket table with a bounded number of sources,
+    `VerifyQueue` collects requesters which should be pinged before they enter the routing table,
+    each requester is queued at most once and the pings are sent at a fixed rate. requesters which
+    were verified, or failed verification, within `ttl` seconds are not queued again
+"""
+
+
+class RateLimiter:
+    """
+    Examples:
+    >>> limiter = RateLimiter(rate=20, burst=40)
+    >>> limiter.allow('1.2.3.4')
+    True
+    """
+
+    def __init__(self, rate=20, burst=40, max_sources=1 << 16):
+        self.rate = rate
+        self.burst = burst
+        self.max_sources = max_sources
+        self._buckets = OrderedDict()     # source -> [tokens, last refill], least recently seen first
+
+        # counters
+        self.allowed = 0
+        self.limited = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def allow(self, source, now=None) -> bool:
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(source)
+        if bucket is None:
+            if len(self._buckets) >= self.max_sources:
+                self._buckets.popitem(last=False)
+            bucket = self._buckets[source] = [float(self.burst), now]
+        else:
+            self._buckets.move_to_end(source)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] < 1:
+            self.limited += 1
+            return False
+        bucket[0] -= 1
+        self.allowed += 1
+        return True
+
+    def stats(self) -> dict:
+        return dict(sources=len(self._buckets), allowed=self.allowed, limited=self.limited)
+
+
+class VerifyQueue:
+    """
+    Examples:
+    >>> queue = VerifyQueue(protocol.verify_requester, rate=50)
+    >>> queue.push(node_id, addr)
+    >>> task = loop.create_task(queue.run())
+    """
+
+    def __init__(self, verify, rate=50, concurrency=16, maxsize=4096, ttl=600, max_recent=1 << 16, logger=None):
+        self.verify = verify    # coroutine function (key, addr)
+        self.rate = rate
+        self.concurrency = concurrency
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_recent = max_recent
+        self.logger = logger or logging.getLogger('krpc')
+
+        self._pending = OrderedDict()   # key -> addr
+        self._recent = OrderedDict()    # key -> time its verification started, oldest first
+        self._wakeup = None
+
+        # counters
+        self.pushed = 0
+        self.duplicated = 0
+        self.recent = 0
+        self.overflowed = 0
+        self.verified = 0
+        self.failed = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, key):
+        return key in self._pending
+
+    def push(self, key, addr, now=None) -> bool:
+        """ queue a requester, False if it is queued already, verified recently or the queue is full """
+        if key in self._pending:
+            self.duplicated += 1
+            return False
+        started = self._recent.get(key)
+        if started is not None:
+            now = time.monotonic() if now is None else now
+            if now - started < self.ttl:
+                self.recent += 1
+                return False
+            del self._recent[key]
+        if len(self._pending) >= self.maxsize:
+            self.overflowed += 1
+            return False
+        self._pending[key] = addr
+        self.pushed += 1
+        if self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+        return True
+
+    async def run(self):
+        """ background task, verify queued requesters at most `rate` per second """
+        loop = aio.get_running_loop()
+        sem = aio.Semaphore(self.concurrency)
+        tasks = set()
+        try:
+            while True:
+                if not self._pending:
+                    self._wakeup = loop.create_future()
+                    await self._wakeup
+                    continue
+                await sem.acquire()
+                key, addr = self._pending.popitem(last=False)
+                self._remember(key)
+                task = loop.create_task(self._verify(key, addr))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _: sem.release())
+                await aio.sleep(1 / self.rate)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _remember(self, key):
+        # recorded when the verification starts, which also covers the ones in flight
+        now = time.monotonic()
+        while self._recent:
+            oldest = next(iter(self._recent.values()))
+            if now - oldest < self.ttl and len(self._recent) < self.max_recent:
+                break
+            self._recent.popitem(last=False)
+        self._recent[key] = now
+
+    async def _verify(self, key, addr):
+        try:
+            await self.verify(key, addr)
+        except (aio.TimeoutError, OSError):
+            self.failed += 1
+        except Exception as e:
+            self.failed += 1
+            self.logger.warning('VerifyQueue.verify|error=%s|addr=%s', e, addr)
+        else:
+            self.verified += 1
+
+    def stats(self) -> dict:
+        return dict(
+            pending=len(self._pending), pushed=self.pushed, duplicated=self.duplicated, recent=self.recent,
+            overflowed=self.overflowed, verified=self.verified, failed=self.failed,
+        )
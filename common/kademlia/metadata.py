@@ -0,0 +1,323 @@
+import asyncio as aio
+import contextlib
+import hashlib
+import logging
+import math
+import struct
+
+import bencodepy
+
+from . import codec
+from .bittorrent import BitTorrentProtocol, MessageType
+from .constants import DEFAULT_BIT_TORRENT_CONFIG
+from .metrics import BitTorrentMetrics
+from .node import Node
+
+"""
+    ut_metadata fetcher
+
+    `MetadataFetcher.fetch` resolves an info hash to its info dictionary from peers, like the ones
+    `KrpcProtocol.iter_peers` yields. up to `peers_per_torrent` peers of one torrent are connected at
+    once and every connected peer requests a missing piece, so the pieces come in parallel. all
+    torrents share `max_connections`, a peer which does not answer the handshake or a piece in time
+    is dropped for the next one. the joined pieces must hash to the info hash, otherwise they are
+    thrown away and the remaining peers start over
+
+    Examples:
+    >>> fetcher = MetadataFetcher()
+    >>> info = await fetcher.resolve(krpc.get_default().core, info_hash)
+    >>> parse_info(info)['name']
+
+    refer:
+     BEP 9 Extension for Peers to Send Metadata Files - http://bittorrent.org/beps/bep_0009.html
+     BEP 10 Extension Protocol - http://bittorrent.org/beps/bep_0010.html
+"""
+
+METADATA_PIECE_SIZE = 1 << 14
+UT_METADATA_ID = 3     # our extended message id of ut_metadata
+
+MSG_REQUEST = 0
+MSG_DATA = 1
+MSG_REJECT = 2
+
+
+class MetadataError(Exception):
+    pass
+
+
+class MetadataProtocol(BitTorrentProtocol):
+    """ connecting side, `ready` is the metadata size the peer announced in its extended handshake """
+
+    def __init__(self, peer_id: bytes, loop, logger, info_hash: bytes, metrics: BitTorrentMetrics = None):
+        super().__init__(peer_id, loop, logger, info_hash=info_hash, metrics=metrics)
+        self.ready = loop.create_future()
+        self.remote_id = None       # ut_metadata message id of the peer
+        self._requests = dict()     # piece -> future of its data
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.status = self.STATUS_HANDSHAKING
+        self.write(self.message.handshake())
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        error = ConnectionResetError('MetadataProtocol.connection_lost|error=%s' % exc)
+        for future in [self.ready] + list(self._requests.values()):
+            if not future.done():
+                future.set_exception(error)
+        self._requests.clear()
+        # nobody may wait for `ready` any more
+        if self.ready.done() and not self.ready.cancelled():
+            self.ready.exception()
+
+    def handshake_received(self, data):
+        super().handshake_received(data)
+        if self.status != self.STATUS_NORMAL:
+            return
+        if not self.message.features.is_support_extended_protocol():
+            return self.fail(MetadataError('MetadataProtocol.handshake_received|no extension protocol'))
+        self.write(self.message.extended_handshake({'ut_metadata': UT_METADATA_ID}))
+
+    def message_received(self, msg_id: int, payload: memoryview):
+        if msg_id != MessageType.EXTENDED or not payload:
+            return
+        try:
+            if payload[0] == 0:
+                self.extended_handshake_received(bencodepy.decode(bytes(payload[1:])))
+            elif payload[0] == UT_METADATA_ID:
+                self.metadata_received(bytes(payload[1:]))
+        except (bencodepy.BencodeDecodeError, codec.DecodeError, AttributeError, TypeError) as e:
+            self.fail(MetadataError('MetadataProtocol.message_received|malformed message|error=%s' % e))
+
+    def extended_handshake_received(self, handshake: dict):
+        if self.ready.done():
+            return
+        self.remote_id = handshake.get(b'm', {}).get(b'ut_metadata')
+        size = handshake.get(b'metadata_size')
+        if not isinstance(self.remote_id, int) or not 0 < self.remote_id < 256 or not isinstance(size, int) or size <= 0:
+            return self.fail(MetadataError('MetadataProtocol.extended_handshake_received|no ut_metadata'))
+        self.ready.set_result(size)
+
+    def metadata_received(self, data: bytes):
+        header, end = codec.decode_value(data)
+        future = self._requests.pop(header.get(b'piece'), None)
+        if future is None or future.done():
+            return
+        if header.get(b'msg_type') == MSG_DATA:
+            future.set_result(data[end:])
+        else:
+            future.set_exception(MetadataError('MetadataProtocol.metadata_received|rejected'))
+
+    def request(self, piece: int) -> aio.Future:
+        future = self._requests.get(piece)
+        if future is None:
+            future = self._requests[piece] = self.loop.create_future()
+            body = bencodepy.encode({'msg_type': MSG_REQUEST, 'piece': piece})
+            self.write(struct.pack('>IBB', len(body) + 2, MessageType.EXTENDED, self.remote_id) + body)
+        return future
+
+    def fail(self, exc: Exception):
+        if not self.ready.done():
+            self.ready.set_exception(exc)
+        self.disconnect()
+
+
+class _Metadata:
+    """ pieces of one info dictionary, shared by the peers of one `fetch` """
+
+    def __init__(self, info_hash: bytes, max_size: int):
+        self.info_hash = info_hash
+        self.max_size = max_size
+        self.size = None
+        self.pieces = []        # bytes or None
+        self.requested = []     # number of peers requesting each piece
+        self.done = aio.get_running_loop().create_future()
+        self.changed = aio.Event()
+
+    def set_size(self, size: int):
+        if self.size is None:
+            if size > self.max_size:
+                raise MetadataError('_Metadata.set_size|metadata too large|size=%d' % size)
+            self.size = size
+            count = math.ceil(size / METADATA_PIECE_SIZE)
+            self.pieces, self.requested = [None] * count, [0] * count
+        elif size != self.size:
+            raise MetadataError('_Metadata.set_size|size differs|size=%d|expected=%d' % (size, self.size))
+
+    def next_piece(self) -> int | None:
+        """ the missing piece with the fewest requests, slow peers get company instead of waiting """
+        missing = [i for i, x in enumerate(self.pieces) if x is None]
+        if not missing:
+            return None
+        return min(missing, key=self.requested.__getitem__)
+
+    def put(self, piece: int, data: bytes):
+        expected = min(METADATA_PIECE_SIZE, self.size - piece * METADATA_PIECE_SIZE)
+        if len(data) != expected:
+            raise MetadataError('_Metadata.put|wrong piece length|piece=%d|length=%d' % (piece, len(data)))
+        if self.pieces[piece] is None:
+            self.pieces[piece] = data
+        if all(x is not None for x in self.pieces) and not self.done.done():
+            info = b''.join(self.pieces)
+            if hashlib.sha1(info).digest() == self.info_hash:
+                self.done.set_result(info)
+            else:
+                # some peer lied, nobody knows which one, every piece is fetched again
+                self.pieces = [None] * len(self.pieces)
+                raise MetadataError('_Metadata.put|sha1 mismatch')
+        self.changed.set()
+        self.changed.clear()
+
+
+class MetadataFetcher:
+    """ runs on one event loop, `max_connections` is shared by every concurrent `fetch` """
+
+    def __init__(self, peer_id: bytes = None, max_connections=None, peers_per_torrent=None, connect_timeout=None,
+                 piece_timeout=None, max_metadata_size=None, logger=None):
+        config = DEFAULT_BIT_TORRENT_CONFIG
+        self.peer_id = peer_id or Node.create_random().data
+        self.max_connections = max_connections or config.get('metadata_connections', 256)
+        self.peers_per_torrent = peers_per_torrent or config.get('metadata_peers_per_torrent', 8)
+        self.connect_timeout = connect_timeout or config.get('metadata_connect_timeout', 5)
+        self.piece_timeout = piece_timeout or config.get('metadata_piece_timeout', 10)
+        self.max_metadata_size = max_metadata_size or config.get('max_metadata_size', 8 << 20)
+        self.logger = logger or logging.getLogger(config['logger'])
+        self.metrics = BitTorrentMetrics()
+        self._connections = None    # semaphore, created on the loop
+
+        # counters
+        self.fetched = 0
+        self.failed = 0
+
+    def stats(self) -> dict:
+        return dict(fetched=self.fetched, failed=self.failed, connections=len(self.metrics.connections),
+                    handshakes=self.metrics.handshakes, handshake_failures=self.metrics.handshake_failures)
+
+    async def fetch(self, info_hash: bytes, peers, timeout=60) -> bytes:
+        """
+        bencoded info dictionary of `info_hash`, raise MetadataError if no peer served it or
+        TimeoutError after `timeout` seconds
+
+        :param peers: iterable or async iterable of (ip, port), it is consumed while peers are needed
+        """
+        if self._connections is None:
+            self._connections = aio.Semaphore(self.max_connections)
+        loop = aio.get_running_loop()
+        metadata = _Metadata(info_hash, self.max_metadata_size)
+        slots = aio.Semaphore(self.peers_per_torrent)
+        tasks = set()
+
+        async def connect_peers():
+            tried = set()
+            async with contextlib.aclosing(_aiter(peers)) as addrs:
+                async for addr in addrs:
+                    addr = tuple(addr)
+                    if addr in tried:
+                        continue
+                    tried.add(addr)
+                    await slots.acquire()
+                    if metadata.done.done():
+                        return
+                    task = loop.create_task(self._peer(metadata, addr))
+                    task.add_done_callback(lambda _: slots.release())
+                    tasks.add(task)
+            await aio.gather(*tasks, return_exceptions=True)
+            if not metadata.done.done():
+                metadata.done.set_exception(MetadataError('MetadataFetcher.fetch|no peer served the metadata|peers=%d' % len(tried)))
+
+        producer = loop.create_task(connect_peers())
+        try:
+            info = await aio.wait_for(aio.shield(metadata.done), timeout)
+        except BaseException:
+            self.failed += 1
+            raise
+        finally:
+            producer.cancel()
+            for task in tasks:
+                task.cancel()
+            if metadata.done.done() and not metadata.done.cancelled():
+                metadata.done.exception()
+        self.fetched += 1
+        return info
+
+    async def _peer(self, metadata: _Metadata, addr):
+        loop = aio.get_running_loop()
+        async with self._connections:
+            try:
+                transport, protocol = await aio.wait_for(loop.create_connection(
+                    lambda: MetadataProtocol(self.peer_id, loop, self.logger, metadata.info_hash, self.metrics),
+                    *addr,
+                ), self.connect_timeout)
+            except (OSError, aio.TimeoutError):
+                return
+            try:
+                metadata.set_size(await aio.wait_for(protocol.ready, self.connect_timeout))
+                while not metadata.done.done():
+                    piece = metadata.next_piece()
+                    if piece is None:
+                        await metadata.changed.wait()
+                        continue
+                    metadata.requested[piece] += 1
+                    try:
+                        data = await aio.wait_for(protocol.request(piece), self.piece_timeout)
+                    finally:
+                        metadata.requested[piece] -= 1
+                    metadata.put(piece, data)
+            except (MetadataError, ConnectionError, aio.TimeoutError) as e:
+                self.logger.debug('MetadataFetcher._peer|error=%s|addr=%s|info_hash=%s', e, addr, metadata.info_hash.hex())
+            finally:
+                transport.close()
+
+    async def resolve(self, protocol, info_hash: bytes, timeout=60) -> bytes:
+        """ `fetch` from the peers a get_peers lookup of `protocol`, a `KrpcProtocol`, finds """
+        return await self.fetch(info_hash, protocol.iter_peers(info_hash, timeout=timeout), timeout=timeout)
+
+    async def resolve_many(self, protocol, info_hashes, concurrency=32, timeout=60):
+        """ yield (info_hash, info dictionary or the exception) as they finish, `concurrency` at a time """
+        loop = aio.get_running_loop()
+        pending = set()
+        info_hashes = iter(info_hashes)
+
+        async def _one(info_hash):
+            try:
+                return info_hash, await self.resolve(protocol, info_hash, timeout)
+            except (MetadataError, aio.TimeoutError) as e:
+                return info_hash, e
+
+        try:
+            while True:
+                for info_hash in info_hashes:
+                    pending.add(loop.create_task(_one(info_hash)))
+                    if len(pending) >= concurrency:
+                        break
+                if not pending:
+                    return
+                done, pending = await aio.wait(pending, return_when=aio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+async def _aiter(peers):
+    if hasattr(peers, '__aiter__'):
+        async for x in peers:
+            yield x
+    else:
+        for x in peers:
+            yield x
+
+
+def parse_info(info: bytes) -> dict:
+    """ name, total length and [(path, length)] of files of a bencoded info dictionary """
+    d = bencodepy.decode(info)
+    name = d.get(b'name.utf-8', d.get(b'name', b'')).decode('utf8', 'replace')
+    if b'files' in d:
+        files = [
+            ('/'.join(x.decode('utf8', 'replace') for x in f.get(b'path.utf-8', f.get(b'path', []))), f.get(b'length', 0))
+            for f in d[b'files']
+        ]
+    else:
+        files = [(name, d.get(b'length', 0))]
+    return dict(name=name, length=sum(x[1] for x in files), files=files, piece_length=d.get(b'piece length'))
@@ -0,0 +1,248 @@
+import asyncio as aio
+import bisect
+
+try:
+    from prometheus_client import REGISTRY, CollectorRegistry, generate_latest
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+except ImportError:     # optional, `django-prometheus` brings it in the web deployment
+    REGISTRY = None
+
+"""
+    krpc and bittorrent metrics
+
+    the event loop only bumps plain counters, `KrpcCollector` and `BitTorrentCollector` turn them and
+    the live tables into prometheus metric families when the registry is scraped, so nothing is
+    formatted or locked on the loop. the daemon renders them with `exposition` for its `metrics` rpc,
+    in process servers can `register` them into the default registry exported by `django_prometheus`
+
+    label values are restricted to known query types and error codes, anything else is `other`,
+    remote peers can not blow up the number of series
+
+    refer:
+     https://prometheus.github.io/client_python/collector/custom/
+"""
+
+RTT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.2, 0.4, 0.8, 1.6, 3.2)
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Histogram:
+    """
+    Examples:
+    >>> h = Histogram((0.1, 1))
+    >>> h.observe(0.5)
+    >>> h.cumulative()
+    [('0.1', 0), ('1', 1), ('+Inf', 1)]
+    """
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds=RTT_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)     # the last one is +Inf
+        self.sum = 0.0
+
+    def __len__(self):
+        return sum(self.counts)
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        counts, total, ret = list(self.counts), 0, []
+        for bound, count in zip(self.bounds + (float('inf'),), counts):
+            total += count
+            ret.append(('+Inf' if bound == float('inf') else '%g' % bound, total))
+        return ret
+
+
+def _label(value, known) -> str:
+    if value is None:
+        return ''
+    return value if value in known else 'other'
+
+
+class KrpcMetrics:
+    """ owned by `KrpcProtocol`, every key of the dicts is (kind, query) """
+    queries = frozenset(('ping', 'find_node', 'get_peers', 'announce_peer', 'sample_infohashes'))
+    errors = frozenset(('201', '202', '203', '204'))
+
+    def __init__(self):
+        self.packets_in = dict()
+        self.packets_out = dict()
+        self.rtt = dict()       # query -> Histogram of do_request round trips
+        self.timeouts = dict()  # query -> timed out attempts
+        self.loop_lag = Histogram(LAG_BUCKETS)
+
+    def received(self, kind: str, sub: str = None):
+        key = (kind, _label(sub, self.errors if kind == 'e' else self.queries))
+        self.packets_in[key] = self.packets_in.get(key, 0) + 1
+
+    def sent(self, kind: str, sub: str = None):
+        key = (kind, _label(sub, self.queries))
+        self.packets_out[key] = self.packets_out.get(key, 0) + 1
+
+    def observe_rtt(self, query: str, seconds: float):
+        h = self.rtt.get(query)
+        if h is None:
+            h = self.rtt[query] = Histogram(RTT_BUCKETS)
+        h.observe(seconds)
+
+    def timeout(self, query: str):
+        self.timeouts[query] = self.timeouts.get(query, 0) + 1
+
+
+class BitTorrentMetrics:
+    """ shared by every `BitTorrentProtocol` of one `BitTorrent` server or client, or of one `Session` """
+
+    def __init__(self):
+        self.connections = set()    # live protocols
+        self.opened = 0
+        self.closed = 0
+        self.handshakes = 0
+        self.handshake_failures = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages_in = dict()   # message id -> count
+        self.loop_lag = Histogram(LAG_BUCKETS)
+
+    def connection_made(self, protocol):
+        self.connections.add(protocol)
+        self.opened += 1
+
+    def connection_lost(self, protocol):
+        if protocol in self.connections:
+            self.connections.discard(protocol)
+            self.closed += 1
+
+    def message_received(self, msg_id: int):
+        self.messages_in[msg_id] = self.messages_in.get(msg_id, 0) + 1
+
+
+async def monitor_loop_lag(histogram: Histogram, interval=0.5):
+    """ background task, how late the loop wakes up a sleeping coroutine is the loop lag """
+    loop = aio.get_running_loop()
+    while True:
+        start = loop.time()
+        await aio.sleep(interval)
+        histogram.observe(max(loop.time() - start - interval, 0.0))
+
+
+class KrpcCollector:
+    """
+    `source` returns the running `KrpcProtocol` or None, it is called in the scraping thread
+
+    Examples:
+    >>> register(KrpcCollector(lambda: getattr(krpc.get_default(), 'core', None)))
+    """
+
+    def __init__(self, source, prefix='krpc'):
+        self.source = source
+        self.prefix = prefix
+
+    def collect(self):
+        protocol = self.source()
+        if protocol is None or protocol.transactions is None:
+            return
+        p, metrics = self.prefix, protocol.metrics
+
+        for name, packets in (('received', metrics.packets_in), ('sent', metrics.packets_out)):
+            family = CounterMetricFamily(p + '_packets_' + name, 'krpc packets ' + name, labels=('kind', 'query'))
+            for (kind, query), count in dict(packets).items():
+                family.add_metric((kind, query), count)
+            yield family
+
+        family = HistogramMetricFamily(p + '_request_rtt_seconds', 'do_request round trip time', labels=('query', ))
+        for query, h in dict(metrics.rtt).items():
+            family.add_metric((query, ), h.cumulative(), h.sum)
+        yield family
+        family = CounterMetricFamily(p + '_request_timeouts', 'timed out do_request attempts', labels=('query', ))
+        for query, count in dict(metrics.timeouts).items():
+            family.add_metric((query, ), count)
+        yield family
+
+        trans = protocol.transactions.stats()
+        yield GaugeMetricFamily(p + '_transactions', 'outstanding transactions', value=trans['outstanding'])
+        for name in ('retries', 'responses', 'drifting'):
+            yield CounterMetricFamily(p + '_transaction_' + name, 'transaction ' + name, value=trans[name])
+
+        yield GaugeMetricFamily(p + '_routing_table_nodes', 'nodes in the routing table', value=len(protocol.dht))
+        family = GaugeMetricFamily(p + '_routing_table_bucket_nodes', 'nodes per k-bucket', labels=('bucket', ))
+        for i, bk in enumerate(protocol.dht.buckets):
+            if len(bk):
+                family.add_metric((str(i), ), len(bk))
+        yield family
+
+        yield GaugeMetricFamily(p + '_peer_store_peers', 'announced peers', value=len(protocol.peers))
+        yield GaugeMetricFamily(p + '_peer_store_torrents', 'torrents with peers', value=protocol.peers.torrents())
+
+        limiter, verify = protocol.limiter.stats(), protocol.verify_queue.stats()
+        yield CounterMetricFamily(p + '_queries_limited', 'queries dropped by the rate limiter', value=limiter['limited'])
+        yield GaugeMetricFamily(p + '_verify_queue', 'requesters waiting for verification', value=verify['pending'])
+        stats = getattr(protocol.transport, 'stats', None)
+        if stats is not None:
+            udp = stats()
+            yield CounterMetricFamily(p + '_kernel_dropped', 'datagrams dropped by the kernel', value=udp['kernel_dropped'])
+            yield CounterMetricFamily(p + '_send_dropped', 'replies dropped by the send queue', value=udp['send_dropped'])
+            yield GaugeMetricFamily(p + '_send_queue', 'queued replies', value=udp['send_queue'])
+
+        yield _lag_family(p, metrics.loop_lag)
+
+
+class BitTorrentCollector:
+    """ `source` returns the `BitTorrentMetrics` of a server or client, or None """
+
+    def __init__(self, source, prefix='bittorrent'):
+        self.source = source
+        self.prefix = prefix
+
+    def collect(self):
+        metrics = self.source()
+        if metrics is None:
+            return
+        p = self.prefix
+
+        family = GaugeMetricFamily(p + '_connections', 'open connections', labels=('status', ))
+        status = dict()
+        for protocol in list(metrics.connections):
+            name = protocol.STATUS.get(protocol.status, 'unknown')
+            status[name] = status.get(name, 0) + 1
+        for name, count in status.items():
+            family.add_metric((name, ), count)
+        yield family
+
+        for name in ('opened', 'closed', 'handshakes', 'handshake_failures'):
+            yield CounterMetricFamily(p + '_connections_' + name, 'connections ' + name, value=getattr(metrics, name))
+        yield CounterMetricFamily(p + '_received_bytes', 'bytes received', value=metrics.bytes_in)
+        yield CounterMetricFamily(p + '_sent_bytes', 'bytes sent', value=metrics.bytes_out)
+        family = CounterMetricFamily(p + '_messages_received', 'peer wire messages', labels=('type', ))
+        for msg_id, count in dict(metrics.messages_in).items():
+            family.add_metric((str(msg_id), ), count)
+        yield family
+
+        yield _lag_family(p, metrics.loop_lag)
+
+
+def _lag_family(prefix, h: Histogram):
+    family = HistogramMetricFamily(prefix + '_event_loop_lag_seconds', 'event loop lag')
+    family.add_metric((), h.cumulative(), h.sum)
+    return family
+
+
+def exposition(*collectors) -> bytes | None:
+    """ prometheus text format of `collectors` alone, None without prometheus_client """
+    if REGISTRY is None:
+        return None
+    registry = CollectorRegistry(auto_describe=False)
+    for collector in collectors:
+        registry.register(collector)
+    return generate_latest(registry)
+
+
+def register(collector, registry=None) -> bool:
+    """ add a collector to the default prometheus registry, False without prometheus_client """
+    registry = registry or REGISTRY
+    if registry is None:
+        return False
+    registry.register(collector)
+    return True
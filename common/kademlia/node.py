@@ -1,9 +1,10 @@
+import random
+import socket
 import time
 from collections import abc
 import codecs
 import numpy as np
 from collections import deque, namedtuple
-from functools import lru_cache
 from abc import abstractmethod, ABCMeta
 
 from common.utils import serializer
@@ -39,6 +40,10 @@ class NodeInfo(dict):
 
 class Node(metaclass=ABCMeta):
     """
+    node id as bytes plus the same id as an int, distances are `int ^ int` and bucket indexes are
+    `bit_length()` of the distance. addresses of routing table nodes live in the `DHT` arrays, the
+    `information` dict of a node is only created when somebody asks for it
+
     Exapmles:
     >>> a, b = Node.create_random(1), Node.create_random(1)
     >>> a
@@ -54,6 +59,7 @@ class Node(metaclass=ABCMeta):
     >>> a.bits
     160
     """
+    __slots__ = ('data', 'value', '_info')
 
     def __init__(self, data: bytes = None, base16=None, base64=None, ndarray: np.ndarray = None, info: NodeInfo = None):
         if base16:
@@ -68,12 +74,8 @@ class Node(metaclass=ABCMeta):
             raise ValueError("Node uninitialized cause no valid input")
 
         self.data = data
-
-        #   init information
-        if info is None:
-            info = dict()
-        info['id'] = self.base16
-        self.information = info
+        self.value = int.from_bytes(data, 'big')
+        self._info = info if info else None
 
     def __bytes__(self):
         return self.data
@@ -138,47 +140,53 @@ class Node(metaclass=ABCMeta):
     def distance(self, node):
         return distance(self, node)
 
+    def xor(self, node) -> int:
+        """ xor distance as an int, the cheap sort key """
+        return self.value ^ node.value
+
     def created_info(self):
         return 'Node({})'.format(bytes(self))
 
     @property
     def information(self) -> NodeInfo:
-        return getattr(self, '__node_info')
+        info = self._info
+        if not isinstance(info, NodeInfo):
+            info = self._info = NodeInfo(info if info else dict())
+        if 'id' not in info:
+            info['id'] = self.base16
+        return info
 
     @information.setter
     def information(self, value):
-        setattr(self, '__node_info', NodeInfo(value if value else dict()))
+        self._info = NodeInfo(value if value else dict())
+
+    @property
+    def addr(self):
+        """ address without creating the information dict """
+        info = self._info
+        return info.get('addr') if info else None
 
     def is_alive(self):
-        return False
+        """ nodes created by `DHT.get_node` know whether they responded recently """
+        info = self._info
+        return bool(info and info.get('good'))
 
 
-@lru_cache(maxsize=1 << 12)
 def distance(n1: Node, n2: Node) -> Node:
     assert n1.bits == n2.bits
-    return Node(bytes([x ^ y for x, y in zip(n1.data, n2.data)]))
+    return Node((n1.value ^ n2.value).to_bytes(len(n1.data), 'big'))
 
 
 def first_different_bit_position(n1: Node, n2: Node) -> int:
     assert n1.bits == n2.bits
-
-    xor = 0
-    for i in range(len(n1.data)):
-        xor = n1.data[i] ^ n2.data[i]
-        if xor:
-            break
+    xor = n1.value ^ n2.value
     if not xor:
         raise LookupError('kademlia.node.first_different_bit_position error: n1 and n2 is identical')
-
-    for n in range(7, -1, -1):
-        if xor & (1 << n) != 0:
-            break
-
-    return i * 8 + 7 - n
+    return n1.bits - xor.bit_length()
 
 
 def sort(n: Node, ar: list[Node]):
-    return sorted(ar, key=lambda x: distance(x, n))
+    return sorted(ar, key=n.xor)
 
 
 def create_node(data: bytes = None, base16=None, base64=None, ndarray: np.ndarray = None):
@@ -216,57 +224,97 @@ class NetNode(NodeInfo):
 
 
 class KBucket(deque):
+    """
+    ids of the nodes belonging to one bucket, most recently seen on the left,
+    node rows themselves are kept in the parent `DHT` arrays.
+    `replacements` holds (id, ip, port) of nodes which found the bucket full, newest on the left
+    """
     parent = None
     index = None
-    distance_sort = []
 
     def __init__(self, parent, index, maxlen=None):
         super().__init__(maxlen=maxlen)
         self.parent = parent
         self.index = index
+        self.replacements = deque(maxlen=maxlen)
+        self.changed = time.monotonic()     # last time a node was added or seen
 
     def __repr__(self):
         data = self.parent.base_node.base2
-        idx = len(data) - self.index
-        data = data[:-idx] + '-' * (idx)
+        idx = self.index + 1
+        data = data[:-idx] + '-' * idx
         return '(index={:<5d}, {}, {})'.format(self.index, data, super().__repr__())
 
-    def sort_elements(self):
-        self.distance_sort = np.argsort([distance(self.parent.base_node, x) for x in self], kind='quicksort')
+    def __contains__(self, node):
+        if isinstance(node, Node):
+            node = node.data
+        return super().__contains__(node)
 
     @property
     def base2(self):
-        data = '-' * self.maxlen
-        data[self.maxlen - 1 - self.index] = 'X'
-        return data
+        data = ['-'] * self.parent.base_node.bits
+        data[len(data) - 1 - self.index] = 'X'
+        return ''.join(data)
 
-    def put_new_node(self, node: Node):
-        # check
-        if node in self:
-            return
+    def is_full(self):
+        return len(self) == self.maxlen
 
-        # kademlia strategy
-        if len(self) == self.maxlen and not self[0].is_alive():
-            self[0] = node
-        else:
-            self.appendleft(node)
+
+_BIT_LENGTH = np.array([i.bit_length() for i in range(256)], dtype=np.intp)
+
+
+def _pack_addr(addr) -> tuple[int, int]:
+    """ (ip, port) as integers of the address arrays, (0, 0) for an unknown address """
+    if addr is None:
+        return 0, 0
+    return int.from_bytes(socket.inet_aton(addr[0]), 'big'), addr[1]
+
+
+def _prefix_key(data: bytes) -> int:
+    """ the first 8 bytes of `data` as a big endian integer, used to pre-select nearest rows """
+    return int.from_bytes(data[:8].ljust(8, b'\x00'), 'big')
 
 
 class DHT:
     """
+    routing table, node ids are stored as a `uint8[N, bytes]` matrix with parallel address arrays,
+    so the k nearest nodes can be found with a vectorized xor instead of walking the buckets
+
+    liveness follows BEP 5, a node is good if it responded within `good_interval`, or responded once
+    and queried us within `good_interval`. a new node never evicts a good one: when its bucket is
+    full it waits in the replacement cache, and the least recently seen node of the bucket is queued
+    in `pending` to be pinged by the protocol. a node failing `max_fails` times in a row is replaced
+    by the newest replacement and no longer handed out as a neighbor
+
     Examples:
     >>> a, b, k = Node.create_random(2), Node.create_random(2), DHT(Node.create_random(2))
     >>>
     """
     buckets = []
+    initial_capacity = 1 << 10
+    good_interval = 15 * 60
+    max_fails = 2
 
-    def __init__(self, node: Node, k=8):
+    def __init__(self, node: Node, k=8, capacity=None):
         bkt = []
         for i in range(node.bits):
             bkt.append(KBucket(parent=self, index=i, maxlen=k))
 
         self.buckets = bkt
         self._node = node
+        self.k = k
+
+        # node table, row `i` of every array describes the same node
+        capacity = capacity or self.initial_capacity
+        self._size = 0
+        self._rows = dict()     # node id -> row
+        self._ids = np.zeros((capacity, len(node.data)), dtype=np.uint8)
+        self._prefix = np.zeros(capacity, dtype=np.uint64)
+        self._ips = np.zeros(capacity, dtype='>u4')
+        self._ports = np.zeros(capacity, dtype='>u2')     # 0 means address unknown
+        self._seen = np.zeros(capacity, dtype=np.float64)  # monotonic time of the last response, 0 means never
+        self._fails = np.zeros(capacity, dtype=np.uint8)    # consecutive failed queries
+        self.pending = dict()   # ids waiting for a ping before their bucket evicts anybody, in order
 
     def __repr__(self):
         return repr(self.base_node)
@@ -274,6 +322,13 @@ class DHT:
     def __eq__(self, other):
         return self.base_node == other.base_node
 
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, node: Node | bytes):
+        key = node if isinstance(node, bytes) else node.data
+        return key in self._rows
+
     @property
     def base_node(self):
         if self._node is None:
@@ -284,19 +339,235 @@ class DHT:
     def base_node(self, node: Node):
         self._node = node
 
+    def bucket_index(self, node: Node) -> int:
+        xor = self.base_node.value ^ node.value
+        if not xor:
+            raise LookupError('DHT.bucket_index|node is the base node')
+        return xor.bit_length() - 1
+
     def put(self, node: Node):
-        idx = first_different_bit_position(self._node, node)
-        bk = self.buckets[idx]
-        bk.put_new_node(node)
+        assert self.base_node.bits == node.bits
+        if node.data == self.base_node.data:
+            return
+        ip, port = _pack_addr(node.addr)
+        self._put(node.data, self.bucket_index(node), ip, port)
+
+    def put_compact(self, nodes: np.ndarray):
+        """ batch put of a compact node array with `id`, `ip` and `port` fields, no Node is created """
+        if not len(nodes):
+            return
+        ids = nodes['id']
+        assert ids.shape[1] == self._ids.shape[1]
+
+        # bucket index of every row at once, the index is the bit length of the xor distance minus one
+        xor = ids ^ np.frombuffer(self.base_node.data, dtype=np.uint8)
+        first = (xor != 0).argmax(axis=1)
+        leading = xor[np.arange(len(xor)), first]
+        indexes = (ids.shape[1] - 1 - first) * 8 + _BIT_LENGTH[leading] - 1
+
+        for key, index, ip, port, valid in zip(
+                map(bytes, ids), indexes.tolist(), nodes['ip'].tolist(), nodes['port'].tolist(), leading.tolist(),
+        ):
+            if valid:
+                self._put(key, index, ip, port)
+
+    def _put(self, key: bytes, index: int, ip: int, port: int):
+        # refresh address of a known node
+        row = self._rows.get(key)
+        if row is not None:
+            if port:
+                self._ips[row], self._ports[row] = ip, port
+            return
+
+        bk = self.buckets[index]
+        if bk.is_full():
+            # a bad node makes room at once, otherwise wait until the least recently seen one is pinged
+            bad = next((x for x in reversed(bk) if self._fails[self._rows[x]] >= self.max_fails), None)
+            if bad is None:
+                if key not in (x[0] for x in bk.replacements):
+                    bk.replacements.appendleft((key, ip, port))
+                last = bk[-1]
+                if not self._is_good(self._rows[last]):
+                    self.pending[last] = None
+                return
+            bk.remove(bad)
+            self._delete_row(bad)
+        bk.appendleft(key)
+        bk.changed = time.monotonic()
+        self._insert_row(key, ip, port)
+
+    def seen(self, key: bytes, query=False, now=None):
+        """ a node responded, or queried us with `query`, move it to the head of its bucket """
+        row = self._rows.get(key)
+        if row is None or (query and not self._seen[row]):
+            return
+        now = time.monotonic() if now is None else now
+        self._seen[row], self._fails[row] = now, 0
+        self.pending.pop(key, None)
+        bk = self.buckets[self._index_of(key)]
+        if bk[0] != key:
+            bk.remove(key)
+            bk.appendleft(key)
+        bk.changed = now
+
+    def failed(self, key: bytes) -> bool:
+        """ a query to a node timed out, return True if the node was replaced """
+        row = self._rows.get(key)
+        if row is None:
+            return False
+        self._fails[row] = min(int(self._fails[row]) + 1, 255)
+        self.pending.pop(key, None)
+        bk = self.buckets[self._index_of(key)]
+        if self._fails[row] < self.max_fails:
+            return False
+        # replacements may have entered the table meanwhile
+        while bk.replacements and bk.replacements[0][0] in self._rows:
+            bk.replacements.popleft()
+        if not bk.replacements:
+            return False
+        bk.remove(key)
+        self._delete_row(key)
+        new, ip, port = bk.replacements.popleft()
+        bk.append(new)
+        self._insert_row(new, ip, port)
+        return True
+
+    def take_pending(self, nums=32) -> list[bytes]:
+        """ pop ids which should be pinged, oldest requests first """
+        ret = []
+        while self.pending and len(ret) < nums:
+            key = next(iter(self.pending))
+            del self.pending[key]
+            if key in self._rows:
+                ret.append(key)
+        return ret
+
+    def is_good(self, key: bytes, now=None) -> bool:
+        row = self._rows.get(key)
+        return row is not None and self._is_good(row, now)
+
+    def stale_buckets(self, interval=None, now=None) -> list[int]:
+        """ indexes of non empty buckets which did not change within `interval`, least recently changed first """
+        now = time.monotonic() if now is None else now
+        interval = self.good_interval if interval is None else interval
+        ret = [bk for bk in self.buckets if bk and now - bk.changed >= interval]
+        return [bk.index for bk in sorted(ret, key=lambda x: x.changed)]
+
+    def random_id(self, index: int) -> bytes:
+        """ random id which falls into bucket `index`, the target of a bucket refresh """
+        node = self.base_node
+        xor = (1 << index) | random.getrandbits(index)
+        return (node.value ^ xor).to_bytes(len(node.data), 'big')
+
+    def _is_good(self, row, now=None) -> bool:
+        seen = self._seen[row]
+        now = time.monotonic() if now is None else now
+        return bool(seen) and now - seen < self.good_interval and self._fails[row] == 0
+
+    def _index_of(self, key: bytes) -> int:
+        return (self.base_node.value ^ int.from_bytes(key, 'big')).bit_length() - 1
 
     def puts(self, ar):
         for n in ar:
             self.put(n)
 
+    def remove(self, node: Node):
+        key = node.data
+        if key not in self._rows:
+            return
+        self.buckets[self.bucket_index(node)].remove(key)
+        self.pending.pop(key, None)
+        self._delete_row(key)
+
+    def get_node(self, key: bytes) -> Node:
+        return self._create_node(self._rows[key])
+
     def get_neighbors(self, node: Node, nums=8) -> list[Node]:
         assert self.base_node.bits == node.bits
-        idx = first_different_bit_position(self.base_node, node)
-        return list(self.buckets[idx])[:nums]
+        return [self._create_node(row) for row in self.nearest_rows(node.data, nums)]
+
+    def get_compact_neighbors(self, node: Node, nums=8) -> bytes:
+        """ k nearest nodes with known address as BEP 5 compact node info """
+        assert self.base_node.bits == node.bits
+        rows = self.nearest_rows(node.data, nums)
+        rows = rows[(self._ports[rows] != 0) & (self._fails[rows] < self.max_fails)]
+        width = self._ids.shape[1]
+        ret = np.empty((len(rows), width + 6), dtype=np.uint8)
+        ret[:, :width] = self._ids[rows]
+        ret[:, width:width + 4] = self._ips[rows].view(np.uint8).reshape(-1, 4)
+        ret[:, width + 4:] = self._ports[rows].view(np.uint8).reshape(-1, 2)
+        return ret.tobytes()
+
+    def to_compact(self) -> np.ndarray:
+        """
+        every node as an array with `id`, `ip` and `port` fields, oldest first within each bucket,
+        so that `put_compact` of the result rebuilds the same buckets
+        """
+        width = self._ids.shape[1]
+        dtype = np.dtype([('id', np.uint8, (width,)), ('ip', '>u4'), ('port', '>u2')])
+        rows = np.fromiter((self._rows[key] for bk in self.buckets for key in reversed(bk)), dtype=np.intp)
+        ret = np.empty(len(rows), dtype=dtype)
+        ret['id'], ret['ip'], ret['port'] = self._ids[rows], self._ips[rows], self._ports[rows]
+        return ret
+
+    def nearest_rows(self, target: bytes, nums=8) -> np.ndarray:
+        """ rows of the `nums` nodes closest to `target`, sorted by xor distance """
+        size = self._size
+        if size == 0 or nums <= 0:
+            return np.empty(0, dtype=np.intp)
+
+        # bad nodes only stay until a replacement shows up, they are never neighbors
+        candidates = np.flatnonzero(self._fails[:size] < self.max_fails)
+
+        # pre-select by the leading 64 bits, remotes choose their ids, so every candidate tying with
+        # the kth prefix stays for the exact order below
+        if nums < len(candidates):
+            prefix = self._prefix[candidates] ^ np.uint64(_prefix_key(target))
+            kth = np.partition(prefix, nums - 1)[nums - 1]
+            candidates = candidates[prefix <= kth]
+
+        # exact order by the full xor distance
+        xor = self._ids[candidates] ^ np.frombuffer(target, dtype=np.uint8)
+        order = np.lexsort(xor.T[::-1])
+        return candidates[order[:nums]]
+
+    def _create_node(self, row) -> Node:
+        info = NodeInfo()
+        port = int(self._ports[row])
+        if port:
+            info.addr = (socket.inet_ntoa(int(self._ips[row]).to_bytes(4, 'big')), port)
+        if self._is_good(row):
+            info['good'] = True
+        return Node(self._ids[row].tobytes(), info=info)
+
+    def _insert_row(self, key: bytes, ip: int, port: int):
+        if self._size == len(self._ids):
+            self._grow(len(self._ids) << 1)
+        row = self._size
+        self._ids[row] = np.frombuffer(key, dtype=np.uint8)
+        self._prefix[row] = _prefix_key(key)
+        self._ips[row], self._ports[row] = ip, port
+        self._seen[row], self._fails[row] = 0, 0
+        self._rows[key] = row
+        self._size += 1
+        return row
+
+    def _delete_row(self, key: bytes):
+        # move the last row into the hole so that rows stay dense
+        row = self._rows.pop(key)
+        last = self._size - 1
+        if row != last:
+            for ar in (self._ids, self._prefix, self._ips, self._ports, self._seen, self._fails):
+                ar[row] = ar[last]
+            self._rows[self._ids[row].tobytes()] = row
+        self._size = last
+
+    def _grow(self, capacity):
+        for name in ('_ids', '_prefix', '_ips', '_ports', '_seen', '_fails'):
+            ar = getattr(self, name)
+            new = np.zeros((capacity,) + ar.shape[1:], dtype=ar.dtype)
+            new[:len(ar)] = ar
+            setattr(self, name, new)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,179 @@
+import math
+import random
+import time
+from hashlib import sha1
+from itertools import islice
+
+from .constants import ONE_WEEK
+
+"""
+    announce_peer storage
+
+    every announcement lands in the time bucket of its arrival, buckets are kept in arrival order so
+    expiring is popping buckets from the front, O(expired) instead of scanning every torrent
+
+    refer:
+     BEP 5 DHT Protocol - http://bittorrent.org/beps/bep_0005.html
+     BEP 33 DHT Scrape - http://bittorrent.org/beps/bep_0033.html
+     BEP 51 DHT Infohash Indexing - http://bittorrent.org/beps/bep_0051.html
+"""
+
+BLOOM_SIZE = 256    # bytes of a BEP 33 bloom filter
+
+
+def bloom_add(bits: bytearray, ip: bytes):
+    """ insert an ip, 4 bytes in network order for ipv4, into a BEP 33 bloom filter """
+    h = sha1(ip).digest()
+    m = len(bits) * 8
+    for i in ((h[0] | h[1] << 8) % m, (h[2] | h[3] << 8) % m):
+        bits[i >> 3] |= 1 << (i & 7)
+
+
+def bloom_estimate(bits: bytes) -> int:
+    """ estimated number of distinct ips inserted into a BEP 33 bloom filter """
+    m = len(bits) * 8
+    zeros = m - sum(x.bit_count() for x in bits)
+    zeros = max(zeros, 1)     # saturated filter
+    return round(math.log(zeros / m) / (2 * math.log(1 - 1 / m)))
+
+
+class Torrent:
+    __slots__ = ('peers', 'seeds', 'bloom')
+
+    def __init__(self):
+        self.peers = dict()     # compact peer -> time bucket, oldest announcement first
+        self.seeds = set()
+        self.bloom = None       # cached (BFsd, BFpe)
+
+
+class PeerStore:
+    """
+    Examples:
+    >>> store = PeerStore(max_peers=1 << 16)
+    >>> store.announce(info_hash, compact_ip_port('1.2.3.4', 6881))
+    >>> store.get(info_hash)
+    [b'\\x01\\x02\\x03\\x04\\x1a\\xe1']
+    """
+
+    def __init__(self, ttl=ONE_WEEK, interval=60, max_peers=1 << 18, max_peers_per_torrent=1 << 10, scrape=True):
+        self.ttl = ttl
+        self.interval = interval
+        self.max_peers = max_peers
+        self.max_peers_per_torrent = max_peers_per_torrent
+        self.scrape = scrape
+
+        self._torrents = dict()     # info_hash -> Torrent
+        self._buckets = dict()      # time bucket -> {(info_hash, compact peer)}, in arrival order
+        self._size = 0
+        self._samples = (0.0, b'')    # BEP 51 (expires at, concatenated info hashes)
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, info_hash: bytes):
+        return info_hash in self._torrents
+
+    def torrents(self) -> int:
+        return len(self._torrents)
+
+    def announce(self, info_hash: bytes, peer: bytes, seed=False, now=None):
+        now = time.time() if now is None else now
+        self.expire(now)
+        bucket = int(now // self.interval)
+        if bucket <= int((now - self.ttl) // self.interval):
+            return
+
+        torrent = self._torrents.get(info_hash)
+        if torrent is None:
+            torrent = self._torrents[info_hash] = Torrent()
+
+        # an announcement again moves the peer to the newest bucket
+        old = torrent.peers.pop(peer, None)
+        if old is not None:
+            self._buckets[old].discard((info_hash, peer))
+            self._size -= 1
+        elif len(torrent.peers) >= self.max_peers_per_torrent:
+            self._remove(info_hash, next(iter(torrent.peers)))
+
+        # restored announcements may be older than the newest bucket
+        if bucket not in self._buckets and self._buckets and bucket < next(reversed(self._buckets)):
+            bucket = next(reversed(self._buckets))
+        torrent.peers[peer] = bucket
+        if seed:
+            torrent.seeds.add(peer)
+        else:
+            torrent.seeds.discard(peer)
+        torrent.bloom = None
+        self._buckets.setdefault(bucket, set()).add((info_hash, peer))
+        self._size += 1
+
+        while self._size > self.max_peers:
+            self._evict_oldest()
+
+    def get(self, info_hash: bytes, nums=50, now=None) -> list[bytes]:
+        """ compact peers of the most recent announcements """
+        self.expire(time.time() if now is None else now)
+        torrent = self._torrents.get(info_hash)
+        if torrent is None:
+            return []
+        return list(islice(reversed(torrent.peers), nums))
+
+    def get_bloom(self, info_hash: bytes) -> tuple[bytes, bytes] | None:
+        """ BEP 33 (BFsd, BFpe) filters of seeds and downloaders, None if scrape is disabled """
+        if not self.scrape:
+            return None
+        torrent = self._torrents.get(info_hash)
+        if torrent is None:
+            return bytes(BLOOM_SIZE), bytes(BLOOM_SIZE)
+        if torrent.bloom is None:
+            seeds, peers = bytearray(BLOOM_SIZE), bytearray(BLOOM_SIZE)
+            for peer in torrent.peers:
+                bloom_add(seeds if peer in torrent.seeds else peers, peer[:4])
+            torrent.bloom = bytes(seeds), bytes(peers)
+        return torrent.bloom
+
+    def sample(self, count=20, interval=300, now=None) -> bytes:
+        """ BEP 51 random info hashes, concatenated, the same sample is served for `interval` seconds """
+        now = time.time() if now is None else now
+        expires, samples = self._samples
+        if now >= expires:
+            keys = self._torrents.keys()
+            samples = b''.join(random.sample(list(keys), count) if len(keys) > count else keys)
+            self._samples = (now + interval, samples)
+        return samples
+
+    def items(self):
+        """ (info_hash, compact peer, announced at) of every peer """
+        for info_hash, torrent in self._torrents.items():
+            for peer, bucket in torrent.peers.items():
+                yield info_hash, peer, float(bucket * self.interval)
+
+    def expire(self, now=None):
+        now = time.time() if now is None else now
+        cutoff = int((now - self.ttl) // self.interval)
+        while self._buckets:
+            bucket = next(iter(self._buckets))
+            if bucket > cutoff:
+                break
+            for info_hash, peer in self._buckets.pop(bucket):
+                self._remove(info_hash, peer, bucket=False)
+
+    def _evict_oldest(self):
+        bucket = next(iter(self._buckets))
+        entries = self._buckets[bucket]
+        if entries:
+            info_hash, peer = entries.pop()
+            self._remove(info_hash, peer, bucket=False)
+        if not entries:
+            del self._buckets[bucket]
+
+    def _remove(self, info_hash: bytes, peer: bytes, bucket=True):
+        torrent = self._torrents[info_hash]
+        old = torrent.peers.pop(peer)
+        torrent.seeds.discard(peer)
+        torrent.bloom = None
+        if not torrent.peers:
+            del self._torrents[info_hash]
+        if bucket:
+            self._buckets[old].discard((info_hash, peer))
+        self._size -= 1
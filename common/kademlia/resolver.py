@@ -0,0 +1,106 @@
+import asyncio as aio
+import ipaddress
+import logging
+import socket
+import time
+
+from .constants import BOOTSTRAP_RESOLVE_TTL, dht_bootstrap_fallback
+
+"""
+    lazy bootstrap address resolution
+
+    host names are resolved with `loop.getaddrinfo` inside the krpc loop, never at import time,
+    results are cached for `ttl` seconds and refreshed in the background, a host which can not be
+    resolved keeps its last known addresses and the static fallbacks are used until anything resolved
+"""
+
+
+def is_ip(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+class BootstrapResolver:
+    """
+    Examples:
+    >>> resolver = BootstrapResolver([('router.bittorrent.com', 6881)])
+    >>> resolver.addrs      # never blocks, fallbacks while a hostname is not resolved yet
+    >>> addrs = await resolver.get()
+    """
+
+    def __init__(self, hosts, fallback=None, ttl=BOOTSTRAP_RESOLVE_TTL, timeout=5, logger=None):
+        self.hosts = list(dict.fromkeys((host, int(port)) for host, port in hosts))
+        self.fallback = list(dht_bootstrap_fallback if fallback is None else fallback) if self.hosts else []
+        self.ttl = ttl
+        self.timeout = timeout
+        self.logger = logger or logging.getLogger('krpc')
+
+        self._cache = dict()    # (host, port) -> [(ip, port)]
+        self._expire = 0
+        self._resolving = None
+
+    @property
+    def addrs(self) -> list[tuple[str, int]]:
+        """ the cached addresses, ip literals are returned as is, the fallbacks while a hostname is unresolved """
+        ret = []
+        unresolved = False
+        for host, port in self.hosts:
+            if is_ip(host):
+                ret.append((host, port))
+            elif (host, port) in self._cache:
+                ret.extend(self._cache[host, port])
+            else:
+                unresolved = True
+        if unresolved:
+            ret.extend(self.fallback)
+        return list(dict.fromkeys(ret))
+
+    def is_expired(self) -> bool:
+        return time.monotonic() >= self._expire
+
+    async def get(self) -> list[tuple[str, int]]:
+        """ cached addresses, resolve first if the cache is expired """
+        if self.is_expired():
+            await self.resolve()
+        return self.addrs
+
+    async def resolve(self):
+        # concurrent callers share one resolution
+        if self._resolving is None or self._resolving.done():
+            self._resolving = aio.ensure_future(self._resolve())
+        await aio.shield(self._resolving)
+
+    async def refresh_forever(self):
+        """ background task, resolve again shortly before the cache expires """
+        while True:
+            await self.resolve()
+            await aio.sleep(max(self._expire - time.monotonic(), 1))
+
+    async def _resolve(self):
+        names = [x for x in self.hosts if not is_ip(x[0])]
+        results = await aio.gather(*[self._resolve_one(*x) for x in names])
+        resolved = 0
+        for key, addrs in zip(names, results):
+            if addrs:
+                self._cache[key] = addrs
+                resolved += 1
+
+        # retry sooner while nothing could be resolved
+        ttl = self.ttl if resolved or not names else min(self.ttl, 60)
+        self._expire = time.monotonic() + ttl
+        self.logger.info('BootstrapResolver.resolve|resolved=%d|hosts=%d|addrs=%d', resolved, len(names), len(self.addrs))
+
+    async def _resolve_one(self, host, port) -> list[tuple[str, int]]:
+        loop = aio.get_running_loop()
+        try:
+            infos = await aio.wait_for(
+                loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM),
+                self.timeout,
+            )
+        except (OSError, aio.TimeoutError) as e:
+            self.logger.warning('BootstrapResolver.resolve|error=%s|host=%s', e, host)
+            return []
+        return list(dict.fromkeys(x[-1][:2] for x in infos))
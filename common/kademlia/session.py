@@ -0,0 +1,273 @@
+import asyncio as aio
+import logging
+
+from .bittorrent import BitTorrentProtocol
+from .constants import DEFAULT_BIT_TORRENT_CONFIG
+from .metrics import BitTorrentMetrics, monitor_loop_lag
+from .node import Node
+
+"""
+    multi-torrent session
+
+    one `Session` runs every torrent and every peer connection on the event loop it is started on,
+    instead of a thread, a loop and a socket per `bittorrent.BitTorrent`. it listens on one address
+    for all torrents and routes an inbound connection by the info hash of its handshake, a handshake
+    for a torrent the session does not have is dropped without an answer
+
+    `max_connections` caps the connections of the session, connecting and handshaking ones included,
+    `Torrent.max_connections` the ones of each torrent. a peer which does not finish the handshake in
+    `handshake_timeout` or sends nothing for `idle_timeout` seconds is dropped, idle peers of ours get
+    a keep alive every `keep_alive_interval` seconds. all timeouts are checked by one periodic sweep,
+    not by a timer per connection
+
+    Examples:
+    >>> session = Session(address=('0.0.0.0', 6882))
+    >>> await session.start()
+    >>> torrent = session.add(Torrent(info_hash))
+    >>> await torrent.connect(('1.2.3.4', 6881))
+    >>> await session.close()
+
+    refer:
+     BEP 3 The BitTorrent Protocol Specification - http://bittorrent.org/beps/bep_0003.html
+"""
+
+MESSAGE_KEEP_ALIVE = b'\x00\x00\x00\x00'
+
+
+class Torrent:
+    """ one torrent of a `Session`, subclasses handle the messages of its peers """
+
+    def __init__(self, info_hash: bytes, max_connections: int = None):
+        assert len(info_hash) == 20
+        self.info_hash = info_hash
+        self.max_connections = max_connections     # None takes the session default
+        self.session = None
+        self.peers = set()      # handshaken connections
+        self.pending = 0        # outbound connections not handshaken yet
+
+    def is_full(self) -> bool:
+        return len(self.peers) + self.pending >= self.max_connections
+
+    async def connect(self, address):
+        return await self.session.connect(self, address)
+
+    def peer_connected(self, conn: 'PeerConnection'):
+        """ handshake done, `conn.remote_peer_id` and `conn.message.features` are known """
+
+    def peer_disconnected(self, conn: 'PeerConnection'):
+        pass
+
+    def message_received(self, conn: 'PeerConnection', msg_id: int, payload: memoryview):
+        """ see `BitTorrentProtocol.message_received`, `payload` is valid only during the call """
+
+
+class PeerConnection(BitTorrentProtocol):
+    """ a peer of a `Session`, an inbound one has no torrent until its handshake arrives """
+
+    def __init__(self, session: 'Session', torrent: Torrent = None):
+        super().__init__(
+            session.peer_id, session.loop, session.logger,
+            info_hash=torrent.info_hash if torrent else None, metrics=session.metrics,
+        )
+        self.session = session
+        self.torrent = torrent
+        self.outbound = torrent is not None
+        self.address = None
+        self.remote_peer_id = None
+        self.connected_at = self.last_received = self.last_sent = session.loop.time()
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.address = transport.get_extra_info('peername')
+        if not self.session._admit(self):
+            return self.disconnect()
+        if self.outbound:
+            self.status = self.STATUS_HANDSHAKING
+            self.write(self.message.handshake())
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        self.session._release(self)
+
+    def write(self, data: bytes):
+        self.last_sent = self.loop.time()
+        super().write(data)
+
+    def buffer_updated(self, nbytes: int):
+        self.last_received = self.loop.time()
+        super().buffer_updated(nbytes)
+
+    def data_received(self, data: bytes):
+        self.last_received = self.loop.time()
+        super().data_received(data)
+
+    def handshake_received(self, data: memoryview):
+        # route before answering, the info hash follows the protocol string and the reserved bytes
+        if not self.outbound and not self.session._route(self, bytes(data[28:48])):
+            self.metrics.handshake_failures += 1
+            return self.disconnect()
+        super().handshake_received(data)
+        if self.status == self.STATUS_NORMAL:
+            self.remote_peer_id = bytes(data[48:68])
+            self.session._established(self)
+
+    def message_received(self, msg_id: int, payload: memoryview):
+        self.torrent.message_received(self, msg_id, payload)
+
+
+class Session:
+    """ every method runs on the loop `start` was awaited on """
+
+    def __init__(self, peer_id: bytes = None, address=None, max_connections=None, peers_per_torrent=None,
+                 handshake_timeout=None, idle_timeout=None, keep_alive_interval=None, logger=None):
+        config = DEFAULT_BIT_TORRENT_CONFIG
+        self.peer_id = peer_id or Node.create_random().data
+        self.address = address
+        self.max_connections = max_connections or config.get('session_connections', 500)
+        self.peers_per_torrent = peers_per_torrent or config.get('session_peers_per_torrent', 50)
+        self.handshake_timeout = handshake_timeout or config.get('session_handshake_timeout', 10)
+        self.idle_timeout = idle_timeout or config.get('session_idle_timeout', 180)
+        self.keep_alive_interval = keep_alive_interval or config.get('session_keep_alive_interval', 90)
+        self.logger = logger or logging.getLogger(config['logger'])
+        self.metrics = BitTorrentMetrics()
+        self.loop = None
+        self.server = None
+        self.torrents = dict()      # info hash -> Torrent
+        self.connections = set()    # admitted connections, handshaking ones included
+        self._connecting = 0        # outbound connections not made yet
+        self._tasks = []
+
+        # counters
+        self.refused = 0
+        self.handshake_timeouts = 0
+        self.idle_timeouts = 0
+
+    async def start(self):
+        self.loop = aio.get_running_loop()
+        if self.address is not None:
+            self.server = await self.loop.create_server(
+                lambda: PeerConnection(self), *self.address, reuse_address=True,
+            )
+            self.address = self.server.sockets[0].getsockname()[:2]
+        self._tasks.append(self.loop.create_task(self._sweep()))
+        interval = DEFAULT_BIT_TORRENT_CONFIG.get('loop_lag_interval', 0.5)
+        if interval:
+            self._tasks.append(self.loop.create_task(monitor_loop_lag(self.metrics.loop_lag, interval)))
+        self.logger.warning('Session.start|address=%s|peer_id=%s', self.address, self.peer_id.hex())
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+        if self.server is not None:
+            self.server.close()
+        for conn in list(self.connections):
+            conn.disconnect()
+        if self.server is not None:
+            await self.server.wait_closed()
+            self.server = None
+
+    def is_serving(self) -> bool:
+        return self.server is not None and self.server.is_serving()
+
+    def add(self, torrent: Torrent) -> Torrent:
+        if torrent.info_hash in self.torrents:
+            raise ValueError('Session.add|torrent exists|info_hash=%s' % torrent.info_hash.hex())
+        if torrent.max_connections is None:
+            torrent.max_connections = self.peers_per_torrent
+        torrent.session = self
+        self.torrents[torrent.info_hash] = torrent
+        return torrent
+
+    def remove(self, info_hash: bytes) -> Torrent:
+        torrent = self.torrents.pop(info_hash)
+        for conn in [x for x in self.connections if x.torrent is torrent]:
+            conn.disconnect()
+        return torrent
+
+    def is_full(self) -> bool:
+        return len(self.connections) + self._connecting >= self.max_connections
+
+    async def connect(self, torrent: Torrent, address) -> PeerConnection | None:
+        """
+        open a connection to `address` for `torrent` and send our handshake, None if a connection
+        cap is reached. raise OSError or TimeoutError if the peer can not be reached in `handshake_timeout`
+        """
+        assert self.torrents.get(torrent.info_hash) is torrent
+        if self.is_full() or torrent.is_full():
+            self.refused += 1
+            return None
+        # both reservations are held until the connection is admitted or fails
+        self._connecting += 1
+        torrent.pending += 1
+        try:
+            _, conn = await aio.wait_for(
+                self.loop.create_connection(lambda: PeerConnection(self, torrent), *address),
+                self.handshake_timeout,
+            )
+        except BaseException:
+            torrent.pending -= 1
+            raise
+        finally:
+            self._connecting -= 1
+        return conn
+
+    def stats(self) -> dict:
+        return dict(
+            torrents=len(self.torrents), connections=len(self.connections),
+            peers=sum(len(x.peers) for x in self.torrents.values()),
+            handshakes=self.metrics.handshakes, handshake_failures=self.metrics.handshake_failures,
+            refused=self.refused, handshake_timeouts=self.handshake_timeouts, idle_timeouts=self.idle_timeouts,
+        )
+
+    # callbacks of PeerConnection
+
+    def _admit(self, conn: PeerConnection) -> bool:
+        # an outbound connection has reserved its place in `connect`
+        if not conn.outbound and self.is_full():
+            self.refused += 1
+            return False
+        self.connections.add(conn)
+        return True
+
+    def _route(self, conn: PeerConnection, info_hash: bytes) -> bool:
+        torrent = self.torrents.get(info_hash)
+        if torrent is None or torrent.is_full():
+            self.refused += 1
+            return False
+        conn.torrent = torrent
+        return True
+
+    def _established(self, conn: PeerConnection):
+        torrent = conn.torrent
+        if conn.outbound:
+            torrent.pending -= 1
+        torrent.peers.add(conn)
+        torrent.peer_connected(conn)
+
+    def _release(self, conn: PeerConnection):
+        if conn not in self.connections:
+            return
+        self.connections.discard(conn)
+        torrent = conn.torrent
+        if torrent is not None and conn in torrent.peers:
+            torrent.peers.discard(conn)
+            torrent.peer_disconnected(conn)
+        elif conn.outbound:
+            torrent.pending -= 1
+
+    async def _sweep(self):
+        interval = min(self.handshake_timeout, self.keep_alive_interval) / 4
+        while True:
+            await aio.sleep(interval)
+            now = self.loop.time()
+            for conn in list(self.connections):
+                if conn.status != conn.STATUS_NORMAL:
+                    if now - conn.connected_at > self.handshake_timeout:
+                        self.handshake_timeouts += 1
+                        conn.disconnect()
+                elif now - conn.last_received > self.idle_timeout:
+                    self.idle_timeouts += 1
+                    conn.disconnect()
+                elif now - conn.last_sent > self.keep_alive_interval:
+                    conn.write(MESSAGE_KEEP_ALIVE)
@@ -0,0 +1,200 @@
+import asyncio as aio
+import logging
+import random
+import socket
+import time
+
+import numpy as np
+
+from .krpc import KrpcProtocol
+from .node import Node, DHT
+
+"""
+    in process dht swarm simulator
+
+    hundreds to thousands of `KrpcProtocol` instances exchange datagrams through an in memory network
+    with configurable latency and loss, nothing touches a real socket. used by `benchmark.bench_swarm`
+    to measure lookup latency, packets per lookup, routing table convergence and cpu per packet
+
+    Examples:
+    >>> swarm = Swarm(500, SimNetwork(latency=(0.005, 0.03), loss=0.01))
+    >>> await swarm.start()
+    >>> await swarm.bootstrap()
+    >>> report = await swarm.run_lookups(100)
+"""
+
+
+class SimNetwork:
+    def __init__(self, latency=(0.005, 0.03), loss=0.0, seed=None):
+        self.latency = latency
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.endpoints = dict()     # addr -> SimTransport
+
+        # counters
+        self.sent = 0
+        self.delivered = 0
+        self.lost = 0
+        self.unreachable = 0
+
+    def send(self, data: bytes, src, dst):
+        self.sent += 1
+        if self.loss and self.random.random() < self.loss:
+            self.lost += 1
+            return
+        low, high = self.latency
+        delay = self.random.uniform(low, high)
+        aio.get_running_loop().call_later(delay, self._deliver, bytes(data), src, dst)
+
+    def _deliver(self, data, src, dst):
+        transport = self.endpoints.get(dst)
+        if transport is None or transport.is_closing():
+            self.unreachable += 1
+            return
+        self.delivered += 1
+        transport.protocol.datagram_received(data, src)
+
+    def stats(self) -> dict:
+        return dict(sent=self.sent, delivered=self.delivered, lost=self.lost, unreachable=self.unreachable)
+
+
+class SimTransport(aio.DatagramTransport):
+    def __init__(self, network: SimNetwork, addr, protocol: aio.DatagramProtocol):
+        super().__init__(extra={'sockname': addr})
+        self.network = network
+        self.addr = addr
+        self.protocol = protocol
+        self._closing = False
+        network.endpoints[addr] = self
+
+    def sendto(self, data, addr=None):
+        if not self._closing:
+            self.network.send(data, self.addr, tuple(addr))
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self.network.endpoints.pop(self.addr, None)
+        aio.get_running_loop().call_soon(self.protocol.connection_lost, None)
+
+    abort = close
+
+
+def percentiles(values, qs=(50, 90, 99)) -> dict:
+    if not len(values):
+        return {'p%d' % q: None for q in qs}
+    ar = np.percentile(np.asarray(values, dtype=np.float64), qs)
+    return {'p%d' % q: float(x) for q, x in zip(qs, ar)}
+
+
+class Swarm:
+    def __init__(self, size: int, network: SimNetwork = None, k=8, protocol_class=KrpcProtocol, seed=None,
+                 verify_rate=None, logger=None):
+        self.size = size
+        self.verify_rate = verify_rate
+        self.network = network or SimNetwork(seed=seed)
+        self.k = k
+        self.protocol_class = protocol_class
+        self.random = random.Random(seed)
+        if logger is None:
+            # thousands of nodes share one logger, only errors are worth printing
+            logger = logging.getLogger('krpc.simulator')
+            logger.setLevel(logging.ERROR)
+        self.logger = logger
+        self.protocols = []
+        self.addresses = []
+
+    def __len__(self):
+        return len(self.protocols)
+
+    async def start(self):
+        """ create every node, the first one is the bootstrap router of the others """
+        for i in range(self.size):
+            n = Node(self.random.getrandbits(160).to_bytes(20, 'big'))
+            addr = (socket.inet_ntoa((0x0a000000 + i + 1).to_bytes(4, 'big')), 6881)
+            bootstrap_addrs = [self.addresses[0]] if self.addresses else []
+            p = self.protocol_class(n, DHT(n, self.k), self.logger, bootstrap_addrs)
+            p.connection_made(SimTransport(self.network, addr, p))
+            # bootstrap is driven by the simulator
+            p._tasks.pop('bootstrap').cancel()
+            if self.verify_rate:
+                p.verify_queue.rate = self.verify_rate
+            p.address = addr
+            self.protocols.append(p)
+            self.addresses.append(addr)
+
+    def stop(self):
+        for p in self.protocols:
+            p.transport.close()
+
+    async def bootstrap(self, rounds=2, concurrency=64, timeout=10):
+        """ every node looks up its own id through the router, like `KrpcProtocol.bootstrap` does """
+        sem = aio.Semaphore(concurrency)
+        router = self.addresses[:1]
+
+        async def _one(p):
+            async with sem:
+                addrs = router if len(p.dht) < p.dht.k else ()
+                await p.bootstrap_by_find_node(addrs, timeout=timeout)
+
+        for _ in range(rounds):
+            await aio.gather(*[_one(p) for p in self.protocols])
+            await self.settle(timeout)
+
+    async def settle(self, timeout=10):
+        """ wait until queued requesters are verified, they enter routing tables only afterwards """
+        deadline = time.monotonic() + timeout
+        while any(len(p.verify_queue) for p in self.protocols) and time.monotonic() < deadline:
+            await aio.sleep(0.05)
+        # pings of the last requesters are still in flight
+        await aio.sleep(self.network.latency[1] * 2)
+
+    def true_closest(self, target: bytes, k=None) -> list[bytes]:
+        k = k or self.k
+        ids = np.frombuffer(b''.join(p.node.data for p in self.protocols), dtype=np.uint8).reshape(-1, 20)
+        xor = ids ^ np.frombuffer(target, dtype=np.uint8)
+        order = np.lexsort(xor.T[::-1])[:k]
+        return [ids[i].tobytes() for i in order]
+
+    def convergence(self, samples=200) -> float:
+        """ mean share of every node's true k closest nodes present in its routing table """
+        protocols = self.random.sample(self.protocols, min(samples, len(self.protocols)))
+        scores = []
+        for p in protocols:
+            closest = [x for x in self.true_closest(p.node.data, self.k + 1) if x != p.node.data][:self.k]
+            scores.append(sum(x in p.dht for x in closest) / len(closest))
+        return float(np.mean(scores)) if scores else 0.0
+
+    async def run_lookups(self, count=100, concurrency=8, **kwargs) -> dict:
+        """ random find_node lookups from random nodes, report latency, traffic and accuracy """
+        sem = aio.Semaphore(concurrency)
+        latencies, precisions = [], []
+
+        async def _one():
+            async with sem:
+                p = self.random.choice(self.protocols)
+                target = self.random.getrandbits(160).to_bytes(20, 'big')
+                start = time.perf_counter()
+                nodes, _ = await p.lookup(target, k=self.k, **kwargs)
+                latencies.append(time.perf_counter() - start)
+                expected = set(self.true_closest(target))
+                precisions.append(len(expected & {x.data for x in nodes}) / len(expected))
+
+        sent, cpu, wall = self.network.sent, time.process_time(), time.perf_counter()
+        await aio.gather(*[_one() for _ in range(count)])
+        packets = self.network.sent - sent
+        cpu = time.process_time() - cpu
+
+        ret = dict(
+            lookups=count,
+            elapsed=time.perf_counter() - wall,
+            packets_per_lookup=packets / count if count else 0,
+            cpu_per_packet_us=cpu / packets * 1e6 if packets else 0,
+            precision=float(np.mean(precisions)) if precisions else 0.0,
+        )
+        ret.update({'latency_' + k: v for k, v in percentiles(latencies).items()})
+        return ret
@@ -0,0 +1,115 @@
+import os
+import struct
+import time
+
+import numpy as np
+
+from .constants import ONE_WEEK
+
+"""
+    routing table snapshot
+
+    a binary file of fixed size records, so it can be memory mapped and handed to `DHT.put_compact`
+    without parsing:
+
+        header      magic(8) version(2) id_width(2) nodes(4) peers(4) root id(id_width)
+        nodes       [id(id_width) ip(4) port(2)] * nodes
+        peers       [info_hash(id_width) ip(4) port(2) announced_at(8, float)] * peers
+
+    all integers are big endian, the same byte order as BEP 5 compact info
+"""
+
+MAGIC = b'KRPCSNAP'
+VERSION = 1
+HEADER = struct.Struct('>8sHHII')
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def node_dtype(width=20) -> np.dtype:
+    return np.dtype([('id', np.uint8, (width,)), ('ip', '>u4'), ('port', '>u2')])
+
+
+def peer_dtype(width=20) -> np.dtype:
+    return np.dtype([('info_hash', np.uint8, (width,)), ('ip', '>u4'), ('port', '>u2'), ('time', '>f8')])
+
+
+class Snapshot:
+    __slots__ = ('root', 'nodes', 'peers', 'mtime')
+
+    def __init__(self, root: bytes, nodes: np.ndarray, peers: np.ndarray, mtime: float):
+        self.root = root
+        self.nodes = nodes
+        self.peers = peers
+        self.mtime = mtime
+
+    def __repr__(self):
+        return 'Snapshot(root={}, nodes={}, peers={})'.format(self.root.hex(), len(self.nodes), len(self.peers))
+
+
+def encode_peers(items, width=20) -> np.ndarray:
+    """ (info_hash, compact peer, announced at) triples, e.g. `PeerStore.items()`, as a flat record array """
+    items = [x for x in items if len(x[1]) == 6]
+    ret = np.empty(len(items), dtype=peer_dtype(width))
+    if items:
+        ret['info_hash'] = np.frombuffer(b''.join(x[0] for x in items), dtype=np.uint8).reshape(-1, width)
+        compact = np.frombuffer(b''.join(x[1] for x in items), dtype=[('ip', '>u4'), ('port', '>u2')])
+        ret['ip'], ret['port'] = compact['ip'], compact['port']
+        ret['time'] = [x[2] for x in items]
+    return ret
+
+
+def decode_peers(records: np.ndarray, now=None) -> list[tuple[bytes, bytes, float]]:
+    """ reverse of `encode_peers` in announcement order, announcements older than a week are dropped """
+    now = time.time() if now is None else now
+    records = records[records['time'] + ONE_WEEK > now]
+    records = records[np.argsort(records['time'], kind='stable')]
+    compact = np.empty(len(records), dtype=[('ip', '>u4'), ('port', '>u2')])
+    compact['ip'], compact['port'] = records['ip'], records['port']
+    return list(zip(map(bytes, records['info_hash']), map(bytes, compact), records['time'].tolist()))
+
+
+def dump(path: str, root: bytes, nodes: np.ndarray, peers: np.ndarray):
+    """ write a snapshot atomically, readers never see a half written file """
+    header = HEADER.pack(MAGIC, VERSION, len(root), len(nodes), len(peers))
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as fp:
+        fp.write(header)
+        fp.write(root)
+        fp.write(np.ascontiguousarray(nodes, dtype=node_dtype(len(root))).tobytes())
+        fp.write(np.ascontiguousarray(peers, dtype=peer_dtype(len(root))).tobytes())
+    os.replace(tmp, path)
+
+
+def load(path: str) -> Snapshot | None:
+    """ memory map a snapshot, return None if there is none, raise `SnapshotError` for a broken file """
+    try:
+        size = os.path.getsize(path)
+        mtime = os.path.getmtime(path)
+        with open(path, 'rb') as fp:
+            head = fp.read(HEADER.size)
+            if len(head) < HEADER.size:
+                raise SnapshotError('Snapshot.load|truncated header|path={}'.format(path))
+            magic, version, width, n_nodes, n_peers = HEADER.unpack(head)
+            root = fp.read(width)
+    except FileNotFoundError:
+        return None
+
+    if magic != MAGIC or version != VERSION:
+        raise SnapshotError('Snapshot.load|unknown format|magic={}|version={}'.format(magic, version))
+    nodes_type, peers_type = node_dtype(width), peer_dtype(width)
+    offset = HEADER.size + width
+    if size != offset + n_nodes * nodes_type.itemsize + n_peers * peers_type.itemsize:
+        raise SnapshotError('Snapshot.load|size mismatch|path={}|size={}'.format(path, size))
+
+    nodes = _memmap(path, nodes_type, offset, n_nodes)
+    peers = _memmap(path, peers_type, offset + n_nodes * nodes_type.itemsize, n_peers)
+    return Snapshot(root, nodes, peers, mtime)
+
+
+def _memmap(path, dtype, offset, count) -> np.ndarray:
+    if not count:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
@@ -0,0 +1,157 @@
+import asyncio as aio
+import bisect
+import hashlib
+import math
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import bencodepy
+import numpy as np
+
+from .constants import DEFAULT_BIT_TORRENT_CONFIG
+
+"""
+    mmap piece storage
+
+    the files of a torrent are preallocated and mapped once, a PIECE block is copied from the receive
+    buffer of the framer, see `framer.Framer`, straight into the page cache by a slice assignment on
+    the map. that is the only copy of the block in the process, the kernel writes the pages back in
+    the background, so `write` does not block the loop on disk io
+
+    hashing a piece reads it from the maps in a thread pool, `hashlib` releases the GIL for data
+    longer than 2 KiB, so pieces are verified in parallel and off the loop. `rehash` checks every
+    piece of existing files the same way, to resume a download
+
+    Examples:
+    >>> storage = FileStorage.from_info('/data/torrents', info)
+    >>> have = await storage.rehash(hashes)
+    >>> download = session.add(Download.from_info(info_hash, info, storage, have=have))
+    >>> await download.run(peers)
+    >>> storage.close()
+
+    refer:
+     https://docs.python.org/3/library/mmap.html
+     https://docs.python.org/3/library/hashlib.html    # the GIL is released while hashing
+"""
+
+
+class FileStorage:
+    """
+    `files` is [(path, length)] in torrent order, pieces run across file boundaries. `executor`, shared
+    by several storages if given, hashes and flushes, otherwise one of `threads` threads is created
+    """
+
+    def __init__(self, files, piece_length: int, preallocate=True, executor: ThreadPoolExecutor = None,
+                 threads: int = None):
+        self.piece_length = piece_length
+        self.paths = [x[0] for x in files]
+        self.lengths = [x[1] for x in files]
+        self.length = sum(self.lengths)
+        self.offsets = [0]      # start of every file in the torrent
+        for length in self.lengths[:-1]:
+            self.offsets.append(self.offsets[-1] + length)
+        self._own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(
+            threads or DEFAULT_BIT_TORRENT_CONFIG.get('storage_threads', 4), thread_name_prefix='storage',
+        )
+        self.maps = [self._open(path, length, preallocate) for path, length in files]
+
+    @classmethod
+    def from_info(cls, root: str, info: bytes, **kwargs) -> 'FileStorage':
+        """ the files of a bencoded info dictionary below directory `root` """
+        d = bencodepy.decode(info)
+        name = _safe_path([d.get(b'name.utf-8', d.get(b'name', b''))])
+        if b'files' in d:
+            files = [
+                (os.path.join(root, name, _safe_path(f.get(b'path.utf-8', f.get(b'path', [])))), f[b'length'])
+                for f in d[b'files']
+            ]
+        else:
+            files = [(os.path.join(root, name), d[b'length'])]
+        return cls(files, d[b'piece length'], **kwargs)
+
+    @staticmethod
+    def _open(path: str, length: int, preallocate: bool):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < length:
+                if preallocate and hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(fd, 0, length)
+                else:
+                    os.ftruncate(fd, length)
+            # empty files can not be mapped, they have no piece data anyway
+            return mmap.mmap(fd, length) if length else None
+        finally:
+            # the map keeps its own reference to the file
+            os.close(fd)
+
+    @property
+    def pieces(self) -> int:
+        return math.ceil(self.length / self.piece_length)
+
+    def piece_size(self, index: int) -> int:
+        return min(self.piece_length, self.length - index * self.piece_length)
+
+    def _spans(self, offset: int, length: int):
+        """ yield (map, offset in the file, offset in the data, length) of a range of the torrent """
+        i = bisect.bisect_right(self.offsets, offset) - 1
+        done = 0
+        while done < length:
+            start = offset + done - self.offsets[i]
+            n = min(self.lengths[i] - start, length - done)
+            if n > 0:
+                yield self.maps[i], start, done, n
+                done += n
+            i += 1
+
+    def write(self, index: int, begin: int, block: memoryview):
+        """ the one copy of a block, from the receive buffer into the page cache """
+        for mm, start, i, n in self._spans(index * self.piece_length + begin, len(block)):
+            mm[start:start + n] = block[i:i + n]
+
+    def read(self, index: int, begin: int, length: int) -> bytes:
+        return b''.join(mm[start:start + n] for mm, start, _, n in self._spans(index * self.piece_length + begin, length))
+
+    def hash_piece(self, index: int) -> bytes:
+        """ sha1 of a piece, runs in the executor """
+        h = hashlib.sha1()
+        for mm, start, _, n in self._spans(index * self.piece_length, self.piece_size(index)):
+            with memoryview(mm) as view:
+                h.update(view[start:start + n])
+        return h.digest()
+
+    async def verify(self, index: int, digest: bytes) -> bool:
+        loop = aio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.hash_piece, index) == digest
+
+    async def rehash(self, hashes: bytes) -> np.ndarray:
+        """ the pieces of existing files matching `hashes`, every thread of the executor hashes at once """
+        loop = aio.get_running_loop()
+        digests = await aio.gather(*(
+            loop.run_in_executor(self.executor, self.hash_piece, i) for i in range(self.pieces)
+        ))
+        return np.array([d == hashes[i * 20:i * 20 + 20] for i, d in enumerate(digests)], dtype=np.bool_)
+
+    async def flush(self):
+        """ write the dirty pages back, for a durable checkpoint """
+        loop = aio.get_running_loop()
+        await aio.gather(*(loop.run_in_executor(self.executor, mm.flush) for mm in self.maps if mm is not None))
+
+    def close(self):
+        # a map can not be closed while a hashing thread holds a view of it
+        if self._own_executor:
+            self.executor.shutdown(wait=True)
+        for mm in self.maps:
+            if mm is not None:
+                mm.close()
+        self.maps = []
+
+
+def _safe_path(parts) -> str:
+    """ a relative path of a torrent, parts which would leave the download directory are refused """
+    parts = [x.decode('utf8', 'replace') if isinstance(x, bytes) else x for x in parts]
+    if not parts or any(x in ('', '.', '..') or '/' in x or '\\' in x or '\0' in x for x in parts):
+        raise ValueError('storage._safe_path|unsafe path|path=%r' % parts)
+    return os.path.join(*parts)
@@ -1,10 +1,31 @@
-import json, socket
+import json, os, random, socket, struct, logging, time
+import asyncio as aio
+import hashlib
 import bencodepy
 
 import pytest
 import numpy as np
-from . import constants, krpc
-from .node import Node, distance, DHT
+from . import constants, krpc, codec, snapshot
+from .node import Node, NodeInfo, distance, DHT
+from .transaction import TransactionManager
+from .resolver import BootstrapResolver
+from .peer_store import PeerStore, bloom_estimate
+from .cluster import Channel, ShardedDHT
+from .udp import create_batch_endpoint
+from .limiter import RateLimiter, VerifyQueue
+from .access_log import AccessSampler, LazyPacket, start_background_logging, stop_background_logging
+from .simulator import SimNetwork, Swarm
+from .metrics import Histogram, KrpcMetrics, KrpcCollector
+from . import daemon
+from .crawler import Crawler, InfohashIndex
+from .framer import Framer, FrameError, HANDSHAKE, KEEP_ALIVE, parse_piece
+from .bittorrent import BitTorrentProtocol, Message, MessageType
+from .metadata import MetadataFetcher, MetadataError, UT_METADATA_ID, parse_info
+from .session import Session, Torrent
+from .download import Download, BLOCK_SIZE
+from .storage import FileStorage
+from common.constants import ErrCode
+from common.utils import error_response
 from . import krpc
 
 _0001 = Node(b'\x01')
@@ -28,6 +49,24 @@ dht.puts([
 ])
 
 
+async def create_swarm(size):
+    """ `size` protocols on loopback, every one knows all the others """
+    loop = aio.get_running_loop()
+    protocols = []
+    for _ in range(size):
+        n = Node.create_random()
+        trans, p = await loop.create_datagram_endpoint(
+            lambda: krpc.KrpcProtocol(n, DHT(n, 32), logging.getLogger('krpc'), []),
+            local_addr=('127.0.0.1', 0),
+        )
+        p.address = trans.get_extra_info('sockname')
+        protocols.append(p)
+    for p in protocols:
+        p._tasks.pop('bootstrap').cancel()
+        p.dht.puts([Node(x.node.data, info=NodeInfo(addr=x.address)) for x in protocols])
+    return protocols
+
+
 class TestNode:
     def test_exception(self):
         n1, n2 = Node.create_random(), Node.create_random(3)
@@ -58,6 +97,17 @@ class TestNode:
         n = Node.from_binary_string(binary_string)
         assert n.base2 == expected
 
+    def test_int_distance(self):
+        base, n = Node.create_random(), Node.create_random()
+        assert base.xor(n) == int.from_bytes(bytes(distance(base, n)), 'big')
+        assert DHT(base).bucket_index(n) == base.xor(n).bit_length() - 1
+        assert Node(b'\x04').value == 4 and not hasattr(n, '__dict__')
+
+        # information is created on demand and always carries the id
+        assert n.addr is None and n._info is None
+        assert n.information == {'id': n.base16}
+        assert Node(n.data, info=NodeInfo(addr=('1.2.3.4', 1))).addr == ('1.2.3.4', 1)
+
 
 @pytest.mark.parametrize('a,b,expected', [
     (_0100, _1111, _1011),
@@ -119,6 +169,58 @@ class TestDistributedHashTable:
             assert expected[i] == ret[i]
 
 
+    def test_get_neighbors_brute_force(self):
+        root = Node.create_random()
+        tab = DHT(root, k=1 << 12)
+        nodes = [Node.create_random() for _ in range(2000)]
+        tab.puts(nodes)
+        for _ in range(5):
+            target = Node.create_random()
+            expected = sorted(set(nodes), key=lambda x: bytes(distance(x, target)))[:16]
+            assert tab.get_neighbors(target, 16) == expected
+
+    def test_get_neighbors_shared_prefix(self):
+        # remotes choose their ids, many may share the leading 64 bits the pre-selection looks at
+        prefix = os.urandom(8)
+        tab = DHT(Node.create_random(), k=1 << 12)
+        nodes = [Node(prefix + os.urandom(12)) for _ in range(200)]
+        tab.puts(nodes)
+        target = Node(prefix + os.urandom(12))
+        expected = sorted(set(nodes), key=lambda x: bytes(distance(x, target)))[:8]
+        assert tab.get_neighbors(target, 8) == expected
+
+    def test_remove_and_compact_neighbors(self):
+        tab = DHT(_0100)
+        tab.put(Node(b'\x0b', info=NodeInfo(addr=('1.2.3.4', 6881))))
+        tab.puts([_0001, _1111])
+        tab.remove(_0001)
+        assert len(tab) == 2 and _0001 not in tab and _0001 not in tab.buckets[2]
+        assert tab.get_compact_neighbors(_1010, 8) == b'\x0b\x01\x02\x03\x04\x1a\xe1'
+        assert tab.get_neighbors(_1010, 1)[0].information.addr == ('1.2.3.4', 6881)
+
+    def test_liveness(self):
+        tab = DHT(Node(b'\x00'), k=2)
+        tab.puts([Node(b'\x80'), Node(b'\x81')])
+        tab.seen(b'\x81', query=True)
+        assert not tab.is_good(b'\x81'), 'a node must respond once before queries count'
+
+        # a full bucket keeps its nodes and asks for a ping of the least recently seen one
+        tab.seen(b'\x80')
+        tab.put(Node(b'\x82'))
+        assert b'\x82' not in tab and tab.buckets[7].replacements[0][0] == b'\x82'
+        assert list(tab.buckets[7]) == [b'\x80', b'\x81'] and tab.take_pending() == [b'\x81']
+
+        # the silent node gives way to the replacement after `max_fails` failures
+        assert not tab.failed(b'\x81') and tab.get_neighbors(Node(b'\x81'), 1)[0].data == b'\x81'
+        assert tab.failed(b'\x81')
+        assert b'\x81' not in tab and list(tab.buckets[7]) == [b'\x80', b'\x82']
+        assert tab.is_good(b'\x80') and tab.get_node(b'\x80').is_alive()
+
+        # idle buckets are refreshed with a random id inside them
+        assert tab.stale_buckets(now=time.monotonic() + tab.good_interval) == [7]
+        assert tab.bucket_index(Node(tab.random_id(3))) == 3
+
+
 class TestKrpc:
     @pytest.mark.parametrize('serializer,expected', [
         (krpc.FindNodeResponse(
@@ -126,7 +228,7 @@ class TestKrpc:
                 'id': b'\x1c\x11\xe0\x1b\xe8\xe7\x8dvZ.c3\x9f\xc9\x9af2\r\xb7T',
                 'nodes': b"\xb2c\x88#3\x1b\xeb\xaf{#&MDY\x8f\\l[\n\xcf\xdf\xb3\xe3\xc7b\xce\x1d\xcd\xa1m\xd8[\x97\xa4\x8e\xec\xfb \x18\xb0a\xd1\xa793\xf4f'\xc6w\xe2xb\x19B\x07.g\x1e\x81\xb0Mn\xd0G?\xaf\x02\x15\xe7\xb9<\xa8\xc2j\x01\xc6\xc6",
             },
-            visible_ip=b'w\x81a\xbc9k',
+            visible_addr=b'w\x81a\xbc9k',
             version=b'LT\x01\x02',
         ),
          ''),
@@ -237,6 +339,920 @@ class TestKrpc:
     #     assert req.query == expected['q']
 
 
+class TestCompactInfo:
+    def test_decode_compact(self):
+        ids = [Node.create_random().data for _ in range(3)]
+        data = b''.join(krpc.compact_node_info(x, '10.0.0.%d' % i, 6881 + i) for i, x in enumerate(ids))
+        ar = krpc.decode_compact_nodes(data)
+        assert [bytes(x) for x in ar['id']] == ids
+        assert krpc.compact_ip_ports(ar) == [('10.0.0.0', 6881), ('10.0.0.1', 6882), ('10.0.0.2', 6883)]
+        assert len(krpc.decode_compact_nodes(data[:-1])) == 0
+        assert [x.information.addr for x in krpc.decompress_node_info(data)] == krpc.compact_ip_ports(ar)
+        peers = krpc.decode_compact_peers([b'\x01\x02\x03\x04\x1a\xe1', b'\x00' * 18])
+        assert krpc.compact_ip_ports(peers) == [('1.2.3.4', 6881)]
+
+    def test_dht_put_compact(self):
+        root = Node.create_random()
+        ids = [Node.create_random().data for _ in range(64)] + [root.data]
+        data = b''.join(krpc.compact_node_info(x, '10.0.0.1', 6881) for x in ids)
+        a, b = DHT(root), DHT(root)
+        a.put_compact(krpc.decode_compact_nodes(data))
+        b.puts([Node(x, info=NodeInfo(addr=('10.0.0.1', 6881))) for x in ids[:-1]])
+        assert [list(x) for x in a.buckets] == [list(x) for x in b.buckets]
+        target = Node.create_random()
+        assert a.get_compact_neighbors(target, 8) == b.get_compact_neighbors(target, 8)
+
+
+class TestSnapshot:
+    def test_dump_and_load(self, tmp_path):
+        root = Node.create_random()
+        a = DHT(root)
+        a.puts([Node.create_random() for _ in range(64)])
+        a.puts([Node(Node.create_random().data, info=NodeInfo(addr=('10.0.0.1', 6881 + i))) for i in range(64)])
+        now = constants.ONE_WEEK * 2
+        peers = [
+            (b'a' * 20, krpc.compact_ip_port('1.2.3.4', 6881), now),
+            (b'a' * 20, krpc.compact_ip_port('1.2.3.5', 6882), 0.0),
+            (b'b' * 20, krpc.compact_ip_port('1.2.3.6', 6883), now - 1),
+        ]
+        path = str(tmp_path / 'krpc.snapshot')
+        snapshot.dump(path, root.data, a.to_compact(), snapshot.encode_peers(peers))
+
+        snap = snapshot.load(path)
+        assert snap.root == root.data
+        b = DHT(Node(snap.root))
+        b.put_compact(snap.nodes)
+        assert [list(x) for x in a.buckets] == [list(x) for x in b.buckets]
+        target = Node.create_random()
+        assert a.get_compact_neighbors(target, 16) == b.get_compact_neighbors(target, 16)
+        assert snapshot.decode_peers(snap.peers, now=now) == [peers[2], peers[0]]
+
+    def test_broken(self, tmp_path):
+        path = tmp_path / 'krpc.snapshot'
+        assert snapshot.load(str(path)) is None
+        snapshot.dump(str(path), Node.create_random().data, DHT(Node.create_random()).to_compact(),
+                      snapshot.encode_peers([]))
+        path.write_bytes(path.read_bytes() + b'\x00')
+        with pytest.raises(snapshot.SnapshotError):
+            snapshot.load(str(path))
+
+
+class TestPeerStore:
+    def test_caps_and_expire(self):
+        a, b = b'a' * 20, b'b' * 20
+        store = PeerStore(ttl=600, interval=60, max_peers=6, max_peers_per_torrent=4)
+        for i in range(5):
+            store.announce(a, krpc.compact_ip_port('1.2.3.%d' % i, 6881), now=i * 60)
+        store.announce(a, krpc.compact_ip_port('1.2.3.1', 6881), now=300)     # dedupe, moves to the newest bucket
+        assert len(store) == 4
+        assert store.get(a, now=300) == [krpc.compact_ip_port('1.2.3.%d' % i, 6881) for i in (1, 4, 3, 2)]
+
+        # global budget evicts the oldest announcements of any torrent
+        for i in range(3):
+            store.announce(b, krpc.compact_ip_port('1.2.4.%d' % i, 6881), now=360)
+        assert len(store) == 6
+        assert store.get(a, now=360) == [krpc.compact_ip_port('1.2.3.%d' % i, 6881) for i in (1, 4, 3)]
+
+        # expiry drops whole buckets
+        store.expire(now=240 + 600)
+        assert store.get(a, now=840) == [krpc.compact_ip_port('1.2.3.1', 6881)] and len(store) == 4
+        store.expire(now=360 + 600)
+        assert len(store) == 0 and a not in store and b not in store
+
+    def test_scrape(self):
+        store = PeerStore()
+        info_hash = b'a' * 20
+        for i in range(100):
+            store.announce(info_hash, krpc.compact_ip_port('10.0.%d.%d' % (i // 10, i), 6881), seed=i < 20)
+        seeds, peers = store.get_bloom(info_hash)
+        assert abs(bloom_estimate(seeds) - 20) <= 2 and abs(bloom_estimate(peers) - 80) <= 5
+
+        resp = codec.decode(codec.encode_get_peers_response(
+            b'aa', b'b' * 20, krpc.compact_ip_port('1.2.3.4', 6881), b'token', values=store.get(info_hash),
+            bloom=(seeds, peers)))
+        assert resp.extra == {b'BFsd': seeds, b'BFpe': peers} and len(resp.values) == 50
+
+
+class TestBootstrapResolver:
+    def test_lazy_resolve(self):
+        resolver = BootstrapResolver([('localhost', 6881), ('1.2.3.4', 6882)], fallback=[('5.6.7.8', 6883)])
+        assert resolver.addrs == [('1.2.3.4', 6882), ('5.6.7.8', 6883)]
+        addrs = aio.run(resolver.get())
+        assert ('127.0.0.1', 6881) in addrs and ('5.6.7.8', 6883) not in addrs
+        assert not resolver.is_expired()
+        assert BootstrapResolver([]).addrs == []
+
+        # private, ip only deployments never reach the public routers
+        resolver = BootstrapResolver([('10.0.0.1', 6881)])
+        assert resolver.addrs == [('10.0.0.1', 6881)]
+        assert aio.run(resolver.get()) == [('10.0.0.1', 6881)]
+
+
+class TestCodec:
+    def test_decode_query(self):
+        msg = codec.decode(b'd1:ad2:id20:abcdefghij01234567896:target20:mnopqrstuvwxyz123456e1:q9:find_node1:t2:aa1:y1:qe')
+        assert (msg.t, msg.y, msg.query) == (b'aa', b'q', 'find_node')
+        assert msg.validate().get_target() == b'mnopqrstuvwxyz123456'
+        with pytest.raises(codec.DecodeError):
+            codec.decode(b'd1:ad2:id3:abce1:q4:ping1:t2:aa1:y1:qe').validate()
+        with pytest.raises(codec.DecodeError):
+            codec.decode(b'd1:ad2:id20:abcdefghij0123')
+        announce = b'd1:ad2:id20:abcdefghij012345678912:implied_porti0e9:info_hash20:mnopqrstuvwxyz1234564:port%s5:token8:aoeusnthe1:q13:announce_peer1:t2:aa1:y1:qe'
+        assert codec.decode(announce % b'i6881e').validate().get_port() == 6881
+        for port in (b'i70000e', b'i0e', b'4:6881'):
+            with pytest.raises(codec.DecodeError):
+                codec.decode(announce % port).validate()
+
+        # keys holding values of the wrong type
+        for data in (
+            b'd1:ad2:idi5ee1:q4:ping1:t2:aa1:y1:qe',
+            b'd1:ad2:id20:abcdefghij01234567896:targetli1eee1:q9:find_node1:t2:aa1:y1:qe',
+            announce.replace(b'5:token8:aoeusnth', b'5:tokeni1e') % b'i6881e',
+            announce.replace(b'12:implied_porti0e', b'12:implied_port1:0') % b'i6881e',
+        ):
+            with pytest.raises(codec.DecodeError):
+                codec.decode(data).validate()
+        # the query name is read before validation, a non ascii one does not raise
+        assert codec.decode(b'd1:ad2:id20:abcdefghij0123456789e1:q2:\xff\xfe1:t2:aa1:y1:qe').query == '\ufffd\ufffd'
+
+    def test_decode_response(self):
+        nodes = b''.join(krpc.compact_node_info(Node.create_random().data, '10.0.0.1', 6881) for _ in range(3))
+        data = bencodepy.encode({b't': b'aa', b'y': b'r', b'ip': b'\x7f\x00\x00\x01\x1a\xe1',
+                                 b'r': {b'id': b'abcdefghij0123456789', b'nodes': nodes, b'p': 1}})
+        msg = codec.decode(data)
+        assert isinstance(msg.nodes, memoryview) and bytes(msg.nodes) == nodes
+        assert msg.extra == {b'p': 1}
+        assert msg.to_dict() == bencodepy.decode(data)
+
+    def test_encode_response(self):
+        t, node_id, ip = b'aa', Node.create_random().data, krpc.compact_ip_port('127.0.0.1', 6881)
+        cases = [
+            (codec.encode_get_peers_response(t, node_id, ip, b'tk', values=[b'abcdef', b'ghijkl']),
+             krpc.GetPeersResponse(transaction_id=t, visible_addr=ip, response=dict(
+                 id=node_id, token=b'tk', values=[b'abcdef', b'ghijkl'],
+             ))),
+            (codec.encode_find_node_response(t, node_id, ip, b''),
+             krpc.FindNodeResponse(transaction_id=t, visible_addr=ip, response=dict(id=node_id, nodes=b''))),
+            (codec.encode_ping_response(t, node_id, ip),
+             krpc.PingResponse(transaction_id=t, visible_addr=ip, response=dict(id=node_id))),
+        ]
+        for data, expected in cases:
+            assert codec.decode(data).to_dict() == codec.decode(expected.bencode()).to_dict()
+
+
+class TestTransactionManager:
+    def test_timeout_and_drifting(self):
+        async def run():
+            table = TransactionManager(aio.get_running_loop(), resolution=0.01)
+            slow, fast = table.create(('127.0.0.1', 1), 0.05), table.create(('127.0.0.1', 1), 0.05)
+            assert slow.tid != fast.tid and len(table) == 2
+            # a response from another address leaves the transaction pending
+            assert not table.resolve(fast.tid, ('127.0.0.2', 1), 'spoofed')
+            assert len(table) == 2 and not fast.done()
+            assert table.resolve(fast.tid, ('127.0.0.1', 1), 'pong')
+            assert await fast == 'pong'
+            with pytest.raises(aio.TimeoutError):
+                await slow
+            assert not table.resolve(slow.tid, ('127.0.0.1', 1), 'late')
+            assert table.stats() == dict(outstanding=0, created=2, responses=1, timeouts=1, drifting=2, retries=0)
+
+        aio.run(run())
+
+    def test_sharded_ids(self):
+        async def run():
+            loop = aio.get_running_loop()
+            tables = [TransactionManager(loop, shard=i, shards=3) for i in range(3)]
+            for shard, table in enumerate(tables):
+                tids = [table.create(('127.0.0.1', 1), 1).tid for _ in range(100)]
+                assert len(set(tids)) == 100
+                assert {table.owner(x) for x in tids} == {shard} and {tables[0].owner(x) for x in tids} == {shard}
+                table.cancel_all()
+            assert tables[0].owner(b'\xff\xff') is None and tables[0].owner(b'abc') is None
+
+        aio.run(run())
+
+
+class TestCluster:
+    def test_share_routing_updates(self):
+        channel = Channel(2)
+        root = Node.create_random()
+        a, b = ShardedDHT(root), ShardedDHT(root)
+        a.puts([Node(Node.create_random().data, info=NodeInfo(addr=('10.0.0.1', 6881 + i))) for i in range(32)])
+        assert channel.send(1, b''.join(a.outbox))
+        b.apply(channel.inbox(1).recv(1 << 16))
+        assert [list(x) for x in a.buckets] == [list(x) for x in b.buckets] and not b.outbox
+        channel.close()
+
+
+class TestBatchDatagramTransport:
+    class Collector(aio.DatagramProtocol):
+        def __init__(self):
+            self.packets = []
+
+        def datagram_received(self, data, addr):
+            self.packets.append(data)
+
+    def test_batch_read_and_paced_send(self):
+        async def run():
+            loop = aio.get_running_loop()
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            transport, protocol = await create_batch_endpoint(
+                loop, self.Collector, sock, batch=16, send_rate=200, send_burst=1)
+
+            client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            client.bind(('127.0.0.1', 0))
+            client.setblocking(False)
+            for i in range(100):
+                client.sendto(b'%d' % i, sock.getsockname())
+            await aio.sleep(0.05)
+            assert protocol.packets == [b'%d' % i for i in range(100)]
+            assert transport.batches < 100
+
+            # one packet leaves at once, the rest are paced at 200 per second
+            start = loop.time()
+            for i in range(10):
+                transport.sendto(b'%d' % i, client.getsockname())
+            assert transport.stats()['send_queue'] == 9
+            while transport.get_write_buffer_size():
+                await aio.sleep(0.01)
+            assert loop.time() - start >= 0.04
+            assert [client.recv(16) for _ in range(10)] == [b'%d' % i for i in range(10)]
+            transport.close()
+            client.close()
+
+        aio.run(run())
+
+
+class TestLimiter:
+    def test_rate_limiter(self):
+        limiter = RateLimiter(rate=10, burst=5, max_sources=2)
+        assert [limiter.allow('1.1.1.1', now=0) for _ in range(6)] == [True] * 5 + [False]
+        assert limiter.allow('1.1.1.1', now=0.1) and not limiter.allow('1.1.1.1', now=0.1)
+        limiter.allow('2.2.2.2', now=0)
+        limiter.allow('3.3.3.3', now=0)
+        assert len(limiter) == 2 and limiter.allow('1.1.1.1', now=0.1)    # evicted, starts with a full bucket
+
+    def test_inline_handling_and_verify_queue(self):
+        class Transport:
+            def __init__(self):
+                self.sent = []
+
+            def sendto(self, data, addr):
+                self.sent.append((data, addr))
+
+        async def run():
+            n = Node.create_random()
+            p = krpc.KrpcProtocol(n, DHT(n), logging.getLogger('krpc'), [])
+            p.transport, p.transactions = Transport(), TransactionManager(aio.get_running_loop())
+            p.limiter = RateLimiter(rate=1, burst=3)
+            requester = Node.create_random().data
+            for i in range(5):
+                req = krpc.FindNodeRequest(transaction_id=b'%d' % i, arguments=dict(id=requester, target=requester))
+                p.datagram_received(req.bencode(), ('10.0.0.1', 6881))
+
+            # answered inside the callback, without a task
+            assert [codec.decode(x[0]).t for x in p.transport.sent] == [b'0', b'1', b'2']
+            assert p.limiter.stats()['limited'] == 2
+            assert len(p.verify_queue) == 1 and p.verify_queue.stats()['duplicated'] == 2
+
+        aio.run(run())
+
+    def test_verify_queue(self):
+        verified = []
+
+        async def verify(key, addr):
+            if key == b'b':
+                raise aio.TimeoutError
+            verified.append((key, addr))
+
+        async def run():
+            queue = VerifyQueue(verify, rate=1000, maxsize=3)
+            results = [queue.push(key, ('10.0.0.1', i)) for i, key in enumerate((b'a', b'a', b'b', b'c', b'd'))]
+            task = aio.get_running_loop().create_task(queue.run())
+            while len(queue) or queue.verified + queue.failed < 3:
+                await aio.sleep(0.01)
+            # a push wakes up the idle queue
+            queue.push(b'e', ('10.0.0.1', 5))
+            while queue.verified < 3:
+                await aio.sleep(0.01)
+            task.cancel()
+            # verified and failed requesters are not queued again until the ttl passes
+            results += [queue.push(b'a', ('10.0.0.1', 0)), queue.push(b'b', ('10.0.0.1', 2))]
+            results.append(queue.push(b'a', ('10.0.0.1', 0), now=time.monotonic() + queue.ttl))
+            return results, queue
+
+        results, queue = aio.run(run())
+        assert results == [True, False, True, True, False, False, False, True]
+        assert verified == [(b'a', ('10.0.0.1', 0)), (b'c', ('10.0.0.1', 3)), (b'e', ('10.0.0.1', 5))]
+        assert (queue.duplicated, queue.recent, queue.overflowed, queue.failed) == (1, 2, 1, 1)
+
+
+class TestAccessLog:
+    def test_sampler(self):
+        sampler = AccessSampler({'q': 0.25, 'q:announce_peer': 1, 'r': 0})
+        assert [sampler.sample('q', 'ping') for _ in range(8)] == [True, False, False, False] * 2
+        assert all(sampler.sample('q', 'announce_peer') for _ in range(4))
+        assert not any(sampler.sample('r') for _ in range(4))
+        assert sampler.sample('e', '203') and sampler.sampled == 7
+
+        # remote chosen query names share one counter, disabled keys are stored once
+        assert [sampler.sample('q', 'x%d' % i) for i in range(8)] == [True, False, False, False] * 2
+        assert sorted(sampler._counters) == [('e', '203'), ('q', 'announce_peer'), ('q', 'other'), ('q', 'ping'), ('r', None)]
+
+    def test_background_logging(self):
+        logger = logging.getLogger('krpc.test_background')
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger.addHandler(handler)
+        listener = start_background_logging(logger)
+        assert start_background_logging(logger) is None
+        logger.warning('queued')
+        stop_background_logging(logger, listener)
+        assert logger.handlers == [handler] and not listener._thread
+        assert [x.getMessage() for x in records] == ['queued']
+        logger.removeHandler(handler)
+
+    def test_lazy_packet(self):
+        node_id = Node.create_random().data
+        msg = codec.decode(krpc.PingRequest(transaction_id=b'\x01\x02', arguments=dict(id=node_id)).bencode())
+        assert AccessSampler.kind_of(msg) == ('q', 'ping')
+        assert str(LazyPacket(msg, ('1.2.3.4', 6881))) == 'from=1.2.3.4:6881|y=q|q=ping|t=0102|id=' + node_id.hex()
+
+
+class TestSimulator:
+    def test_swarm_lookup(self):
+        async def run():
+            swarm = Swarm(64, SimNetwork(latency=(0.001, 0.002), seed=1), seed=1, verify_rate=1000)
+            await swarm.start()
+            await swarm.bootstrap()
+            assert swarm.convergence() > 0.8
+            report = await swarm.run_lookups(20)
+            swarm.stop()
+            return report
+
+        report = aio.run(run())
+        assert report['precision'] > 0.9 and report['packets_per_lookup'] > 0
+        assert report['latency_p50'] <= report['latency_p99']
+
+
+class TestIterPeers:
+    def test_stream_and_cancel(self):
+        info_hash = Node.create_random().data
+
+        async def run():
+            swarm = Swarm(32, SimNetwork(latency=(0.001, 0.002), seed=3), seed=3, verify_rate=1000)
+            await swarm.start()
+            await swarm.bootstrap(rounds=1)
+            for p in swarm.protocols[1:]:
+                for i in range(5):
+                    p.peers.announce(info_hash, krpc.compact_ip_port('10.1.0.%d' % i, 6881))
+            p = swarm.protocols[0]
+            peers = [x async for x in p.iter_peers(info_hash, addrs=(), timeout=5)]
+
+            # closing the generator early cancels the lookup and its queries
+            agen = p.iter_peers(info_hash, addrs=(), timeout=5)
+            first = await agen.__anext__()
+            await agen.aclose()
+            await aio.sleep(0.01)
+            lookups = [x for x in aio.all_tasks() if x.get_coro().__name__ in ('lookup', 'get_peers')]
+            swarm.stop()
+            return peers, first, lookups
+
+        peers, first, lookups = aio.run(run())
+        assert sorted(peers) == [('10.1.0.%d' % i, 6881) for i in range(5)]
+        assert first in peers and not lookups
+
+
+class TestCrawler:
+    def test_index(self, tmp_path):
+        hashes = [Node.create_random().data for _ in range(1000)]
+        index = InfohashIndex(str(tmp_path), segment_size=28 * 100, touch_interval=60, capacity=16)
+        assert index.add(b''.join(hashes[:600]), now=1000) == 600
+        assert index.add(b''.join(hashes[500:] + hashes[:10]), now=1030) == 400
+        assert index.add(b''.join(hashes[:5]), now=1100) == 0
+        assert index.get(hashes[0]) == (1000, 1100) and index.get(hashes[10]) == (1000, 1000)
+        assert index.get(hashes[999]) == (1030, 1030) and bytes(20) not in index
+        assert index.records == 1005
+        index.close()
+
+        # replayed from the segments
+        reloaded = InfohashIndex(str(tmp_path))
+        assert len(reloaded) == 1000 and len(os.listdir(tmp_path)) > 1
+        assert all(reloaded.get(x) == index.get(x) for x in hashes)
+
+    def test_sample_infohashes(self, tmp_path):
+        hashes = set()
+
+        async def run():
+            swarm = Swarm(64, SimNetwork(latency=(0.001, 0.005), seed=5), seed=5)
+            await swarm.start()
+            await swarm.bootstrap()
+            for p in swarm.protocols[1:]:
+                for _ in range(3):
+                    info_hash = Node.create_random().data
+                    hashes.add(info_hash)
+                    p.peers.announce(info_hash, krpc.compact_ip_port('10.1.0.1', 6881))
+            p, q = swarm.protocols[:2]
+            resp = await p.sample_infohashes(Node.create_random().data, q.address)
+
+            crawler = Crawler(p, InfohashIndex(str(tmp_path)), concurrency=8, rate=10000, flush_interval=0.05)
+            await crawler.run(duration=1)
+            swarm.stop()
+            return resp, q, crawler
+
+        resp, q, crawler = aio.run(run())
+        assert resp.get_num() == 3 and resp.get_interval() == constants.DEFAULT_KRPC_CONFIG['sample_interval']
+        assert sorted(resp.get_samples()[i:i + 20] for i in range(0, 60, 20)) == sorted(q.peers._torrents)
+        assert crawler.responses == crawler.queries - crawler.timeouts
+        # every node is sampled once, its interval is not over yet
+        assert crawler.responses <= 64 and len(crawler.index) > len(hashes) * 0.75
+        assert all(x in hashes for x in map(bytes, crawler.index.to_array()['key']))
+
+
+class TestFramer:
+    @staticmethod
+    def _stream():
+        def message(msg_id, payload=b''):
+            return struct.pack('>IB', len(payload) + 1, msg_id) + payload
+
+        handshake = Message(os.urandom(20), os.urandom(20)).handshake()
+        frames = [(HANDSHAKE, handshake), (KEEP_ALIVE, b''), (4, struct.pack('>I', 7)), (5, os.urandom(300))]
+        frames += [(7, struct.pack('>II', i, 0) + os.urandom(1 << 14)) for i in range(8)]
+        frames += [(20, os.urandom(300000)), (1, b'')]
+        data = b''.join(x if msg_id == HANDSHAKE else struct.pack('>I', 0) if msg_id == KEEP_ALIVE
+                        else message(msg_id, x) for msg_id, x in frames)
+        return data, frames
+
+    @pytest.mark.parametrize('seed', range(6))
+    def test_segmentation(self, seed):
+        data, frames = self._stream()
+        rnd = random.Random(seed)
+        framer, got, i = Framer(capacity=1 << 14), [], 0
+        while i < len(data):
+            if seed % 2:
+                n = rnd.randint(1, 40000)
+                framer.feed(data[i:i + n])
+            else:
+                buf = framer.get_buffer(-1)
+                n = min(len(buf), rnd.choice([1, 5, 67, 16397, 65536]), len(data) - i)
+                buf[:n] = data[i:i + n]
+                framer.buffer_updated(n)
+            i += n
+            got.extend((msg_id, bytes(x)) for msg_id, x in framer.frames())
+        assert got == frames and len(framer) == 0
+
+    def test_piece_view_and_limit(self):
+        framer = Framer(handshake=False, max_length=1 << 15)
+        block = os.urandom(1 << 14)
+        framer.feed(struct.pack('>IBII', len(block) + 9, 7, 3, 1 << 14) + block)
+        (msg_id, payload), = framer.frames()
+        index, begin, view = parse_piece(payload)
+        assert (msg_id, index, begin) == (7, 3, 1 << 14) and view == block and isinstance(view, memoryview)
+
+        framer.feed(struct.pack('>I', (1 << 15) + 1))
+        with pytest.raises(FrameError):
+            list(framer.frames())
+
+    def test_protocol(self):
+        class Transport:
+            def __init__(self):
+                self.data, self.closed = b'', False
+
+            def write(self, data):
+                self.data += data
+
+            def close(self):
+                self.closed = True
+
+        info_hash = os.urandom(20)
+        p = BitTorrentProtocol(os.urandom(20), None, logging.getLogger('bt'))
+        p.connection_made(Transport())
+        received = []
+        p.message_received = lambda msg_id, payload: received.append((msg_id, bytes(payload)))
+        data = Message(os.urandom(20), info_hash).handshake() + struct.pack('>IBI', 5, 4, 9)
+        p.data_received(data[:30])
+        assert p.status == p.STATUS_CONNECTING
+        p.data_received(data[30:])
+        assert p.status == p.STATUS_NORMAL and p.info_hash == info_hash and p.transport.data[28:48] == info_hash
+        assert received == [(4, struct.pack('>I', 9))]
+
+        p.data_received(struct.pack('>I', 1 << 30))
+        assert p.status == p.STATUS_DISCONNECTED and p.transport.closed
+
+
+class TestMetadata:
+    @staticmethod
+    async def seed(info: bytes, mode=None):
+        """ a peer serving the metadata of `info`, `mode` silent ignores requests and corrupt garbles them """
+        async def handle(reader, writer):
+            framer = Framer()
+            while data := await reader.read(1 << 16):
+                framer.feed(data)
+                for msg_id, payload in framer.frames():
+                    if msg_id == HANDSHAKE:
+                        writer.write(bytes(payload[:20]) + bytes([0, 0, 0, 0, 0, 0x10, 0, 0]) + bytes(payload[28:48]) + os.urandom(20))
+                        writer.write(Message(os.urandom(20)).extended_handshake({'ut_metadata': 1}, metadata_size=len(info)))
+                    elif msg_id == MessageType.EXTENDED and payload[0] == 1 and mode != 'silent':
+                        piece = bencodepy.decode(bytes(payload[1:]))[b'piece']
+                        chunk = info[piece << 14:(piece + 1) << 14]
+                        chunk = os.urandom(len(chunk)) if mode == 'corrupt' else chunk
+                        body = bencodepy.encode({'msg_type': 1, 'piece': piece, 'total_size': len(info)}) + chunk
+                        writer.write(struct.pack('>IBB', len(body) + 2, MessageType.EXTENDED, UT_METADATA_ID) + body)
+            writer.close()
+
+        server = await aio.start_server(handle, '127.0.0.1', 0)
+        return server, server.sockets[0].getsockname()[:2]
+
+    def test_fetch(self):
+        info = bencodepy.encode({'name': 'a', 'piece length': 1 << 18, 'pieces': os.urandom(20 * 2000), 'length': 1 << 29})
+        info_hash = hashlib.sha1(info).digest()
+
+        async def run():
+            seeds = [await self.seed(info, mode) for mode in ('silent', 'corrupt', None, None)]
+            fetcher = MetadataFetcher(peers_per_torrent=2, connect_timeout=0.5, piece_timeout=0.2)
+            ret = await fetcher.fetch(info_hash, (addr for _, addr in seeds), timeout=5)
+            with pytest.raises(MetadataError):
+                await fetcher.fetch(info_hash, [seeds[1][1], ('127.0.0.1', 1)], timeout=5)
+            for server, _ in seeds:
+                server.close()
+            return ret, fetcher
+
+        ret, fetcher = aio.run(run())
+        assert ret == info and parse_info(ret) == dict(name='a', length=1 << 29, files=[('a', 1 << 29)], piece_length=1 << 18)
+        assert (fetcher.fetched, fetcher.failed) == (1, 1) and fetcher.metrics.handshakes >= 3
+
+
+class TestSession:
+    class Recorder(Torrent):
+        def __init__(self, info_hash, max_connections=None):
+            super().__init__(info_hash, max_connections)
+            self.connected, self.received = [], []
+
+        def peer_connected(self, conn):
+            self.connected.append(conn.remote_peer_id)
+
+        def message_received(self, conn, msg_id, payload):
+            self.received.append((msg_id, bytes(payload)))
+
+    def test_route_and_limits(self):
+        a_hash, b_hash = os.urandom(20), os.urandom(20)
+
+        async def run():
+            server = Session(address=('127.0.0.1', 0), max_connections=4, handshake_timeout=0.2)
+            client = Session(max_connections=8)
+            await server.start()
+            await client.start()
+            a, b = server.add(self.Recorder(a_hash, max_connections=1)), server.add(self.Recorder(b_hash))
+            a_out, b_out = client.add(self.Recorder(a_hash)), client.add(self.Recorder(b_hash))
+
+            # both torrents share the listening socket
+            conn = await a_out.connect(server.address)
+            await b_out.connect(server.address)
+            await aio.sleep(0.05)
+            conn.write(struct.pack('>IBI', 5, MessageType.HAVE, 7))
+            await aio.sleep(0.05)
+            routed = len(a.peers), len(b.peers), len(a_out.peers), a.connected == [client.peer_id], a.received
+
+            # a full torrent and an unknown one are dropped without an answer
+            await a_out.connect(server.address)
+            reader, writer = await aio.open_connection(*server.address)
+            writer.write(Message(os.urandom(20), os.urandom(20)).handshake())
+            dropped = await reader.read(100)
+            await aio.sleep(0.05)
+            refused = server.refused, len(a.peers), len(a_out.peers)
+
+            # silent connections time out, the last one exceeds the connection cap
+            silent = [await aio.open_connection(*server.address) for _ in range(3)]
+            await aio.sleep(0.05)
+            capped = len(server.connections)
+            await aio.sleep(0.3)
+            timeouts = server.handshake_timeouts, len(server.connections)
+            for _, w in silent:
+                w.close()
+            writer.close()
+            await client.close()
+            await server.close()
+            return routed, dropped, refused, capped, timeouts
+
+        routed, dropped, refused, capped, timeouts = aio.run(run())
+        assert routed == (1, 1, 1, True, [(MessageType.HAVE, struct.pack('>I', 7))])
+        assert dropped == b'' and refused == (2, 1, 1)
+        assert capped == 4 and timeouts == (2, 2)
+
+
+class TestDownload:
+    class Seed(Torrent):
+        """ unchokes everyone and serves the pieces in `bitfield`, `corrupt` ones with a flipped byte """
+        def __init__(self, info_hash, data, piece_length, bitfield, corrupt=()):
+            super().__init__(info_hash)
+            self.data, self.piece_length, self.bitfield, self.corrupt = data, piece_length, bitfield, set(corrupt)
+
+        def peer_connected(self, conn):
+            payload = np.packbits(self.bitfield).tobytes()
+            conn.write(struct.pack('>IB', len(payload) + 1, MessageType.BITFIELD) + payload + struct.pack('>IB', 1, MessageType.UNCHOKE))
+
+        def message_received(self, conn, msg_id, payload):
+            if msg_id == MessageType.REQUEST:
+                index, begin, length = struct.unpack('>III', payload)
+                offset = index * self.piece_length + begin
+                block = bytearray(self.data[offset:offset + length])
+                if index in self.corrupt:
+                    self.corrupt.discard(index)
+                    block[0] ^= 0xff
+                conn.write(struct.pack('>IBII', length + 9, MessageType.PIECE, index, begin) + block)
+
+    def test_pick(self):
+        d = Download(os.urandom(20), 4 * BLOCK_SIZE, 10 * 4 * BLOCK_SIZE - 100, bytes(200), queue_depth=4)
+        d.availability[:] = [5, 1, 2, 1, 9, 9, 9, 9, 9, 9]
+        d._update_keys()
+        peer = np.ones(10, dtype=np.bool_)
+        # the rarest pieces, 1 and 3, tie
+        assert d.block_piece[d.pick(peer, 4)][0] in (1, 3)
+        # a started piece goes first, the short last piece has 4 blocks too
+        d.free[7] -= 1
+        d.requested[d.first_block[7]] = 1
+        d._update_keys(7)
+        assert d.pick(peer, 3) == list(range(d.first_block[7] + 1, d.first_block[7] + 4))
+        assert d._block_length(len(d.block_piece) - 1) == BLOCK_SIZE - 100
+        # pieces the peer lacks or we have are skipped
+        d.free[[1, 3]] = 0
+        d._update_keys()
+        peer[2] = False
+        assert set(d.block_piece[d.pick(peer, 7)]) == {7, 0}
+
+    @pytest.mark.parametrize('on_disk', [False, True])
+    def test_swarm(self, on_disk, tmp_path):
+        piece_length = 2 * BLOCK_SIZE
+        data = os.urandom(40 * piece_length - 5000)
+        pieces = -(-len(data) // piece_length)
+        hashes = b''.join(hashlib.sha1(data[i:i + piece_length]).digest() for i in range(0, len(data), piece_length))
+        info_hash = os.urandom(20)
+        half = np.arange(pieces) % 2 == 0
+
+        async def run():
+            seeds = []
+            for bitfield, corrupt in ((np.ones(pieces, dtype=np.bool_), (3,)), (half, ()), (~half, (3,))):
+                session = Session(address=('127.0.0.1', 0))
+                await session.start()
+                session.add(self.Seed(info_hash, data, piece_length, bitfield, corrupt))
+                seeds.append(session)
+            session = Session()
+            await session.start()
+            files = [(str(tmp_path / 'a'), 40000), (str(tmp_path / 'b' / 'c'), 0), (str(tmp_path / 'd'), len(data) - 40000)]
+            storage = FileStorage(files, piece_length) if on_disk else None
+            download = session.add(Download(info_hash, piece_length, len(data), hashes, storage, queue_depth=4))
+            await aio.wait_for(download.run([x.address for x in seeds]), 10)
+            for x in seeds + [session]:
+                await x.close()
+            return download
+
+        download = aio.run(run())
+        progress = download.progress()
+        # whichever seed serves piece 3 first garbles it
+        assert progress['have'] == pieces and 1 <= progress['hash_failures'] <= 2
+        assert b''.join(download.storage.read(i, 0, download.storage.piece_size(i)) for i in range(pieces)) == data
+        if on_disk:
+            download.storage.close()
+            assert (tmp_path / 'a').read_bytes() + (tmp_path / 'd').read_bytes() == data
+        assert not download.requested.any() and not download.free.any()
+
+
+class TestStorage:
+    def test_rehash(self, tmp_path):
+        piece_length = 1 << 15
+        data = os.urandom(5 * piece_length + 123)
+        hashes = b''.join(hashlib.sha1(data[i:i + piece_length]).digest() for i in range(0, len(data), piece_length))
+        info = bencodepy.encode({'name': 't', 'piece length': piece_length, 'pieces': hashes, 'files': [
+            {'path': ['x', 'y'], 'length': 70000}, {'path': ['e'], 'length': 0}, {'path': ['z'], 'length': len(data) - 70000},
+        ]})
+
+        async def run():
+            storage = FileStorage.from_info(str(tmp_path), info, threads=2)
+            empty = await storage.rehash(hashes)
+            for index in range(storage.pieces):
+                for begin in range(0, storage.piece_size(index), BLOCK_SIZE):
+                    offset = index * piece_length + begin
+                    storage.write(index, begin, memoryview(data)[offset:min(offset + BLOCK_SIZE, offset - begin + storage.piece_size(index))])
+            verified = [await storage.verify(i, hashes[i * 20:i * 20 + 20]) for i in range(storage.pieces)]
+            await storage.flush()
+            storage.close()
+
+            # a resumed download finds every piece but a damaged one
+            with open(tmp_path / 't' / 'z', 'r+b') as fp:
+                fp.seek(100000 - 70000)
+                fp.write(b'\0')
+            storage = FileStorage.from_info(str(tmp_path), info)
+            have = await storage.rehash(hashes)
+            storage.close()
+            return empty, verified, have
+
+        empty, verified, have = aio.run(run())
+        assert not empty.any() and all(verified)
+        assert have.tolist() == [True, True, True, False, True, True]
+        assert os.path.getsize(tmp_path / 't' / 'x' / 'y') == 70000 and os.path.exists(tmp_path / 't' / 'e')
+        for path in (['..', 'etc'], []):
+            with pytest.raises(ValueError):
+                FileStorage.from_info(str(tmp_path), bencodepy.encode({'name': 't', 'piece length': 1, 'pieces': b'', 'files': [{'path': path, 'length': 1}]}))
+
+
+class TestKrpcFacade:
+    def test_call_from_other_loop(self, monkeypatch):
+        class LocalKrpc(krpc.Krpc):
+            bootstrap_addrs = []
+
+        monkeypatch.setitem(constants.DEFAULT_KRPC_CONFIG, 'max_callers', 2)
+        logger = logging.getLogger('krpc.test_facade')
+        handler = logging.NullHandler()
+        logger.addHandler(handler)
+        k = LocalKrpc(address=('127.0.0.1', 0), snapshot_path='', logger=logger)
+        # the log listener thread runs with the server only
+        assert logger.handlers == [handler]
+        k.start()
+        try:
+            while getattr(k, 'core', None) is None:
+                time.sleep(0.01)
+            assert logger.handlers != [handler]
+            addr = k.sock.getsockname()
+
+            async def run():
+                resp = await k.call(k.core.ping, addr, deadline=3)
+                start = time.monotonic()
+                await aio.gather(*[k.call(aio.sleep, 0.1) for _ in range(4)])
+                elapsed = time.monotonic() - start
+                with pytest.raises(aio.TimeoutError):
+                    await k.call(aio.sleep, 1, deadline=0.05)
+                return resp, elapsed
+
+            resp, elapsed = aio.run(run())
+            assert resp.get_queried_id() == k.root.data
+            assert elapsed >= 0.2, 'only two callers run at once'
+            assert k.call_sync(k.core.ping, addr, deadline=3).get_queried_id() == k.root.data
+        finally:
+            k.stop()
+            logger.removeHandler(handler)
+        assert logger.handlers == []
+
+
+class TestDaemon:
+    def test_request_and_lock(self, tmp_path):
+        class LocalKrpc(krpc.Krpc):
+            bootstrap_addrs = []
+
+        path = str(tmp_path / 'krpc.sock')
+        k = LocalKrpc(address=('127.0.0.1', 0), snapshot_path='')
+        d = daemon.Daemon(path, k)
+        d.acquire_lock()
+        k.start()
+        try:
+            with pytest.raises(RuntimeError):
+                daemon.Daemon(path, k).acquire_lock()
+            while getattr(k, 'core', None) is None:
+                time.sleep(0.01)
+
+            async def run():
+                server = await aio.start_unix_server(d.handle, path)
+                async with server:
+                    client = daemon.DaemonClient(path, timeout=5)
+                    status = await client.request('status')
+                    unknown = await client.request('vote')
+                    peers = [x async for x in client.stream('iter_peers', info_hash='11' * 20, timeout=0.2)]
+                return status, unknown, peers
+
+            status, unknown, peers = aio.run(run())
+            assert status['errcode'] == ErrCode.SUCCESS and status['ping'] == k.root.base16
+            assert unknown['errcode'] == ErrCode.INVALID_PARAMETERS
+            assert peers == [error_response(ErrCode.SUCCESS)]
+        finally:
+            d.shutdown()
+        assert not k.is_running()
+
+    def test_lookup_and_bootstrap(self, tmp_path):
+        class LocalKrpc(krpc.Krpc):
+            bootstrap_addrs = []
+
+        path = str(tmp_path / 'krpc.sock')
+        k = LocalKrpc(address=('127.0.0.1', 0), snapshot_path='')
+        d = daemon.Daemon(path, k)
+        k.start()
+        try:
+            while getattr(k, 'core', None) is None:
+                time.sleep(0.01)
+
+            async def join():
+                # responses carry `ip` and get_peers ones a `token`, both bytes in the node information
+                protocols = await create_swarm(5)
+                k.core.resolver = BootstrapResolver([x.address for x in protocols])
+                return protocols
+
+            async def run():
+                protocols = await k.call(join)
+                server = await aio.start_unix_server(d.handle, path)
+                async with server:
+                    client = daemon.DaemonClient(path, timeout=5)
+                    ret = [
+                        await client.request('bootstrap', method='find_node', timeout=1),
+                        await client.request('lookup', target='11' * 20, query='find_node', timeout=2),
+                        await client.request('lookup', target='11' * 20, query='get_peers', timeout=2),
+                    ]
+                for p in protocols:
+                    k.loop.call_soon_threadsafe(p.transport.close)
+                return protocols, ret
+
+            protocols, ret = aio.run(run())
+            ids = {x.node.base16 for x in protocols}
+            for resp in ret:
+                assert resp['errcode'] == ErrCode.SUCCESS, resp
+                assert resp['nodes'] and {x['id'] for x in resp['nodes']} <= ids
+                assert all(x['addr'][0] == '127.0.0.1' for x in resp['nodes'])
+
+            # bytes left in a response come back as an errcode line, not as a dropped connection
+            class Writer(list):
+                write = list.append
+
+            writer = Writer()
+            d._write(writer, {'token': b'\x00'})
+            assert json.loads(writer[0])['errcode'] == ErrCode.SERVER_ERROR
+        finally:
+            d.shutdown()
+
+
+class TestMetrics:
+    def test_histogram(self):
+        h = Histogram((0.1, 1))
+        for x in (0.05, 0.1, 0.5, 2):
+            h.observe(x)
+        assert h.cumulative() == [('0.1', 2), ('1', 3), ('+Inf', 4)] and h.sum == 2.65
+
+    def test_unknown_labels(self):
+        metrics = KrpcMetrics()
+        metrics.received('q', 'vote')
+        metrics.received('e', '999')
+        metrics.received('e', '203')
+        assert metrics.packets_in == {('q', 'other'): 1, ('e', 'other'): 1, ('e', '203'): 1}
+
+    @staticmethod
+    def run_swarm():
+        async def run():
+            swarm = Swarm(16, SimNetwork(latency=(0.001, 0.002), seed=2), seed=2, verify_rate=1000)
+            await swarm.start()
+            await swarm.bootstrap(rounds=1)
+            swarm.protocols[1].transport.sendto(b'garbage', swarm.addresses[0])
+            await aio.sleep(0.01)
+            swarm.stop()
+            return swarm.protocols[0]
+
+        return aio.run(run())
+
+    def test_krpc_counters(self):
+        metrics = self.run_swarm().metrics
+        assert metrics.packets_in[('q', 'find_node')] == metrics.packets_out[('r', 'find_node')] > 0
+        assert metrics.packets_in[('invalid', '')] == 1
+        assert len(metrics.rtt['ping']) == metrics.packets_out[('q', 'ping')] - metrics.timeouts.get('ping', 0)
+
+    def test_collector(self):
+        prometheus_client = pytest.importorskip('prometheus_client')
+        protocol = self.run_swarm()
+        registry = prometheus_client.CollectorRegistry()
+        registry.register(KrpcCollector(lambda: protocol))
+        assert registry.get_sample_value('krpc_routing_table_nodes') == len(protocol.dht)
+        assert registry.get_sample_value('krpc_packets_received_total', dict(kind='q', query='find_node')) > 0
+
+
+class TestLookup:
+    def test_lookup(self):
+        async def run():
+            protocols = await create_swarm(20)
+            target = protocols[7].node.data
+            nodes, peers = await protocols[0].lookup(target, k=8)
+            for p in protocols:
+                p.transport.close()
+            expected = sorted((x.node for x in protocols[1:]), key=lambda x: bytes(distance(x, Node(target))))
+            assert nodes == expected[:8]
+            assert peers == set()
+
+        aio.run(run())
+
+    def test_malformed_responder(self):
+        async def run():
+            protocols = await create_swarm(8)
+            bad = protocols[3]
+
+            def answer(data, addr):
+                t = bencodepy.decode(data)[b't']
+                bad.transport.sendto(bencodepy.encode({'t': t, 'y': 'r', 'r': {'id': b'x' * 19, 'nodes': b''}}), addr)
+
+            bad.datagram_received = answer
+            nodes, _ = await protocols[0].lookup(os.urandom(20), k=8)
+            for p in protocols:
+                p.transport.close()
+            return protocols, nodes
+
+        protocols, nodes = aio.run(run())
+        assert len(nodes) == 6 and all(len(x.data) == 20 for x in nodes)
+
+
 class TestLibTorrent:
     @pytest.mark.parametrize('input,expected', [
         ('', ''),
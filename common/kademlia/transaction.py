@@ -0,0 +1,158 @@
+import asyncio as aio
+import math
+import random
+import struct
+
+"""
+    krpc transaction table
+
+    outstanding queries are keyed by compact 16 bits transaction ids, and all of them expire through
+    one hashed timer wheel ticking on the event loop instead of one timer handle per query
+"""
+
+_TRANSACTION_IDS = [struct.pack('>H', i) for i in range(1 << 16)]
+
+
+class Transaction:
+    __slots__ = ('tid', 'future', 'addr', 'expire_tick', 'ctime')
+
+    def __init__(self, tid: bytes, future: aio.Future, addr, expire_tick: int, ctime: float):
+        self.tid = tid
+        self.future = future
+        self.addr = addr
+        self.expire_tick = expire_tick
+        self.ctime = ctime
+
+
+class TransactionManager:
+    """
+    Examples:
+    >>> table = TransactionManager(aio.get_running_loop())
+    >>> future = table.create(('127.0.0.1', 6881), timeout=0.2)
+    >>> table.resolve(future.tid, addr, (msg, addr))
+
+    with `shards` > 1 the id space is partitioned, shard `i` only hands out ids with `id % shards == i`,
+    so the owner of any response can be told from its transaction id
+    """
+
+    def __init__(self, loop: aio.AbstractEventLoop, resolution=0.05, wheel_size=512, shard=0, shards=1):
+        assert 0 <= shard < shards
+        self.loop = loop
+        self.resolution = resolution
+        self.wheel_size = wheel_size
+        self.shard = shard
+        self.shards = shards
+        self._ids = ((1 << 16) - (1 << 16) % shards) // shards     # ids available to this shard
+
+        self._sessions = dict()     # tid -> Transaction
+        self._wheel = [dict() for _ in range(wheel_size)]     # slot -> {tid: Transaction}
+        self._epoch = loop.time()
+        self._tick = 0
+        self._handle = None
+        self._next_id = random.randrange(self._ids)
+
+        # counters
+        self.created = 0
+        self.responses = 0
+        self.timeouts = 0
+        self.drifting = 0
+        self.retries = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, tid: bytes):
+        return tid in self._sessions
+
+    def allocate(self) -> bytes:
+        """ next free transaction id, ids are handed out monotonically and wrap at 65536 """
+        for _ in range(self._ids):
+            self._next_id = (self._next_id + 1) % self._ids
+            tid = _TRANSACTION_IDS[self._next_id * self.shards + self.shard]
+            if tid not in self._sessions:
+                return tid
+        raise RuntimeError('TransactionManager.allocate|all transaction ids are in use')
+
+    def owner(self, tid: bytes) -> int | None:
+        """ shard which allocated `tid`, None for ids no shard hands out """
+        if len(tid) != 2:
+            return None
+        i = (tid[0] << 8) | tid[1]
+        if i >= self._ids * self.shards:
+            return None
+        return i % self.shards
+
+    def create(self, addr, timeout: float) -> aio.Future:
+        """ register a new transaction, the returned future has a `tid` attribute and resolves to (message, addr) """
+        tid = self.allocate()
+        future = self.loop.create_future()
+        future.tid = tid
+        now = self.loop.time()
+        expire_tick = max(math.ceil((now + timeout - self._epoch) / self.resolution), self._tick + 1)
+        trans = Transaction(tid, future, addr, expire_tick, now)
+        self._sessions[tid] = trans
+        self._wheel[expire_tick % self.wheel_size][tid] = trans
+        self.created += 1
+
+        if self._handle is None:
+            self._handle = self.loop.call_later(self.resolution, self._advance)
+        return future
+
+    def resolve(self, tid: bytes, addr, result) -> bool:
+        """
+        deliver a response received from `addr`, return False for drifting packets which match no
+        outstanding transaction. a response from another address than the query was sent to is
+        drifting too, and the transaction keeps waiting for the queried node
+        """
+        trans = self._sessions.get(tid)
+        if trans is None or trans.addr != addr:
+            self.drifting += 1
+            return False
+        del self._sessions[tid]
+        del self._wheel[trans.expire_tick % self.wheel_size][tid]
+        if trans.future.done():
+            return False
+        trans.future.set_result(result)
+        self.responses += 1
+        return True
+
+    def cancel_all(self, msg=None):
+        for trans in self._sessions.values():
+            trans.future.cancel(msg)
+        self._sessions.clear()
+        for slot in self._wheel:
+            slot.clear()
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def stats(self) -> dict:
+        return dict(
+            outstanding=len(self._sessions),
+            created=self.created,
+            responses=self.responses,
+            timeouts=self.timeouts,
+            drifting=self.drifting,
+            retries=self.retries,
+        )
+
+    def _advance(self):
+        now_tick = int((self.loop.time() - self._epoch) / self.resolution)
+        start = max(self._tick + 1, now_tick - self.wheel_size + 1)
+        for tick in range(start, now_tick + 1):
+            slot = self._wheel[tick % self.wheel_size]
+            if not slot:
+                continue
+            expired = [x for x in slot.values() if x.expire_tick <= now_tick]
+            for trans in expired:
+                del slot[trans.tid]
+                del self._sessions[trans.tid]
+                if not trans.future.done():
+                    trans.future.set_exception(aio.TimeoutError())
+                    self.timeouts += 1
+        self._tick = max(self._tick, now_tick)
+
+        if self._sessions:
+            self._handle = self.loop.call_later(self.resolution, self._advance)
+        else:
+            self._handle = None
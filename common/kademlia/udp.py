@@ -0,0 +1,249 @@
+import asyncio as aio
+import errno
+import socket
+import struct
+import time
+from collections import deque
+
+"""
+    batch draining udp transport
+
+    the asyncio selector transport reads one datagram per readiness callback, under bursts the receive
+    queue overflows and the kernel silently drops packets. this transport drains up to `batch`
+    datagrams per readiness event with `recvmsg`, reads the kernel drop counter from SO_RXQ_OVFL
+    ancillary data, and keeps replies in a bounded, optionally paced send queue instead of losing them
+    when the send buffer is full
+
+    refer:
+     socket(7) - https://man7.org/linux/man-pages/man7/socket.7.html
+"""
+
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40)   # linux value, not exported by the socket module
+_UINT32 = struct.Struct('=I')
+
+
+class BatchDatagramTransport(aio.DatagramTransport):
+    """
+    Examples:
+    >>> transport, protocol = await create_batch_endpoint(loop, KrpcProtocol, sock, batch=64)
+    >>> transport.stats()['kernel_dropped']
+    """
+
+    def __init__(self, loop: aio.AbstractEventLoop, sock: socket.socket, protocol: aio.DatagramProtocol,
+                 batch=64, bufsize=1 << 16, send_queue=4096, send_rate=0, send_burst=64):
+        super().__init__(extra={'socket': sock, 'sockname': sock.getsockname()})
+        sock.setblocking(False)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+        except OSError:
+            ancbufsize = 0
+        else:
+            ancbufsize = socket.CMSG_SPACE(_UINT32.size)
+
+        self._loop = loop
+        self._sock = sock
+        self._fileno = sock.fileno()
+        self._protocol = protocol
+        self._batch = batch
+        self._bufsize = bufsize
+        self._ancbufsize = ancbufsize
+        self._closing = False
+        self._writing = False
+        self._flush_handle = None
+
+        # paced send queue, `send_rate` packets per second, 0 means unlimited
+        self._queue = deque()
+        self._send_queue = send_queue
+        self._send_rate = send_rate
+        self._send_burst = send_burst
+        self._tokens = float(send_burst)
+        self._token_time = time.monotonic()
+
+        # counters
+        self.received = 0
+        self.batches = 0
+        self.kernel_dropped = 0     # cumulative SO_RXQ_OVFL counter of the socket
+        self.sent = 0
+        self.queued = 0
+        self.send_dropped = 0
+
+    def stats(self) -> dict:
+        return dict(
+            received=self.received,
+            batches=self.batches,
+            kernel_dropped=self.kernel_dropped,
+            sent=self.sent,
+            queued=self.queued,
+            send_dropped=self.send_dropped,
+            send_queue=len(self._queue),
+        )
+
+    def start(self):
+        self._protocol.connection_made(self)
+        self._loop.add_reader(self._fileno, self._read_ready)
+
+    # read
+
+    def _read_ready(self):
+        sock, protocol = self._sock, self._protocol
+        self.batches += 1
+        for _ in range(self._batch):
+            try:
+                data, ancdata, flags, addr = sock.recvmsg(self._bufsize, self._ancbufsize)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self._call(protocol.error_received, e)
+                return
+            for level, kind, cdata in ancdata:
+                if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL and len(cdata) >= _UINT32.size:
+                    self.kernel_dropped = _UINT32.unpack_from(cdata)[0]
+            self.received += 1
+            self._call(protocol.datagram_received, data, addr)
+            if self._closing:
+                return
+
+    # write
+
+    def sendto(self, data, addr=None):
+        if self._closing:
+            return
+        if not self._queue and self._take_token():
+            try:
+                self._sock.sendto(data, addr)
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    self._call(self._protocol.error_received, e)
+                    return
+            else:
+                self.sent += 1
+                return
+            self._refund()
+
+        if len(self._queue) >= self._send_queue:
+            self.send_dropped += 1
+            return
+        self._queue.append((bytes(data), addr))
+        self.queued += 1
+        self._schedule_flush()
+
+    def get_write_buffer_size(self):
+        return len(self._queue)
+
+    def _take_token(self) -> bool:
+        if not self._send_rate:
+            return True
+        now = time.monotonic()
+        self._tokens = min(self._send_burst, self._tokens + (now - self._token_time) * self._send_rate)
+        self._token_time = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def _refund(self):
+        if self._send_rate:
+            self._tokens += 1
+
+    def _schedule_flush(self):
+        if self._writing or self._flush_handle is not None:
+            return
+        if self._send_rate and self._tokens < 1:
+            self._flush_handle = self._loop.call_later(1 / self._send_rate, self._flush)
+        else:
+            self._flush_handle = self._loop.call_soon(self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        queue = self._queue
+        while queue:
+            if not self._take_token():
+                self._stop_writing()
+                self._schedule_flush()
+                return
+            data, addr = queue[0]
+            try:
+                self._sock.sendto(data, addr)
+            except (BlockingIOError, InterruptedError):
+                self._refund()
+                self._start_writing()
+                return
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    self._refund()
+                    self._start_writing()
+                    return
+                queue.popleft()
+                self._call(self._protocol.error_received, e)
+                continue
+            queue.popleft()
+            self.sent += 1
+
+        self._stop_writing()
+        if self._closing:
+            self._loop.call_soon(self._connection_lost, None)
+
+    def _start_writing(self):
+        if not self._writing:
+            self._writing = True
+            self._loop.add_writer(self._fileno, self._flush)
+
+    def _stop_writing(self):
+        if self._writing:
+            self._writing = False
+            self._loop.remove_writer(self._fileno)
+
+    # close
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        """ stop reading, queued replies are still sent before the connection is lost """
+        if self._closing:
+            return
+        self._closing = True
+        self._loop.remove_reader(self._fileno)
+        if not self._queue:
+            self._loop.call_soon(self._connection_lost, None)
+
+    def abort(self):
+        self._queue.clear()
+        self._closing = True
+        self._loop.remove_reader(self._fileno)
+        self._stop_writing()
+        self._loop.call_soon(self._connection_lost, None)
+
+    def _connection_lost(self, exc):
+        if self._sock is None:
+            return
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._stop_writing()
+        try:
+            self._protocol.connection_lost(exc)
+        finally:
+            self._sock.close()
+            self._sock = None
+
+    def _call(self, func, *args):
+        try:
+            func(*args)
+        except Exception as e:
+            self._loop.call_exception_handler({
+                'message': 'BatchDatagramTransport|protocol callback error',
+                'exception': e,
+                'transport': self,
+                'protocol': self._protocol,
+            })
+
+
+async def create_batch_endpoint(loop: aio.AbstractEventLoop, protocol_factory, sock: socket.socket, **kwargs):
+    """ counterpart of `loop.create_datagram_endpoint(protocol_factory, sock=sock)` """
+    protocol = protocol_factory()
+    transport = BatchDatagramTransport(loop, sock, protocol, **kwargs)
+    transport.start()
+    return transport, protocol
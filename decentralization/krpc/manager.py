@@ -1,102 +1,110 @@
 import asyncio as aio
+import contextlib
+import json
 import time
 
-from asgiref.sync import async_to_sync, sync_to_async
 from django.conf import settings
-from common.kademlia import krpc
+from common.kademlia import krpc, daemon
+from common.kademlia.constants import DEFAULT_BIT_TORRENT_CONFIG
 from common.constants import ErrCode, ErrMsg
 from common.utils import error_response
 
+"""
+    the krpc and bittorrent servers live in one daemon per host, see `common.kademlia.daemon`,
+    web workers only talk to it through its unix socket
+"""
+
 
 # assign user custom krpc config
 if hasattr(settings, 'KRPC_CONFIG'):
     krpc.DEFAULT_KRPC_CONFIG.update(getattr(settings, 'KRPC_CONFIG'))
 
 
-def get_default() -> krpc.Krpc:
-    ret = krpc.get_default()
-    return ret
+def get_client() -> daemon.DaemonClient:
+    return daemon.DaemonClient(krpc.DEFAULT_KRPC_CONFIG['daemon_socket'])
 
 
-def with_default(coro):
-    async def wrapper(*args, k: krpc.Krpc = None, **kwargs):
-        if not k:
-            k = get_default()
+def with_elapsed_time(coro):
+    async def wrapper(*args, **kwargs):
         start_time = time.time()
-        resp = await coro(k=k, *args, **kwargs)
+        resp = await coro(*args, **kwargs)
         resp['elapsed_time'] = int((time.time() - start_time)*1000)
         return resp
     return wrapper
 
 
-def run(k: krpc.Krpc = None):
-    if not k:
-        k = get_default()
+async def request(method: str, /, **params) -> dict:
+    try:
+        return await get_client().request(method, **params)
+    except OSError as e:
+        return error_response(ErrCode.KRPC_SERVER_NOT_START, 'daemon unreachable|error=%s' % e)
+    except aio.TimeoutError:
+        return error_response(ErrCode.TIMEOUT, 'daemon did not answer')
+
 
+def run():
     ret = error_response(ErrCode.SUCCESS)
+    if get_client().is_alive():
+        return ret
+
+    # a second daemon exits at once, the first one holds the socket lock
     try:
-        k.start()
-    except Exception as e:
-        ret = error_response(ErrCode.SERVER_ERROR, 'start_default_krpc|exception=%s' % e)
+        daemon.spawn(
+            krpc.DEFAULT_KRPC_CONFIG['daemon_socket'], cwd=settings.BASE_DIR,
+            args=(
+                '--address', '%s:%d' % tuple(krpc.DEFAULT_KRPC_CONFIG['address']),
+                '--bt-address', '%s:%d' % tuple(DEFAULT_BIT_TORRENT_CONFIG['address']),
+            ),
+        )
+    except OSError as e:
+        ret = error_response(ErrCode.SERVER_ERROR, 'spawn_krpc_daemon|exception=%s' % e)
     return ret
 
 
-def stop(k: krpc.Krpc = None):
-    if not k:
-        k = get_default()
+def stop():
+    return aio.run(request('stop'))
 
-    ret = error_response(ErrCode.SUCCESS)
-    try:
-        k.stop()
-    except Exception as e:
-        ret = error_response(ErrCode.SERVER_ERROR, 'start_default_krpc|exception=%s' % e)
-    return ret
 
+@with_elapsed_time
+async def bootstrap(info_hash, timeout=10, bootstrap_method=krpc.QueryType.FIND_NODE):
+    return await request('bootstrap', method=bootstrap_method, info_hash=info_hash, timeout=float(timeout))
 
-def bootstrap_ping(k: krpc.Krpc = None):
-    if not k:
-        k = get_default()
 
-    ret = error_response(ErrCode.SUCCESS)
-    # try:
-    #     k.core.bootstrap_by_ping()
-
-
-@with_default
-async def bootstrap(info_hash, timeout=10, k: krpc.Krpc =None, bootstrap_method=krpc.QueryType.FIND_NODE):
-    if not k:
-        k = get_default()
-
-    l = aio.get_running_loop()
-    aio.set_event_loop(k.loop)
-    ret = dict()
-    if bootstrap_method == krpc.QueryType.FIND_NODE:
-        nodes = await k.core.bootstrap_by_find_node(krpc.dht_bootstrap_address)
-    elif bootstrap_method == krpc.QueryType.GET_PEERS:
-        nodes, peers = await k.core.bootstrap_by_get_peers(bytes.fromhex(info_hash), krpc.dht_bootstrap_address, timeout=timeout)
-        ret['peers'] = peers
-    else:
-        nodes = await k.core.bootstrap_by_ping(krpc.dht_bootstrap_address)
-        bootstrap_method = krpc.QueryType.PING
-
-    ret['nodes'] = [x.information for x in nodes]
-    aio.set_event_loop(l)
-    return ret
+@with_elapsed_time
+async def lookup(target, query=krpc.QueryType.FIND_NODE, timeout=10):
+    return await request('lookup', target=target, query=query, timeout=float(timeout))
 
 
-@with_default
-async def status(k: krpc.Krpc):
-    ret = error_response(ErrCode.SUCCESS)
-    addr = ('127.0.0.1', 6881)
-    if not k.is_running():
-        return error_response(ErrCode.KRPC_SERVER_NOT_START)
+@with_elapsed_time
+async def status():
+    return await request('status')
+
+
+@with_elapsed_time
+async def metadata(info_hash, timeout=60):
+    return await request('metadata', info_hash=info_hash, timeout=float(timeout))
+
 
+async def metrics() -> dict:
+    return await request('metrics')
+
+
+async def stream_peers(info_hash: bytes, timeout=10):
+    """ ndjson lines, one per peer as soon as it is found, then a line with the count and elapsed time """
+    start_time = time.time()
+    count = 0
     try:
-        resp = await k.core.ping(addr)
+        async with contextlib.aclosing(get_client().stream('iter_peers', info_hash=info_hash.hex(), timeout=timeout)) as lines:
+            async for obj in lines:
+                if 'errcode' in obj:
+                    ret = obj
+                    break
+                count += 1
+                yield json.dumps(obj) + '\n'
+    except OSError as e:
+        ret = error_response(ErrCode.KRPC_SERVER_NOT_START, 'daemon unreachable|error=%s' % e)
     except aio.TimeoutError:
-        ret = error_response(ErrCode.TIMEOUT, 'timeout while self krpc ping')
-        ret['ping'] = False
-    else:
-        ret['ping'] = resp.get_queried_id().hex()
-
-    return ret
+        ret = error_response(ErrCode.TIMEOUT, 'daemon did not answer')
+    ret['count'] = count
+    ret['elapsed_time'] = int((time.time() - start_time)*1000)
+    yield json.dumps(ret) + '\n'
@@ -8,4 +8,8 @@ urlpatterns = [
     path('stop/', views.stop, name='stop'),
     path('bootstrap/', views.bootstrap, name='bootstrap'),
     path('status/', views.status, name='status'),
+    path('peers/', views.peers, name='peers'),
+    path('lookup/', views.lookup, name='lookup'),
+    path('metadata/', views.metadata, name='metadata'),
+    path('metrics/', views.metrics, name='metrics'),
 ]
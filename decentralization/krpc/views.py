@@ -1,4 +1,6 @@
-from django.http import HttpRequest, HttpResponse, JsonResponse, Http404, HttpResponseForbidden
+from django.http import HttpRequest, HttpResponse, JsonResponse, Http404, HttpResponseForbidden, StreamingHttpResponse
+from common.constants import ErrCode
+from common.utils import error_response
 from . import manager
 
 
@@ -28,3 +30,47 @@ async def status(request: HttpRequest):
     resp = await manager.status()
     return JsonResponse(resp)
 
+
+async def peers(request: HttpRequest):
+    # parse arguments
+    try:
+        info_hash = bytes.fromhex(request.GET.get('info_hash', ''))
+        timeout = float(request.GET.get('timeout', 10))
+    except ValueError:
+        info_hash = b''
+    if len(info_hash) != 20:
+        return JsonResponse(error_response(ErrCode.INVALID_PARAMETERS, 'info_hash should be 40 hex digits'))
+
+    # stream peers as they arrive
+    return StreamingHttpResponse(manager.stream_peers(info_hash, timeout), content_type='application/x-ndjson')
+
+
+async def lookup(request: HttpRequest):
+    # parse arguments
+    target = request.GET.get('target', '')
+    query = request.GET.get('query', 'find_node')
+    timeout = request.GET.get('timeout', 10)
+
+    # get result
+    ret = await manager.lookup(target, query, timeout)
+
+    return JsonResponse(ret)
+
+
+async def metadata(request: HttpRequest):
+    # parse arguments
+    info_hash = request.GET.get('info_hash', '')
+    timeout = request.GET.get('timeout', 60)
+
+    # name and files of the torrent, fetched from its peers
+    ret = await manager.metadata(info_hash, timeout)
+
+    return JsonResponse(ret)
+
+
+async def metrics(request: HttpRequest):
+    # prometheus text format rendered by the daemon
+    ret = await manager.metrics()
+    if ret['errcode'] != ErrCode.SUCCESS:
+        return JsonResponse(ret, status=503)
+    return HttpResponse(ret['text'], content_type='text/plain; version=0.0.4; charset=utf-8')